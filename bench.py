@@ -0,0 +1,352 @@
+# coding: utf-8
+# Офлайн-бенчмарк бота: обучение, генерация, сохранение и путь сообщения
+#
+# Запуск без Telegram: python bench.py --sizes 1000,10000,100000 --output report.json
+# Собственный корпус: --corpus export.txt (по сообщению в строке, экспорт /export,
+# JSON-список строк, файл чата из data/lsrr_db или result.json экспорта Telegram)
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+# Бот создаётся при импорте lssr и проверяет только формат токена, сеть не нужна
+os.environ.setdefault("TOKEN", "123456789:OFFLINE-BENCHMARK-TOKEN")
+
+from loguru import logger
+
+import lssr
+
+SYLLABLES = ["ра", "бо", "чи", "то", "ва", "ри", "щи", "за", "во", "ды", "ма", "ше", "ны", "ре",
+             "во", "лю", "ци", "я", "на", "ро", "до", "пар", "ти", "я", "со", "ве", "ты", "хлеб",
+             "мир", "труд", "зе", "мля", "крас", "но", "е", "зна", "мя", "ко", "ло", "хоз"]
+PUNCTUATION = ["", "", "", ".", "!", "?", "..."]
+EXPORT_LINE_PATTERN = re.compile(r"^\d+\.\s")
+# Настройки бота, которые меняет замер одного размера; после него они восстанавливаются
+CONFIG_OVERRIDES = ("MAX_MODEL_SIZE", "STORAGE_BACKEND", "DB_FOLDER", "SQLITE_PATH")
+
+# ==================== КОРПУСЫ ====================
+def synthetic_corpus(count: int, seed: int, vocabulary_size: int = 20000) -> List[str]:
+    """Синтетический корпус: слова из слогов с распределением Ципфа"""
+    rng = random.Random(seed)
+    words = []
+    seen = set()
+    while len(words) < vocabulary_size:
+        word = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+
+    messages = []
+    for _ in range(count):
+        length = max(1, int(rng.lognormvariate(2.0, 0.6)))
+        text = " ".join(rng.choices(words, weights, k=length))
+        messages.append(text + rng.choice(PUNCTUATION))
+    return messages
+
+def _telegram_text(text) -> str:
+    # В экспорте Telegram текст - строка или список фрагментов с разметкой
+    if isinstance(text, list):
+        return "".join(part if isinstance(part, str) else part.get("text", "") for part in text)
+    return text or ""
+
+def load_corpus(path: str) -> List[str]:
+    """Загружает записанный корпус сообщений"""
+    with open(path, "r", encoding="utf-8") as f:
+        if not path.endswith(".json"):
+            lines = [line.rstrip("\n") for line in f]
+            # Экспорт /export: шапка, разделитель и пронумерованные сообщения
+            if any(line.startswith("=====") for line in lines):
+                lines = [EXPORT_LINE_PATTERN.sub("", line) for line in lines if EXPORT_LINE_PATTERN.match(line)]
+            return [line for line in lines if line.strip()]
+        data = json.load(f)
+
+    if isinstance(data, dict):
+        data = data.get("messages", [])
+    messages = [_telegram_text(item.get("text")) if isinstance(item, dict) else item for item in data]
+    return [message for message in messages if isinstance(message, str) and message.strip()]
+
+def corpus_stats(messages: List[str]) -> Dict:
+    return {
+        "messages": len(messages),
+        "words": sum(len(message.split()) for message in messages),
+        "chars": sum(len(message) for message in messages),
+    }
+
+# ==================== ИЗМЕРЕНИЯ ====================
+def percentiles(samples: List[float]) -> Dict:
+    """Перцентили задержек в миллисекундах"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1)] * 1000, 4)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 4),
+        "p50_ms": pick(0.50),
+        "p90_ms": pick(0.90),
+        "p99_ms": pick(0.99),
+        "max_ms": round(ordered[-1] * 1000, 4),
+    }
+
+def timed(function: Callable, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+def peak_rss_mb() -> float:
+    # ru_maxrss в Linux - килобайты, в macOS - байты
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def new_chat(chat_id: int, messages: List[str]) -> lssr.ChatData:
+    """Чат, в окно которого помещается весь корпус"""
+    lssr.config.MAX_MODEL_SIZE = max(lssr.Config.MAX_MODEL_SIZE, len(messages))
+    chat_data = lssr.ChatData(chat_id)
+    for message in messages:
+        chat_data.add_message(message)
+    lssr.chats_data[chat_id] = chat_data
+    return chat_data
+
+def bench_train(chat_data: lssr.ChatData, use_tracemalloc: bool) -> Dict:
+    """Полная сборка модели, как в пуле обучения, но в текущем процессе"""
+    snapshot = chat_data.training_snapshot()
+    if use_tracemalloc:
+        tracemalloc.start()
+    model, elapsed = timed(lssr.build_model, *snapshot)
+    result = {
+        "messages": len(snapshot[0]),
+        "seconds": round(elapsed, 4),
+        "messages_per_second": round(len(snapshot[0]) / elapsed, 1) if elapsed else None,
+        "states": len(model.chain),
+        "transitions": model.chain.transition_count,
+        "model_estimate_mb": round(model.memory_estimate() / 1024 / 1024, 2),
+    }
+    if use_tracemalloc:
+        result["traced_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+        tracemalloc.stop()
+
+    chat_data.model = model
+    chat_data.model_version = chat_data.corpus_fingerprint()
+    return result
+
+def bench_update(chat_data: lssr.ChatData, extra: List[str], batch: int = 50) -> Dict:
+    """Дообучение пачками по batch сообщений (как каждые 50 сообщений в handle_message)"""
+    samples = []
+    window_start = len(chat_data.messages)
+    for start in range(0, len(extra) - batch + 1, batch):
+        for message in extra[start:start + batch]:
+            chat_data.add_message(message)
+        _, elapsed = timed(chat_data.update_model)
+        samples.append(elapsed)
+    return {"batch": batch, "window_start": window_start, "window_end": len(chat_data.messages),
+            **percentiles(samples)}
+
+def bench_generate(chat_data: lssr.ChatData, contexts: List[str], calls: int) -> Dict:
+    """Задержка generate_message без пула готовых предложений"""
+    results = {"model_messages": chat_data.model.message_count}
+    for label, pick_context in (("plain", lambda: ""), ("context", lambda: random.choice(contexts))):
+        samples = []
+        produced = 0
+        for _ in range(calls):
+            chat_data.sentence_pool.clear()
+            context = pick_context()
+            reply, elapsed = timed(lssr.generate_message, chat_data, context)
+            samples.append(elapsed)
+            produced += reply is not None
+        results[label] = {"replies": produced, **percentiles(samples)}
+
+    # Пакетная генерация, как при пополнении пулов
+    sentences, elapsed = timed(lssr.generate_model_sentences, chat_data.model, lssr.config.SENTENCE_POOL_MAX)
+    results["pool_batch"] = {
+        "requested": lssr.config.SENTENCE_POOL_MAX,
+        "produced": len(sentences),
+        "ms": round(elapsed * 1000, 4),
+    }
+    return results
+
+def bench_ingest(chat_data: lssr.ChatData, messages: List[str]) -> Dict:
+    """Синхронная часть пути сообщения: запись в буфер и проверка обращения к боту"""
+    window = len(chat_data.messages)
+    started = time.perf_counter()
+    triggered = 0
+    for message in messages:
+        chat_data.add_message(message)
+        triggered += lssr.is_triggered(chat_data, message, "lssr_bench_bot")
+    elapsed = time.perf_counter() - started
+    return {
+        "messages": len(messages),
+        "window_messages": window,
+        "us_per_message": round(elapsed / len(messages) * 1e6, 3) if messages else None,
+        "triggered": triggered,
+    }
+
+async def bench_persistence(snapshot: Dict, extra: List[str], workdir: str) -> Dict:
+    """Сохранение и загрузка чата для обоих хранилищ"""
+    results = {}
+    for backend in ("json", "sqlite"):
+        # Каждое хранилище получает одинаковую копию чата, иначе extra добавился бы дважды
+        chat_data = lssr.ChatData.from_dict(snapshot)
+        lssr.config.STORAGE_BACKEND = backend
+        lssr.config.DB_FOLDER = os.path.join(workdir, backend, "lsrr_db")
+        lssr.config.SQLITE_PATH = os.path.join(workdir, backend, "lssr.sqlite3")
+        os.makedirs(lssr.config.DB_FOLDER, exist_ok=True)
+        lssr.chats_data.clear()
+        lssr.chats_data[chat_data.chat_id] = chat_data
+        chat_data.dirty = True
+        saved_messages = len(chat_data.messages)
+        started = time.perf_counter()
+        written = await lssr.save_chat_data(chat_data.chat_id)
+        full_save = time.perf_counter() - started
+
+        # Повторное сохранение после небольшой пачки новых сообщений
+        for message in extra:
+            chat_data.add_message(message)
+        started = time.perf_counter()
+        written_delta = await lssr.save_chat_data(chat_data.chat_id)
+        delta_save = time.perf_counter() - started
+
+        lssr.chats_data.clear()
+        started = time.perf_counter()
+        await lssr.load_all_chats()
+        load = time.perf_counter() - started
+        loaded = lssr.chats_data.get(chat_data.chat_id)
+        messages = len(loaded.messages) if loaded else 0
+
+        if lssr.sqlite_storage is not None:
+            lssr.sqlite_storage.close()
+            lssr.sqlite_storage = None
+
+        results[backend] = {
+            "messages": saved_messages,
+            "save_seconds": round(full_save, 4),
+            "save_bytes": written,
+            "save_messages_per_second": round(saved_messages / full_save, 1) if full_save else None,
+            "delta_messages": len(extra),
+            "delta_save_seconds": round(delta_save, 4),
+            "delta_save_bytes": written_delta,
+            "load_seconds": round(load, 4),
+            "load_messages": messages,
+            "load_messages_per_second": round(messages / load, 1) if load else None,
+        }
+
+    lssr.chats_data.clear()
+    return results
+
+async def bench_size(size: int, corpus: List[str], args, workdir: str) -> Dict:
+    """Все измерения для одного размера корпуса"""
+    random.seed(args.seed + size)
+    messages = corpus[:size]
+    extra = synthetic_corpus(args.update_messages + args.ingest_messages, args.seed + size + 1)
+    chat_id = -1000000000000 - size
+
+    saved_config = {name: getattr(lssr.config, name) for name in CONFIG_OVERRIDES}
+    lssr.model_cache.clear()
+    lssr.chats_data.clear()
+    try:
+        chat_data = new_chat(chat_id, messages)
+        # Сохранение меряется на исходном корпусе, а не на чате, выросшем от дообучения
+        snapshot = chat_data.to_dict()
+
+        result = {"size": size, "corpus": corpus_stats(messages)}
+        result["train"] = bench_train(chat_data, args.tracemalloc)
+        random.seed(args.seed + size)
+        result["update"] = bench_update(chat_data, extra[:args.update_messages])
+        random.seed(args.seed + size)
+        result["generate"] = bench_generate(chat_data, messages, args.generate_calls)
+        result["persistence"] = await bench_persistence(snapshot, extra[:args.update_messages // 10], workdir)
+        result["ingest"] = bench_ingest(chat_data, extra[args.update_messages:])
+        result["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        for name, value in saved_config.items():
+            setattr(lssr.config, name, value)
+        lssr.model_cache.clear()
+        lssr.chats_data.clear()
+    return result
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run(args) -> Dict:
+    sizes = [int(size) for size in args.sizes.split(",")]
+    if args.corpus:
+        corpus = load_corpus(args.corpus)
+        sizes = sorted({min(size, len(corpus)) for size in sizes})
+    else:
+        corpus = synthetic_corpus(max(sizes), args.seed)
+
+    workdir = tempfile.mkdtemp(prefix="lssr-bench-")
+    lssr.config.MODEL_FOLDER = os.path.join(workdir, "models")
+    try:
+        results = []
+        for size in sizes:
+            print(f"Бенчмарк: {size} сообщений", file=sys.stderr)
+            results.append(await bench_size(size, corpus, args, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "meta": {
+            "bot_version": lssr.config.BOT_VERSION,
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": lssr.np is not None,
+            "chain_engine": lssr.config.CHAIN_ENGINE,
+            "corpus": args.corpus or "synthetic",
+            "seed": args.seed,
+            "started_at": int(time.time()),
+        },
+        "results": results,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота ЛССР")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="Размеры корпуса через запятую (до 1000000)")
+    parser.add_argument("--corpus", help="Записанный корпус вместо синтетического")
+    parser.add_argument("--seed", type=int, default=1917)
+    parser.add_argument("--generate-calls", type=int, default=300)
+    parser.add_argument("--update-messages", type=int, default=1000)
+    parser.add_argument("--ingest-messages", type=int, default=10000)
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="Точный пик памяти при сборке модели (замедляет сборку)")
+    parser.add_argument("--output", help="Файл отчёта JSON (по умолчанию - stdout)")
+    args = parser.parse_args()
+
+    # В отчёт идут только результаты, журнал бота - лишь предупреждения
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,44 @@
 # coding: utf-8
 # Председатель ЛССР - Бот для генерации сообщений на основе цепей Маркова
 
+import argparse
 import asyncio
+import bisect
+import functools
+import heapq
+import hmac
+import io
+import itertools
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
 import json
 import os
+import pickle
 import random
 import re
+import secrets
+import signal
+import sqlite3
 import sys
+import threading
 import time
-from typing import Dict, List, Optional, Tuple
+import zlib
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
 from enum import Enum
 import math
 
 import aiofiles
 import aiogram
+import aiohttp
 import dateparser
 import dotenv
 import markovify
+from markovify.chain import BEGIN, END
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
@@ -27,8 +47,15 @@ from aiogram.types import (Message, InlineKeyboardMarkup,
                           ChatMemberUpdated, ChatMember)
 from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.utils.exceptions import BadRequest, ChatNotFound, RetryAfter, Unauthorized
+from aiohttp import web
 from loguru import logger
 
+try:
+    import numpy as np
+except ImportError:  # numpy необязателен: без него цепь обходится по одному блужданию
+    np = None
+
 # Определяем базовую директорию
 if getattr(sys, 'frozen', False):
     BASE_DIR = os.path.dirname(sys.executable)
@@ -57,12 +84,85 @@ class Config:
     MIN_MESSAGES_FOR_TRAINING = 50  # Минимальное кол-во сообщений для обучения
     MAX_MODEL_SIZE = 30000  # Максимальное количество сообщений в модели
     SAVE_INTERVAL = 300  # Интервал автосохранения в секундах
+    SAVE_CONCURRENCY = 8  # Сколько чатов автосохранение пишет одновременно
     
     # Настройки генерации текста
     MIN_SENTENCE_LENGTH = 10
     MAX_SENTENCE_LENGTH = 500
     SHORT_SENTENCE_MAX = 50
     MAX_TRIES_GENERATION = 100
+    GENERATION_BATCH = 16  # Блужданий цепи за раз на каждое нужное предложение (большие пакеты - через numpy)
+    CONTEXT_WORDS = 3  # Сколько слов сообщения используется как контекст ответа
+    CONTEXT_SEEDS = 10  # Сколько стартовых состояний пробовать для контекстного ответа
+    
+    # Пул заранее сгенерированных предложений
+    SENTENCE_POOL_MIN = 3  # Размер пула для редко отвечающих чатов
+    SENTENCE_POOL_MAX = 30  # Размер пула для самых активных чатов
+    POOL_REFILL_INTERVAL = 5  # Период фонового пополнения пулов в секундах
+    POOL_IDLE_SECONDS = 10  # Пул пополняется, только если чат молчит столько секунд
+    POOL_REFILL_BATCH = 50  # Максимум предложений за один проход пополнения
+    POOL_REFILL_STEP = 5  # Предложений за один шаг без возврата управления циклу событий
+    
+    # Настройки обучения
+    TRAINING_WORKERS = int(os.getenv("TRAINING_WORKERS", "2"))  # Процессов для сборки моделей (0 - в основном процессе)
+    MODEL_CACHE_MB = int(os.getenv("MODEL_CACHE_MB", "512"))  # Бюджет памяти для моделей в памяти
+    CHAIN_ENGINE = os.getenv("CHAIN_ENGINE", "compact")  # "compact" - плоские массивы, "dict" - словари как в markovify
+    
+    # Слова, на которые бот реагирует как на обращение (помимо упоминания)
+    TRIGGER_WORDS = ["председатель", "лсср"]
+    MAX_CUSTOM_TRIGGERS = 20  # Максимум собственных слов-триггеров в чате
+    BOT_IDENTITY_REFRESH = 3600  # Период обновления данных бота (get_me) в секундах
+    TYPING_DELAY = (0.5, 1.5)  # Сколько секунд бот "печатает" перед ответом
+    
+    # Исходящие сообщения: лимиты Telegram - около 30 сообщений в секунду всего,
+    # 1 в секунду в личный чат и 20 в минуту в группу
+    SEND_RATE = float(os.getenv("SEND_RATE", "25"))  # Сообщений в секунду на всего бота
+    SEND_BURST = 5  # Сколько сообщений может уйти разом после простоя
+    SEND_CHAT_INTERVAL = 1.0  # Минимальный промежуток между ответами в личный чат
+    SEND_GROUP_INTERVAL = 3.0  # То же для групп
+    SEND_MAX_ATTEMPTS = 3  # Попыток отправки при сетевых ошибках
+    SEND_CHAT_BACKLOG = 3  # Сколько ответов чата может ждать отправки, лишние вытесняют старые
+    REPLY_MAX_LATE = 30  # Ответ, опоздавший больше чем на столько секунд, отбрасывается
+    REPLY_STALE_MESSAGES = 20  # Ответ отбрасывается, если в чате за это время написали столько сообщений
+    
+    # Рассылка (/broadcast) идёт с общим лимитом SEND_RATE и продолжается после перезапуска
+    BROADCAST_CONCURRENCY = 8  # Сколько сообщений рассылки отправляются одновременно
+    BROADCAST_SAVE_INTERVAL = 5  # Период сохранения прогресса в секундах
+    BROADCAST_PROGRESS_INTERVAL = 5  # Период обновления сообщения с прогрессом в секундах
+    BROADCAST_WATCH_RETRIES = 12  # Сколько проверок подряд ждать молчащий шард
+    
+    # Адрес Bot API (пусто - api.telegram.org), например локальный telegram-bot-api
+    TELEGRAM_API_SERVER = os.getenv("TELEGRAM_API_SERVER", "")
+    
+    # Вебхук (python lssr.py --webhook) вместо long polling
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Внешний адрес, например https://bot.example.com (пусто - не регистрировать)
+    WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+    WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")  # За обратным прокси; 0.0.0.0 - принимать напрямую
+    WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Сверяется с заголовком X-Telegram-Bot-Api-Secret-Token (пусто - случайный)
+    WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))  # Сколько обновлений обрабатывается одновременно
+    WEBHOOK_QUEUE = 1000  # Принятые, но не начатые обновления; при переполнении ответ Telegram ждёт места
+    
+    # Обработка обновлений: один чат - строго по очереди, разные чаты - параллельно
+    CHAT_CONCURRENCY = int(os.getenv("CHAT_CONCURRENCY", "64"))  # Сколько чатов обрабатываются одновременно
+    MAX_PENDING_UPDATES = 10000  # Принятые, но не обработанные обновления; дальше приём ждёт
+    
+    # Шарды (python lssr.py --shards N): фронт раздаёт обновления N процессам по chat_id
+    SHARDS = int(os.getenv("SHARDS", "0"))  # 0 или 1 - всё в одном процессе
+    SHARD_INDEX = int(os.getenv("SHARD_INDEX", "-1"))  # Номер шарда процесса-воркера (задаёт фронт)
+    SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", "8180"))  # Шард i слушает 127.0.0.1:SHARD_BASE_PORT+i
+    SHARD_SECRET = os.getenv("SHARD_SECRET", "")  # Общий секрет фронта и шардов (генерируется фронтом)
+    SHARD_START_TIMEOUT = 120  # Сколько фронт ждёт готовности шардов в секундах
+    
+    # Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (0 - выключены)
+    METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+    METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+    METRICS_CHAT_LABELS = 200  # Сколько чатов получают собственную метку, остальные идут в "other"
+    
+    # Профилирование
+    SLOW_HANDLER_MS = int(os.getenv("SLOW_HANDLER_MS", "500"))  # Обработчики дольше этого пишутся в журнал
+    PROFILE_INTERVAL = 0.005  # Шаг сэмплирующего профилировщика в секундах
+    PROFILE_MAX_SECONDS = 300  # Максимальная длительность /profile
     
     # Настройки времени
     DEFAULT_DISABLE_TIME = timedelta(days=7)  # По умолчанию отключаем на неделю
@@ -70,6 +170,11 @@ class Config:
     
     DB_FOLDER = os.path.join(BASE_DIR, "data", "lsrr_db") 
     MODEL_FOLDER = os.path.join(BASE_DIR, "data", "models")  
+    
+    # Хранилище: "json" - файл на чат в DB_FOLDER, "sqlite" - база SQLITE_PATH
+    STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+    SQLITE_PATH = os.path.join(BASE_DIR, "data", "lssr.sqlite3")
+    BROADCAST_PATH = os.path.join(BASE_DIR, "data", "broadcast.json")  # Прогресс последней рассылки
         
     # Эмоциональные состояния бота
     MOODS = {
@@ -143,22 +248,1199 @@ class BotStates(StatesGroup):
     waiting_for_training_params = State()
     waiting_for_admin_command = State()
 
+# ==================== ЦЕПИ МАРКОВА ====================
+TOKEN_PATTERN = re.compile(r"\w+")
+
+def tokenize(text: str) -> List[str]:
+    """Нормализованные токены текста для поиска по индексу"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+class Vocabulary:
+    """Общий для всех чатов словарь слов: модели хранят целочисленные идентификаторы"""
+    
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._words: List[str] = []
+        self._lengths = array('H')
+        self.string_bytes = 0
+    
+    def __len__(self) -> int:
+        return len(self._words)
+    
+    def encode(self, word: str) -> int:
+        """Идентификатор слова; новое слово добавляется в словарь"""
+        token_id = self._ids.get(word)
+        if token_id is None:
+            token_id = self._ids[word] = len(self._words)
+            self._words.append(word)
+            self._lengths.append(min(len(word), 65535))
+            self.string_bytes += sys.getsizeof(word)
+        return token_id
+    
+    def length(self, token_id: int) -> int:
+        """Длина слова в символах"""
+        return self._lengths[token_id]
+    
+    def encode_run(self, words: Iterable[str]) -> List[int]:
+        return [self.encode(word) for word in words]
+    
+    def lookup(self, word: str) -> Optional[int]:
+        """Идентификатор слова без добавления в словарь"""
+        return self._ids.get(word)
+    
+    def decode(self, token_id: int) -> str:
+        return self._words[token_id]
+    
+    def decode_run(self, token_ids: Iterable[int]) -> List[str]:
+        words = self._words
+        return [words[token_id] for token_id in token_ids]
+    
+    def saved_bytes(self, occurrences: int) -> int:
+        """Оценка сэкономленной памяти: без словаря каждое вхождение слова хранило бы свою строку"""
+        if not self._words:
+            return 0
+        average = self.string_bytes / len(self._words)
+        return max(0, int(occurrences * (average + 4) - self.string_bytes))
+
+vocabulary = Vocabulary()
+BEGIN_ID = vocabulary.encode(BEGIN)
+END_ID = vocabulary.encode(END)
+
+class IncrementalChain(markovify.Chain):
+    """Цепь Маркова с добавлением и удалением переходов без полной перестройки"""
+    
+    _end_distances: Optional[Dict[Tuple[int, ...], int]] = None
+    
+    def __init__(self, state_size: int, begin: int = BEGIN_ID, end: int = END_ID):
+        self.state_size = state_size
+        self.model: Dict[Tuple[int, ...], Dict[int, int]] = {}
+        self.compiled = False
+        self.begin_state = (begin,) * state_size
+        self.end = end
+        self.begin_choices: List[int] = []
+        self.begin_cumdist: List[int] = []
+        self.transition_count = 0
+        self._begin_dirty = True
+    
+    def _transitions(self, run: Iterable[int]):
+        """Перебирает пары (состояние, следующее слово) для одного предложения"""
+        items = list(self.begin_state)
+        items.extend(run)
+        items.append(self.end)
+        for i in range(len(items) - self.state_size):
+            yield tuple(items[i:i + self.state_size]), items[i + self.state_size]
+    
+    def add_run(self, run: Iterable[int]):
+        """Добавляет переходы предложения в цепь"""
+        for state, follow in self._transitions(run):
+            next_dict = self.model.get(state)
+            if next_dict is None:
+                next_dict = self.model[state] = {}
+            if follow not in next_dict:
+                self.transition_count += 1
+            next_dict[follow] = next_dict.get(follow, 0) + 1
+        self._begin_dirty = True
+    
+    def remove_run(self, run: Iterable[int]):
+        """Убирает переходы предложения из цепи"""
+        for state, follow in self._transitions(run):
+            next_dict = self.model.get(state)
+            if not next_dict or follow not in next_dict:
+                continue
+            next_dict[follow] -= 1
+            if next_dict[follow] <= 0:
+                del next_dict[follow]
+                self.transition_count -= 1
+                if not next_dict:
+                    del self.model[state]
+        self._begin_dirty = True
+    
+    def __len__(self) -> int:
+        return len(self.model)
+    
+    def __contains__(self, state) -> bool:
+        return state in self.model
+    
+    def transitions(self):
+        """Перебирает тройки (состояние, следующее слово, вес)"""
+        for state, next_dict in self.model.items():
+            for follow, count in next_dict.items():
+                yield state, follow, count
+    
+    @classmethod
+    def from_transitions(cls, state_size: int, begin: int, end: int, transitions) -> "IncrementalChain":
+        chain = cls(state_size, begin, end)
+        for state, follow, count in transitions:
+            next_dict = chain.model.get(state)
+            if next_dict is None:
+                next_dict = chain.model[state] = {}
+            next_dict[follow] = count
+            chain.transition_count += 1
+        return chain
+    
+    def remapped(self, convert: Callable[[int], int]) -> "IncrementalChain":
+        """Копия цепи с перекодированными идентификаторами слов"""
+        chain = type(self).from_transitions(
+            self.state_size, convert(self.begin_state[0]), convert(self.end),
+            ((tuple(map(convert, state)), convert(follow), count)
+             for state, follow, count in self.transitions()))
+        if self._end_distances is not None:
+            chain._end_distances = {tuple(map(convert, state)): distance
+                                    for state, distance in self._end_distances.items()}
+        return chain
+    
+    def memory_estimate(self) -> int:
+        return len(self.model) * 250 + self.transition_count * 70
+    
+    def compact_if_needed(self):
+        """Точка обслуживания после пачки изменений (для словарной цепи не нужна)"""
+    
+    def row(self, state) -> List[Tuple[int, int]]:
+        """Переходы состояния с весами"""
+        return list(self.model[state].items())
+    
+    def shortest_endings(self, word_length: Callable[[int], int]) -> Dict[Tuple[int, ...], int]:
+        """Для каждого состояния - минимум символов до конца предложения (Дейкстра от END)"""
+        incoming: Dict[Tuple[int, ...], List[Tuple[Tuple[int, ...], int]]] = {}
+        distances: Dict[Tuple[int, ...], int] = {}
+        for state, follow, _ in self.transitions():
+            if follow == self.end:
+                distances[state] = 0
+            else:
+                target = tuple(state[1:]) + (follow,)
+                incoming.setdefault(target, []).append((state, word_length(follow) + 1))
+        
+        heap = [(0, state) for state in distances]
+        heapq.heapify(heap)
+        while heap:
+            distance, state = heapq.heappop(heap)
+            if distance > distances[state]:
+                continue
+            for previous, cost in incoming.get(state, ()):
+                candidate = distance + cost
+                if candidate < distances.get(previous, math.inf):
+                    distances[previous] = candidate
+                    heapq.heappush(heap, (candidate, previous))
+        return distances
+    
+    def has_end_distances(self) -> bool:
+        return self._end_distances is not None
+    
+    def set_end_distances(self, distances: Dict[Tuple[int, ...], int]):
+        self._end_distances = distances
+    
+    def end_distance(self, state) -> int:
+        """Минимум символов от состояния до конца предложения (0, если неизвестно)"""
+        return self._end_distances.get(state, 0) if self._end_distances is not None else 0
+    
+    def precompute_begin_state(self):
+        """Пересчитывает кэш начального состояния после изменений"""
+        begin_dict = self.model.get(self.begin_state, {})
+        self.begin_choices = list(begin_dict.keys())
+        self.begin_cumdist = list(markovify.chain.accumulate(begin_dict.values())) if begin_dict else []
+        self._begin_dirty = False
+    
+    def move(self, state):
+        if state == self.begin_state:
+            if self._begin_dirty:
+                self.precompute_begin_state()
+            choices, cumdist = self.begin_choices, self.begin_cumdist
+        else:
+            choices, weights = zip(*self.model[state].items())
+            cumdist = list(markovify.chain.accumulate(weights))
+        r = random.random() * cumdist[-1]
+        return choices[bisect.bisect(cumdist, r)]
+    
+    def gen(self, init_state=None):
+        state = init_state or self.begin_state
+        while True:
+            next_word = self.move(state)
+            if next_word == self.end:
+                break
+            yield next_word
+            state = tuple(state[1:]) + (next_word,)
+    
+    def can_vectorize(self, count: int) -> bool:
+        """Выполняет ли walk_batch блуждания векторно"""
+        return False
+    
+    def walk_batch(self, count: int, init_state=None, max_length: Optional[int] = None) -> Iterable[List[int]]:
+        """Лениво выдаёт count блужданий; блуждания длиннее max_length обрываются и пропускаются"""
+        for _ in range(count):
+            if max_length is None:
+                yield self.walk(init_state)
+                continue
+            walk = list(itertools.islice(self.gen(init_state), max_length + 1))
+            if len(walk) <= max_length:
+                yield walk
+
+class CompactChain(IncrementalChain):
+    """Цепь Маркова в плоских типизированных массивах.
+    
+    Состояния упакованы в 64-битные ключи и отсортированы, переходы состояния i
+    лежат в follows[offsets[i]:offsets[i + 1]] с накопленными весами в cumulative,
+    поэтому шаг цепи - два двоичных поиска. Изменения копятся в небольшом
+    словаре _delta и периодически вливаются в массивы
+    """
+    
+    ID_BITS = 32
+    COMPACT_MIN = 4096  # Минимум изменений в _delta перед слиянием с массивами
+    VECTOR_MIN = 128  # С какого числа блужданий numpy обгоняет обход по одному
+    
+    def __init__(self, state_size: int, begin: int = BEGIN_ID, end: int = END_ID):
+        if state_size * self.ID_BITS > 64:
+            raise ValueError("Компактная цепь поддерживает состояния не длиннее 2 слов")
+        self.state_size = state_size
+        self.compiled = True
+        self.begin_state = (begin,) * state_size
+        self.end = end
+        self.keys = array('Q')
+        self.offsets = array('I', [0])
+        self.follows = array('I')
+        self.cumulative = array('I')
+        self._delta: Dict[Tuple[int, ...], Dict[int, int]] = {}
+        self._delta_size = 0
+        self._merged: Dict[Tuple[int, ...], Tuple[List[int], List[int]]] = {}
+        self._vectors = None
+        self._distances: Optional[array] = None
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_merged"] = {}
+        state["_vectors"] = None
+        return state
+    
+    def _pack(self, state) -> int:
+        key = 0
+        for token_id in state:
+            key = key << self.ID_BITS | token_id
+        return key
+    
+    def _unpack(self, key: int) -> Tuple[int, ...]:
+        mask = (1 << self.ID_BITS) - 1
+        return tuple((key >> (self.ID_BITS * shift)) & mask
+                     for shift in range(self.state_size - 1, -1, -1))
+    
+    def _find(self, state) -> int:
+        """Номер строки состояния в массивах или -1"""
+        key = self._pack(state)
+        i = bisect.bisect_left(self.keys, key)
+        return i if i < len(self.keys) and self.keys[i] == key else -1
+    
+    def _base_row(self, i: int):
+        previous = 0
+        for j in range(self.offsets[i], self.offsets[i + 1]):
+            yield self.follows[j], self.cumulative[j] - previous
+            previous = self.cumulative[j]
+    
+    def _row(self, state) -> Dict[int, int]:
+        """Веса переходов состояния с учётом несохранённых изменений"""
+        i = self._find(state)
+        row = dict(self._base_row(i)) if i >= 0 else {}
+        for follow, step in self._delta.get(state, {}).items():
+            row[follow] = row.get(follow, 0) + step
+        return {follow: count for follow, count in row.items() if count > 0}
+    
+    def _count(self, state, follow: int) -> int:
+        count = self._delta.get(state, {}).get(follow, 0)
+        i = self._find(state)
+        if i >= 0:
+            lo, hi = self.offsets[i], self.offsets[i + 1]
+            # Строки короткие и не отсортированы; array.index(x, lo, hi) есть только с Python 3.10
+            for j in range(lo, hi):
+                if self.follows[j] == follow:
+                    count += self.cumulative[j] - (self.cumulative[j - 1] if j > lo else 0)
+                    break
+        return count
+    
+    def _adjust(self, state, follow: int, step: int):
+        row = self._delta.get(state)
+        if row is None:
+            row = self._delta[state] = {}
+        if follow not in row:
+            self._delta_size += 1
+        row[follow] = row.get(follow, 0) + step
+        self._merged.pop(state, None)
+    
+    def add_run(self, run: Iterable[int]):
+        """Добавляет переходы предложения в цепь"""
+        for state, follow in self._transitions(run):
+            self._adjust(state, follow, 1)
+    
+    def remove_run(self, run: Iterable[int]):
+        """Убирает переходы предложения из цепи"""
+        for state, follow in self._transitions(run):
+            if self._count(state, follow) > 0:
+                self._adjust(state, follow, -1)
+    
+    def __len__(self) -> int:
+        return len(self.keys) + sum(1 for state in self._delta if self._find(state) < 0)
+    
+    def __contains__(self, state) -> bool:
+        if state in self._delta:
+            return bool(self._row(state))
+        return self._find(state) >= 0
+    
+    @property
+    def transition_count(self) -> int:
+        if not self._delta:
+            return len(self.follows)
+        return sum(1 for _ in self.transitions())
+    
+    def transitions(self):
+        """Перебирает тройки (состояние, следующее слово, вес)"""
+        for i, key in enumerate(self.keys):
+            state = self._unpack(key)
+            row = self._row(state).items() if state in self._delta else self._base_row(i)
+            for follow, count in row:
+                yield state, follow, count
+        for state in self._delta:
+            if self._find(state) < 0:
+                for follow, count in self._row(state).items():
+                    yield state, follow, count
+    
+    @classmethod
+    def from_transitions(cls, state_size: int, begin: int, end: int, transitions) -> "CompactChain":
+        chain = cls(state_size, begin, end)
+        chain._load(transitions)
+        return chain
+    
+    def _realigned(self, keys: array, distances: array) -> array:
+        """Расстояния до конца, перенесённые на текущие ключи (новые состояния - 0)"""
+        aligned = array('H', bytes(2 * len(self.keys)))
+        j = 0
+        for i, key in enumerate(self.keys):
+            j = bisect.bisect_left(keys, key, j)
+            if j < len(keys) and keys[j] == key:
+                aligned[i] = distances[j]
+        return aligned
+    
+    def remapped(self, convert: Callable[[int], int]) -> "CompactChain":
+        """Копия цепи с перекодированными идентификаторами слов"""
+        chain = super().remapped(convert)
+        if self._distances is not None:
+            pairs = sorted((chain._pack(map(convert, self._unpack(key))), distance)
+                           for key, distance in zip(self.keys, self._distances))
+            chain._distances = chain._realigned(array('Q', [key for key, _ in pairs]),
+                                                array('H', [distance for _, distance in pairs]))
+        return chain
+    
+    def _load(self, transitions):
+        old_keys, old_distances = self.keys, self._distances
+        rows: Dict[int, List[Tuple[int, int]]] = {}
+        for state, follow, count in transitions:
+            if count > 0:
+                rows.setdefault(self._pack(state), []).append((follow, count))
+        
+        self.keys = array('Q', sorted(rows))
+        self.offsets = array('I', [0])
+        self.follows = array('I')
+        self.cumulative = array('I')
+        for key in self.keys:
+            total = 0
+            for follow, count in rows[key]:
+                total += count
+                self.follows.append(follow)
+                self.cumulative.append(total)
+            self.offsets.append(len(self.follows))
+        self._delta = {}
+        self._delta_size = 0
+        self._merged = {}
+        self._vectors = None
+        self._distances = self._realigned(old_keys, old_distances) if old_distances is not None else None
+    
+    def compact(self):
+        """Вливает накопленные изменения в массивы"""
+        if self._delta:
+            self._load(list(self.transitions()))
+    
+    def compact_if_needed(self):
+        if self._delta_size > max(self.COMPACT_MIN, len(self.follows) // 4):
+            self.compact()
+    
+    def memory_estimate(self) -> int:
+        distances = len(self._distances) * 2 if self._distances is not None else 0
+        return len(self.keys) * 12 + len(self.follows) * 8 + self._delta_size * 100 + distances
+    
+    def row(self, state) -> List[Tuple[int, int]]:
+        """Переходы состояния с весами"""
+        if state in self._delta:
+            return list(self._row(state).items())
+        i = self._find(state)
+        if i < 0:
+            raise KeyError(state)
+        return list(self._base_row(i))
+    
+    def has_end_distances(self) -> bool:
+        return self._distances is not None
+    
+    def set_end_distances(self, distances: Dict[Tuple[int, ...], int]):
+        # Расстояния хранятся массивом, выровненным по ключам состояний
+        self.compact()
+        self._distances = array('H', (min(distances.get(self._unpack(key), 0), 65535) for key in self.keys))
+    
+    def end_distance(self, state) -> int:
+        """Минимум символов от состояния до конца предложения (0, если неизвестно)"""
+        if self._distances is None:
+            return 0
+        i = self._find(state)
+        return self._distances[i] if i >= 0 else 0
+    
+    def can_vectorize(self, count: int) -> bool:
+        return np is not None and count >= self.VECTOR_MIN and len(self.keys) > 0
+    
+    def precompute_begin_state(self):
+        """Начальное состояние хранится так же, как остальные"""
+    
+    def move(self, state):
+        if self._delta and state in self._delta:
+            cached = self._merged.get(state)
+            if cached is None:
+                row = self._row(state)
+                cached = self._merged[state] = (list(row), list(markovify.chain.accumulate(row.values())))
+            choices, cumdist = cached
+            return choices[bisect.bisect(cumdist, random.random() * cumdist[-1])]
+        
+        keys = self.keys
+        key = state[0] << self.ID_BITS | state[1] if self.state_size == 2 else self._pack(state)
+        i = bisect.bisect_left(keys, key)
+        if i == len(keys) or keys[i] != key:
+            raise KeyError(state)
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        r = random.random() * self.cumulative[hi - 1]
+        return self.follows[bisect.bisect(self.cumulative, r, lo, hi)]
+    
+    def _numpy_vectors(self):
+        """Представления массивов для numpy и сквозные накопленные веса всех строк"""
+        if self._vectors is None:
+            keys = np.frombuffer(self.keys, dtype=np.uint64)
+            offsets = np.frombuffer(self.offsets, dtype=np.uint32).astype(np.int64)
+            follows = np.frombuffer(self.follows, dtype=np.uint32)
+            cumulative = np.frombuffer(self.cumulative, dtype=np.uint32).astype(np.float64)
+            weights = cumulative.copy()
+            weights[1:] -= cumulative[:-1]
+            weights[offsets[:-1]] = cumulative[offsets[:-1]]
+            through = np.cumsum(weights)
+            row_base = np.concatenate(([0.0], through))[offsets[:-1]]
+            totals = cumulative[offsets[1:] - 1]
+            self._vectors = (keys, follows, through, row_base, totals)
+        return self._vectors
+    
+    def walk_batch(self, count: int, init_state=None, max_length: Optional[int] = None) -> Iterable[List[int]]:
+        """Выполняет count блужданий одновременно на массивах numpy.
+        
+        Каждый шаг - два векторных двоичных поиска для всех незавершённых блужданий;
+        состояния с несохранёнными изменениями (_delta) обрабатываются по одному
+        """
+        if not self.can_vectorize(count):
+            yield from super().walk_batch(count, init_state, max_length)
+            return
+        
+        keys, follows, through, row_base, totals = self._numpy_vectors()
+        rng = np.random.default_rng(random.getrandbits(64))
+        shift = np.uint64(self.ID_BITS)
+        mask = np.uint64((1 << (self.ID_BITS * self.state_size)) - 1)
+        delta_keys = np.array(sorted(self._pack(state) for state in self._delta), dtype=np.uint64)
+        
+        current = np.full(count, self._pack(init_state or self.begin_state), dtype=np.uint64)
+        alive = np.arange(count)
+        dead = np.zeros(count, dtype=bool)
+        steps = []
+        while alive.size and (max_length is None or len(steps) <= max_length):
+            state_keys = current[alive]
+            rows = np.minimum(np.searchsorted(keys, state_keys), len(keys) - 1)
+            found = keys[rows] == state_keys
+            targets = row_base[rows] + rng.random(alive.size) * totals[rows]
+            next_ids = follows[np.minimum(np.searchsorted(through, targets, side="right"), len(follows) - 1)]
+            next_ids = next_ids.astype(np.int64)
+            
+            if delta_keys.size:
+                pending = np.isin(state_keys, delta_keys)
+                for j in np.flatnonzero(pending):
+                    next_ids[j] = self.move(self._unpack(int(state_keys[j])))
+                found |= pending
+            dead[alive[~found]] = True
+            
+            step = np.full(count, self.end, dtype=np.int64)
+            step[alive] = next_ids
+            steps.append(step)
+            current[alive] = ((state_keys << shift) | next_ids.astype(np.uint64)) & mask
+            alive = alive[found & (next_ids != self.end)]
+        
+        too_long = set(alive.tolist())
+        for i, walk in enumerate(np.stack(steps, axis=1).tolist() if steps else []):
+            if dead[i] or i in too_long:
+                continue
+            yield walk[:walk.index(self.end)]
+
+CHAIN_ENGINES = {"dict": IncrementalChain, "compact": CompactChain}
+
+def chain_engine(name: str) -> type:
+    """Класс цепи по имени из CHAIN_ENGINE"""
+    engine = CHAIN_ENGINES.get(name)
+    if engine is None:
+        raise ValueError(f"Неизвестный CHAIN_ENGINE {name!r}, допустимо: {', '.join(CHAIN_ENGINES)}")
+    return engine
+
+class NgramIndex:
+    """Позиционный индекс n-грамм корпуса для проверки оригинальности предложений.
+    
+    Хэш каждой n-граммы ссылается на её место в корпусе (номер сообщения,
+    предложения и слова), совпадения длиннее n проверяются сравнением с самим
+    корпусом. Новые позиции копятся в словаре _tail и периодически сливаются в
+    отсортированные массивы; позиции вытесненных сообщений отбрасываются при слиянии.
+    Предложения дальше 65535-го в сообщении и n-граммы дальше 65535-го слова в
+    предложении не помещаются в поля позиции и в индекс не попадают
+    """
+    
+    RUN_BITS = 16
+    OFFSET_BITS = 16
+    MERGE_MIN = 4096  # Минимум новых позиций перед слиянием с массивами
+    
+    def __init__(self, n: int):
+        self.n = n
+        self.stale = 0  # Позиции вытесненных сообщений, ещё лежащие в массивах
+        self._hashes = array('q')
+        self._positions = array('q')
+        self._tail: Dict[int, List[int]] = {}
+        self._tail_size = 0
+    
+    def __len__(self) -> int:
+        return len(self._hashes) + self._tail_size
+    
+    def ngram_count(self, runs: Iterable[array]) -> int:
+        return sum(max(0, len(run) - self.n + 1) for run in runs)
+    
+    def add(self, ordinal: int, runs: List[array]):
+        """Добавляет n-граммы сообщения с порядковым номером ordinal"""
+        n = self.n
+        for run_index, run in enumerate(runs[:1 << self.RUN_BITS]):
+            base = (ordinal << self.RUN_BITS | run_index) << self.OFFSET_BITS
+            for offset in range(min(len(run) - n + 1, 1 << self.OFFSET_BITS)):
+                key = hash(tuple(run[offset:offset + n]))
+                positions = self._tail.get(key)
+                if positions is None:
+                    positions = self._tail[key] = []
+                positions.append(base | offset)
+                self._tail_size += 1
+    
+    def find(self, key: int) -> Iterable[Tuple[int, int, int]]:
+        """Места n-грамм с хэшем key: (номер сообщения, номер предложения, смещение)"""
+        lo = bisect.bisect_left(self._hashes, key)
+        hi = bisect.bisect_right(self._hashes, key, lo)
+        run_mask = (1 << self.RUN_BITS) - 1
+        offset_mask = (1 << self.OFFSET_BITS) - 1
+        for position in itertools.chain(self._positions[lo:hi], self._tail.get(key, ())):
+            yield (position >> (self.RUN_BITS + self.OFFSET_BITS),
+                   position >> self.OFFSET_BITS & run_mask,
+                   position & offset_mask)
+    
+    def merge(self, first_ordinal: int):
+        """Сливает новые позиции с массивами, отбрасывая вытесненные сообщения"""
+        min_position = first_ordinal << (self.RUN_BITS + self.OFFSET_BITS)
+        hashes = [key for key, position in zip(self._hashes, self._positions) if position >= min_position]
+        positions = [position for position in self._positions if position >= min_position]
+        for key, tail_positions in self._tail.items():
+            hashes.extend([key] * len(tail_positions))
+            positions.extend(tail_positions)
+        
+        if np is not None:
+            keys = np.array(hashes, dtype=np.int64)
+            order = np.argsort(keys, kind="stable")
+            self._hashes = array('q', keys[order].tobytes())
+            self._positions = array('q', np.array(positions, dtype=np.int64)[order].tobytes())
+        else:
+            order = sorted(range(len(hashes)), key=hashes.__getitem__)
+            self._hashes = array('q', [hashes[i] for i in order])
+            self._positions = array('q', [positions[i] for i in order])
+        self._tail = {}
+        self._tail_size = 0
+        self.stale = 0
+    
+    def merge_if_needed(self, first_ordinal: int):
+        if (self._tail_size > max(self.MERGE_MIN, len(self._hashes) // 4)
+                or self.stale * 2 > len(self._hashes)):
+            self.merge(first_ordinal)
+    
+    def memory_estimate(self) -> int:
+        return len(self._hashes) * 16 + self._tail_size * 100
+
+class IncrementalText(markovify.NewlineText):
+    """Модель текста, которая дообучается на новых сообщениях и забывает вытесненные"""
+    
+    accept_rate = 0.25  # Доля блужданий, прошедших фильтры (уточняется при генерации)
+    _originality: Optional["NgramIndex"] = None
+    _length_changes = 0  # Слов добавлено и удалено с последнего расчёта расстояний до конца
+    LENGTH_REFRESH_MIN = 2000
+    LENGTH_INPLACE_MAX = 10000  # До стольких слов расстояния пересчитываются на месте (~0.1 с), без сборки в пуле
+    
+    def __init__(self, state_size: int = 2, engine: Optional[str] = None):
+        self.state_size = state_size
+        self.well_formed = True
+        self.retain_original = True
+        self.chain = chain_engine(engine or config.CHAIN_ENGINE)(state_size)
+        self.trained_upto: int = 0  # Сколько сообщений чата (по счётчику) уже учтено
+        self.word_count: int = 0
+        # Предложения хранятся как массивы идентификаторов слов из vocabulary
+        self._message_runs: Deque[List[array]] = deque()
+        # Инвертированный индекс: идентификатор токена -> возрастающие порядковые
+        # номера сообщений. Номер сообщения _message_runs[i] равен _first_ordinal + i
+        self._word_index: Dict[int, array] = {}
+        self._first_ordinal: int = 0
+        self._extra_runs: List[array] = []
+        # Индекс для проверки оригинальности, строится лениво при первой генерации
+        self._originality: Optional[NgramIndex] = None
+    
+    def __getstate__(self):
+        # Идентификаторы слов действуют только в своём процессе, поэтому модель
+        # сохраняется с собственной таблицей слов и перекодируется при загрузке.
+        # Индекс оригинальности не сохраняем: он восстанавливается из предложений
+        local_ids: Dict[int, int] = {}
+        words: List[str] = []
+        
+        def to_local(token_id: int) -> int:
+            local_id = local_ids.get(token_id)
+            if local_id is None:
+                local_id = local_ids[token_id] = len(words)
+                words.append(vocabulary.decode(token_id))
+            return local_id
+        
+        state = self.__dict__.copy()
+        state["_originality"] = None
+        state["_vocabulary"] = words
+        state["chain"] = self.chain.remapped(to_local)
+        state["_message_runs"] = deque([array('I', map(to_local, run)) for run in runs]
+                                       for runs in self._message_runs)
+        state["_extra_runs"] = [array('I', map(to_local, run)) for run in self._extra_runs]
+        state["_word_index"] = {to_local(token_id): positions
+                                for token_id, positions in self._word_index.items()}
+        return state
+    
+    def __setstate__(self, state):
+        to_global = [vocabulary.encode(word) for word in state.pop("_vocabulary")].__getitem__
+        self.__dict__.update(state)
+        self.chain = self.chain.remapped(to_global)
+        self._message_runs = deque([array('I', map(to_global, run)) for run in runs]
+                                   for runs in self._message_runs)
+        self._extra_runs = [array('I', map(to_global, run)) for run in self._extra_runs]
+        self._word_index = {to_global(token_id): positions
+                            for token_id, positions in self._word_index.items()}
+    
+    def originality_index(self) -> NgramIndex:
+        """Индекс n-грамм корпуса, строится при первом обращении"""
+        index = self._originality
+        if index is None:
+            # Строится в основном процессе: хэши зависят от идентификаторов общего словаря
+            started = time.perf_counter()
+            index = self._originality = NgramIndex(self.state_size + 2)
+            for i, runs in enumerate(self._message_runs):
+                index.add(self._first_ordinal + i, runs)
+            index.merge(self._first_ordinal)
+            elapsed = time.perf_counter() - started
+            log = logger.warning if elapsed * 1000 >= config.SLOW_HANDLER_MS else logger.debug
+            log(f"Индекс оригинальности построен за {elapsed:.2f} с: {len(index)} n-грамм, "
+                f"{len(self._message_runs)} сообщений")
+        return index
+    
+    def _occurs(self, gram: List[int], index: NgramIndex) -> bool:
+        """Встречается ли последовательность слов в корпусе подряд"""
+        size = len(gram)
+        for ordinal, run_index, offset in index.find(hash(tuple(gram[:index.n]))):
+            i = ordinal - self._first_ordinal
+            if i < 0:
+                continue
+            if self._message_runs[i][run_index][offset:offset + size].tolist() == gram:
+                return True
+        return any(run[offset:offset + size].tolist() == gram
+                   for run in self._extra_runs for offset in range(len(run) - size + 1))
+    
+    def is_original(self, token_ids: List[int], max_overlap_ratio: float, max_overlap_total: int) -> bool:
+        """Проверка оригинальности как в markovify, но по индексу n-грамм вместо текста корпуса.
+        
+        Предложение отвергается, если содержит кусок корпуса длиной больше
+        min(max_overlap_total, max_overlap_ratio * длина) слов
+        """
+        overlap_max = min(max_overlap_total, round(max_overlap_ratio * len(token_ids)))
+        size = min(overlap_max + 1, len(token_ids))
+        # Куски не длиннее state_size + 1 слов - это переходы цепи, они всегда из корпуса
+        if size <= self.state_size + 1:
+            return False
+        index = self.originality_index()
+        return not any(self._occurs(token_ids[start:start + size], index)
+                       for start in range(max(len(token_ids) - overlap_max, 1)))
+    
+    def test_sentence_output(self, words, max_overlap_ratio, max_overlap_total):
+        token_ids = [vocabulary.lookup(word) for word in words]
+        return self.is_original([-1 if token_id is None else token_id for token_id in token_ids],
+                                max_overlap_ratio, max_overlap_total)
+    
+    @property
+    def message_count(self) -> int:
+        return len(self._message_runs)
+    
+    def is_empty(self) -> bool:
+        return not len(self.chain)
+    
+    def memory_estimate(self) -> int:
+        """Приблизительный объём модели в памяти в байтах"""
+        index = self._originality
+        return (self.chain.memory_estimate()
+                + (index.memory_estimate() if index is not None else 0)
+                + len(self._message_runs) * 150
+                + self.word_count * 12
+                + len(self._word_index) * 100)
+    
+    @staticmethod
+    def _message_tokens(runs: List[array]) -> set:
+        return {vocabulary.encode(token)
+                for run in runs for word in vocabulary.decode_run(run) for token in tokenize(word)}
+    
+    def _index_message(self, ordinal: int, runs: List[array]):
+        for token_id in self._message_tokens(runs):
+            positions = self._word_index.get(token_id)
+            if positions is None:
+                positions = self._word_index[token_id] = array('q')
+            positions.append(ordinal)
+    
+    def _unindex_message(self, runs: List[array]):
+        # Номера вытесненных сообщений лежат в начале массивов; сжимаем массив,
+        # когда устаревшие номера занимают больше половины
+        for token_id in self._message_tokens(runs):
+            positions = self._word_index.get(token_id)
+            if positions is None:
+                continue
+            stale = bisect.bisect_left(positions, self._first_ordinal)
+            if stale == len(positions):
+                del self._word_index[token_id]
+            elif stale * 2 > len(positions):
+                del positions[:stale]
+    
+    def find_messages(self, token: str) -> List[int]:
+        """Индексы в окне сообщений, содержащих токен"""
+        token_id = vocabulary.lookup(token)
+        positions = self._word_index.get(token_id) if token_id is not None else None
+        if not positions:
+            return []
+        start = bisect.bisect_left(positions, self._first_ordinal)
+        return [ordinal - self._first_ordinal for ordinal in positions[start:]]
+    
+    def make_sentence(self, init_state=None, **kwargs) -> Optional[str]:
+        """Генерирует предложение; слова декодируются из идентификаторов только здесь"""
+        tries = kwargs.get("tries", markovify.text.DEFAULT_TRIES)
+        mor = kwargs.get("max_overlap_ratio", markovify.text.DEFAULT_MAX_OVERLAP_RATIO)
+        mot = kwargs.get("max_overlap_total", markovify.text.DEFAULT_MAX_OVERLAP_TOTAL)
+        test_output = kwargs.get("test_output", True)
+        max_words = kwargs.get("max_words")
+        min_words = kwargs.get("min_words")
+        
+        prefix = [token_id for token_id in init_state or () if token_id != BEGIN_ID]
+        for _ in range(tries):
+            token_ids = prefix + self.chain.walk(init_state)
+            if (max_words is not None and len(token_ids) > max_words) or (
+                    min_words is not None and len(token_ids) < min_words):
+                continue
+            if not test_output or self.is_original(token_ids, mor, mot):
+                return self.word_join(vocabulary.decode_run(token_ids))
+        return None
+    
+    def compute_end_distances(self):
+        """Считает для состояний цепи минимальную длину до конца предложения"""
+        self.chain.set_end_distances(self.chain.shortest_endings(vocabulary.length))
+        self._length_changes = 0
+    
+    def end_distances_stale(self) -> bool:
+        """Цепь заметно изменилась с последнего расчёта расстояний до конца"""
+        return self._length_changes > max(self.LENGTH_REFRESH_MIN, self.word_count // 2)
+    
+    def refresh_end_distances(self) -> bool:
+        """Пересчитывает расстояния на месте, если модель небольшая; иначе нужна сборка в пуле"""
+        if self.word_count > self.LENGTH_INPLACE_MAX:
+            return False
+        self.compute_end_distances()
+        return True
+    
+    def _walks_within(self, count: int, init_state, prefix_chars: int, min_chars: int,
+                      max_chars: Optional[int], max_length: Optional[int] = None) -> Iterable[List[int]]:
+        """Лениво выдаёт блуждания, которые укладываются в диапазон длины.
+        
+        Слово подходит, только если после него до конца предложения можно дойти,
+        не превысив max_chars, и в блуждании остаётся меньше max_length слов;
+        конец предложения подходит, когда набрано min_chars.
+        Сначала берётся обычный шаг цепи, а если он не подходит - выбор среди
+        подходящих переходов с теми же весами. Блуждания без подходящих
+        переходов пропускаются
+        """
+        if not self.chain.has_end_distances():
+            self.compute_end_distances()
+        chain = self.chain
+        limit = max_chars if max_chars is not None else math.inf
+        words_limit = max_length if max_length is not None else math.inf
+        
+        def fits(state, chars: int, words: int, follow: int) -> bool:
+            if follow == chain.end:
+                return chars >= min_chars
+            if words >= words_limit:
+                return False
+            chars += vocabulary.length(follow) + (1 if chars else 0)
+            return chars + chain.end_distance(tuple(state[1:]) + (follow,)) <= limit
+        
+        for _ in range(count):
+            state = init_state or chain.begin_state
+            chars = prefix_chars
+            walk = []
+            while True:
+                follow = chain.move(state)
+                if not fits(state, chars, len(walk), follow):
+                    allowed = [(choice, weight) for choice, weight in chain.row(state)
+                               if fits(state, chars, len(walk), choice)]
+                    if not allowed:
+                        break
+                    choices, weights = zip(*allowed)
+                    follow = random.choices(choices, weights)[0]
+                if follow == chain.end:
+                    yield walk
+                    break
+                chars += vocabulary.length(follow) + (1 if chars else 0)
+                walk.append(follow)
+                state = tuple(state[1:]) + (follow,)
+    
+    def make_short_sentence(self, max_chars: int, min_chars: int = 0, **kwargs) -> Optional[str]:
+        sentences = self.make_sentences(1, max_chars=max_chars, min_chars=min_chars, **kwargs)
+        return sentences[0] if sentences else None
+    
+    def make_sentences(self, count: int, init_state=None, **kwargs) -> List[str]:
+        """Генерирует до count предложений пакетами блужданий по цепи.
+        
+        Параметры как у make_sentence; tries - общий лимит блужданий на все
+        предложения, min_chars/max_chars ограничивают длину в символах
+        """
+        tries = kwargs.get("tries", markovify.text.DEFAULT_TRIES)
+        mor = kwargs.get("max_overlap_ratio", markovify.text.DEFAULT_MAX_OVERLAP_RATIO)
+        mot = kwargs.get("max_overlap_total", markovify.text.DEFAULT_MAX_OVERLAP_TOTAL)
+        test_output = kwargs.get("test_output", True)
+        max_words = kwargs.get("max_words")
+        min_words = kwargs.get("min_words")
+        min_chars = kwargs.get("min_chars", 0)
+        max_chars = kwargs.get("max_chars")
+        
+        prefix = [token_id for token_id in init_state or () if token_id != BEGIN_ID]
+        # Слово занимает хотя бы символ и пробел, поэтому max_chars ограничивает и число слов
+        limits = [limit for limit in (max_words, (max_chars + 1) // 2 if max_chars is not None else None)
+                  if limit is not None]
+        max_length = min(limits) - len(prefix) if limits else None
+        if max_length is not None and max_length < 0:
+            return []
+        
+        # Пакеты для numpy идут без учёта длины, остальные блуждания учитывают её на ходу
+        length_aware = bool(min_chars) or max_chars is not None
+        prefix_chars = len(self.word_join(vocabulary.decode_run(prefix)))
+        
+        sentences: List[str] = []
+        while tries > 0 and len(sentences) < count:
+            # Размер пакета - сколько блужданий понадобится при наблюдаемой доле удачных
+            missing = count - len(sentences)
+            batch = min(tries, config.GENERATION_BATCH * missing, math.ceil(missing * 1.25 / self.accept_rate))
+            tries -= batch
+            walked = accepted = 0
+            if length_aware and not self.chain.can_vectorize(batch):
+                walks = self._walks_within(batch, init_state, prefix_chars, min_chars, max_chars, max_length)
+            else:
+                walks = self.chain.walk_batch(batch, init_state, max_length)
+            for walk in walks:
+                walked += 1
+                token_ids = prefix + walk
+                if min_words is not None and len(token_ids) < min_words:
+                    continue
+                words = vocabulary.decode_run(token_ids)
+                sentence = self.word_join(words)
+                if len(sentence) < min_chars or (max_chars is not None and len(sentence) > max_chars):
+                    continue
+                if test_output and not self.is_original(token_ids, mor, mot):
+                    continue
+                sentences.append(sentence)
+                accepted += 1
+                if len(sentences) == count:
+                    break
+            if walked:
+                rate = 0.8 * self.accept_rate + 0.2 * accepted / walked
+                self.accept_rate = max(rate, 1 / config.GENERATION_BATCH)
+        return sentences
+    
+    def make_sentence_with_context(self, tokens: List[str], seeds: int = 10, **kwargs) -> Optional[str]:
+        """Генерирует предложение, стартуя цепь из состояний со словами контекста"""
+        candidates = [(token, index) for token in tokens for index in self.find_messages(token)]
+        random.shuffle(candidates)
+        
+        for token, index in candidates[:seeds]:
+            run_positions = [(run, i) for run in self._message_runs[index]
+                             for i, word in enumerate(vocabulary.decode_run(run))
+                             if token in tokenize(word)]
+            if not run_positions:
+                continue
+            run, i = random.choice(run_positions)
+            init_state = tuple(([BEGIN_ID] * self.state_size + run[:i + 1].tolist())[-self.state_size:])
+            if init_state not in self.chain:
+                continue
+            sentence = self.make_sentence(init_state=init_state, **kwargs)
+            if sentence:
+                return sentence
+        return None
+    
+    def parse_message(self, message: str) -> List[List[int]]:
+        """Разбивает сообщение на предложения-последовательности идентификаторов слов"""
+        return [vocabulary.encode_run(self.word_split(sentence))
+                for sentence in self.sentence_split(message)
+                if self.test_sentence_input(sentence)]
+    
+    def append_messages(self, messages: Iterable[str]) -> int:
+        """Добавляет новые сообщения в цепь"""
+        added = 0
+        for message in messages:
+            runs = []
+            for run in self.parse_message(message):
+                self.chain.add_run(run)
+                self.word_count += len(run)
+                self._length_changes += len(run)
+                runs.append(array('I', run))
+            ordinal = self._first_ordinal + len(self._message_runs)
+            self._index_message(ordinal, runs)
+            if self._originality is not None:
+                self._originality.add(ordinal, runs)
+            self._message_runs.append(runs)
+            added += 1
+        if added:
+            self._maintain()
+        return added
+    
+    def _evict_oldest(self):
+        runs = self._message_runs.popleft()
+        self._first_ordinal += 1
+        for run in runs:
+            self.chain.remove_run(run)
+            self.word_count -= len(run)
+            self._length_changes += len(run)
+        self._unindex_message(runs)
+        if self._originality is not None:
+            self._originality.stale += self._originality.ngram_count(runs)
+    
+    def _maintain(self):
+        """Сливает накопленные изменения цепи и индекса, когда их стало много"""
+        self.chain.compact_if_needed()
+        if self._originality is not None:
+            self._originality.merge_if_needed(self._first_ordinal)
+    
+    def trim(self, max_messages: int) -> int:
+        """Вытесняет самые старые сообщения сверх окна max_messages"""
+        evicted = 0
+        while len(self._message_runs) > max_messages:
+            self._evict_oldest()
+            evicted += 1
+        self._maintain()
+        return evicted
+    
+    def evict_through(self, seq: int) -> int:
+        """Вытесняет сообщения чата с порядковыми номерами до seq включительно"""
+        evicted = 0
+        while self._message_runs and self.trained_upto - len(self._message_runs) + 1 <= seq:
+            self._evict_oldest()
+            evicted += 1
+        self._maintain()
+        return evicted
+    
+    def set_extra_runs(self, phrases: List[str]):
+        """Заменяет дополнительные фразы (революционный режим) в цепи"""
+        if not phrases and not self._extra_runs:
+            return
+        for run in self._extra_runs:
+            self.chain.remove_run(run)
+        self._extra_runs = []
+        for phrase in phrases:
+            for run in self.parse_message(phrase):
+                self.chain.add_run(run)
+                self._extra_runs.append(array('I', run))
+        self.chain.compact_if_needed()
+
+def build_model(messages: List[str], trained_upto: int) -> IncrementalText:
+    """Собирает модель с нуля (выполняется в процессе пула обучения)"""
+    model = IncrementalText(state_size=2)
+    model.append_messages(messages)
+    model.compute_end_distances()
+    model.trained_upto = trained_upto
+    return model
+
+class ModelCache:
+    """LRU-кэш моделей чатов с ограничением по памяти"""
+    
+    def __init__(self, budget_bytes: int, on_evict: Optional[Callable[[int, IncrementalText], None]] = None):
+        self.budget_bytes = budget_bytes
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._models: "OrderedDict[int, IncrementalText]" = OrderedDict()
+        # Размер каждой модели запоминается при добавлении и дообучении, а не считается заново
+        self._sizes: Dict[int, int] = {}
+        self._resident = 0
+    
+    def __len__(self) -> int:
+        return len(self._models)
+    
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self._models
+    
+    def peek(self, chat_id: int) -> Optional[IncrementalText]:
+        """Модель без учёта в статистике и без изменения порядка"""
+        return self._models.get(chat_id)
+    
+    def get(self, chat_id: int) -> Optional[IncrementalText]:
+        """Модель с учётом попадания и пометкой как недавно использованной"""
+        model = self._models.get(chat_id)
+        if model is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._models.move_to_end(chat_id)
+        return model
+    
+    def put(self, chat_id: int, model: IncrementalText):
+        self._models[chat_id] = model
+        self._models.move_to_end(chat_id)
+        self._set_size(chat_id, model.memory_estimate())
+        self.shrink()
+    
+    def resize(self, chat_id: int):
+        """Пересчитывает размер изменившейся модели и при необходимости вытесняет лишние"""
+        model = self._models.get(chat_id)
+        if model is not None:
+            self._set_size(chat_id, model.memory_estimate())
+            self.shrink()
+    
+    def _set_size(self, chat_id: int, size: int):
+        self._resident += size - self._sizes.get(chat_id, 0)
+        self._sizes[chat_id] = size
+    
+    def discard(self, chat_id: int):
+        if self._models.pop(chat_id, None) is not None:
+            self._resident -= self._sizes.pop(chat_id)
+    
+    def chat_ids(self) -> List[int]:
+        return list(self._models.keys())
+    
+    def clear(self):
+        self._models.clear()
+        self._sizes.clear()
+        self._resident = 0
+    
+    def resident_bytes(self) -> int:
+        return self._resident
+    
+    def word_count(self) -> int:
+        """Сколько слов хранят модели в памяти"""
+        return sum(model.word_count for model in self._models.values())
+    
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+    
+    def shrink(self):
+        """Вытесняет давно не использованные модели, пока не уложимся в бюджет"""
+        while self._resident > self.budget_bytes and len(self._models) > 1:
+            chat_id, model = self._models.popitem(last=False)
+            self._resident -= self._sizes.pop(chat_id)
+            self.evictions += 1
+            metrics.inc("lssr_model_cache_evictions_total")
+            if self.on_evict:
+                self.on_evict(chat_id, model)
+
 # ==================== МОДЕЛИ ДАННЫХ ====================
+class MessageStore:
+    """Кольцевой буфер сообщений чата фиксированной ёмкости.
+    
+    Каждое сообщение получает порядковый номер (1, 2, ...), общий счётчик хранится
+    в total. При переполнении самое старое сообщение вытесняется, а подписчики
+    (производные структуры вроде цепи или индекса) получают уведомление.
+    """
+    
+    def __init__(self, capacity: int, messages: Iterable[str] = (), total: int = 0):
+        self.capacity = max(1, capacity)
+        self.total = 0
+        self._items: List[str] = []
+        self._head = 0  # Индекс самого старого сообщения, когда буфер заполнен
+        self._listeners: List[Callable[[int, str], None]] = []
+        for text in messages:
+            self.append(text)
+        self.total = max(total, self.total)
+    
+    def __len__(self) -> int:
+        return len(self._items)
+    
+    def __iter__(self):
+        items, head = self._items, self._head
+        for i in range(len(items)):
+            yield items[(head + i) % len(items)]
+    
+    def __getitem__(self, index):
+        size = len(self._items)
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(size))]
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("индекс сообщения вне буфера")
+        return self._items[(self._head + index) % size]
+    
+    @property
+    def first_seq(self) -> int:
+        """Порядковый номер самого старого сообщения в буфере"""
+        return self.total - len(self._items) + 1
+    
+    def subscribe(self, listener: Callable[[int, str], None]):
+        """Подписывает обработчик вытеснения: listener(seq, text)"""
+        self._listeners.append(listener)
+    
+    def append(self, text: str):
+        self.total += 1
+        if len(self._items) < self.capacity:
+            self._items.append(text)
+            return
+        evicted_seq = self.total - self.capacity
+        evicted = self._items[self._head]
+        self._items[self._head] = text
+        self._head = (self._head + 1) % self.capacity
+        for listener in self._listeners:
+            listener(evicted_seq, evicted)
+    
+    def tail(self, count: int) -> List[str]:
+        """Последние count сообщений (копируются только они)"""
+        return self[-count:] if count > 0 else []
+    
+    def clear(self):
+        """Удаляет все сообщения, счётчик total продолжает расти"""
+        self._items = []
+        self._head = 0
+
 class ChatData:
     """Данные чата"""
     
     def __init__(self, chat_id: int):
         self.chat_id = chat_id
-        self.messages: List[str] = []
+        self.messages = MessageStore(config.MAX_MODEL_SIZE)
         self.attachments: List[Dict] = []
         self.off_until: int = 0
+        self.unreachable_since: int = 0  # Когда Telegram ответил, что писать в чат нельзя
         self.mood: str = "neutral"
         self.last_activity: int = int(time.time())
         self.message_count: int = 0
-        self.model: Optional[markovify.Text] = None
+        self.dirty: bool = False  # Есть несохранённые изменения
+        self.saved_total: int = 0  # Значение messages_total при последнем сохранении в SQLite
+        self.saved_settings: Dict = {}  # Настройки на момент последнего сохранения в SQLite
         self.model_version: int = 0
+        self.saved_model_version: Optional[int] = None  # Версия модели, сохранённой на диск
         self.custom_responses: List[str] = []
         self.revolutionary_phrases_used: List[str] = []
+        self.sentence_pool: Deque[str] = deque()  # Готовые предложения для ответов
+        self.pool_version: int = 0  # Версия модели, из которой сгенерирован пул
+        self.reply_times: Deque[float] = deque(maxlen=config.SENTENCE_POOL_MAX)
         self.settings: Dict = {
             "response_chance": config.DEFAULT_CHANCE,
             "allow_replies": True,
@@ -166,19 +1448,46 @@ class ChatData:
             "learning_enabled": True,
             "max_messages": config.MAX_MODEL_SIZE,
             "revolutionary_mode": False,
-            "revolutionary_intensity": 3  # 1-5: интенсивность революционных фраз
+            "revolutionary_intensity": 3,  # 1-5: интенсивность революционных фраз
+            "trigger_words": []  # Собственные слова-триггеры чата
         }
+        self.messages.subscribe(self._on_message_evicted)
+    
+    @property
+    def messages_total(self) -> int:
+        """Сколько сообщений когда-либо добавлено (монотонный счётчик)"""
+        return self.messages.total
+    
+    def _on_message_evicted(self, seq: int, text: str):
+        """Убирает вытесненное из буфера сообщение из модели, если оно в неё попало"""
+        model = self.model
+        if model is not None:
+            model.evict_through(seq)
+    
+    @property
+    def model(self) -> Optional[IncrementalText]:
+        """Модель чата, если она сейчас в памяти"""
+        return model_cache.peek(self.chat_id)
+    
+    @model.setter
+    def model(self, value: Optional[IncrementalText]):
+        if value is None:
+            model_cache.discard(self.chat_id)
+        else:
+            model_cache.put(self.chat_id, value)
     
     def to_dict(self) -> Dict:
         """Конвертирует в словарь для сохранения"""
         return {
             "chat_id": self.chat_id,
-            "messages": self.messages[-self.settings["max_messages"]:],
+            "messages": list(self.messages),
             "attachments": self.attachments,
             "off_until": self.off_until,
+            "unreachable_since": self.unreachable_since,
             "mood": self.mood,
             "last_activity": self.last_activity,
             "message_count": self.message_count,
+            "messages_total": self.messages_total,
             "model_version": self.model_version,
             "custom_responses": self.custom_responses,
             "revolutionary_phrases_used": self.revolutionary_phrases_used[-100:],  # Сохраняем последние 100
@@ -189,9 +1498,9 @@ class ChatData:
     def from_dict(cls, data: Dict) -> 'ChatData':
         """Создает из словаря"""
         chat = cls(data["chat_id"])
-        chat.messages = data.get("messages", [])
         chat.attachments = data.get("attachments", [])
         chat.off_until = data.get("off_until", 0)
+        chat.unreachable_since = data.get("unreachable_since", 0)
         chat.mood = data.get("mood", "neutral")
         chat.last_activity = data.get("last_activity", int(time.time()))
         chat.message_count = data.get("message_count", 0)
@@ -207,34 +1516,79 @@ class ChatData:
             "learning_enabled": loaded_settings.get("learning_enabled", True),
             "max_messages": loaded_settings.get("max_messages", config.MAX_MODEL_SIZE),
             "revolutionary_mode": loaded_settings.get("revolutionary_mode", False),
-            "revolutionary_intensity": loaded_settings.get("revolutionary_intensity", 3)
+            "revolutionary_intensity": loaded_settings.get("revolutionary_intensity", 3),
+            "trigger_words": loaded_settings.get("trigger_words", [])
         }
         
+        chat.messages = MessageStore(
+            chat.settings["max_messages"],
+            data.get("messages", []),
+            total=data.get("messages_total", 0)
+        )
+        chat.messages.subscribe(chat._on_message_evicted)
+        
         if chat.message_count == 0:
             chat.message_count = len(chat.messages)
             
         return chat
     
+    def pending_messages(self) -> List[Tuple[int, str]]:
+        """Сообщения окна, ещё не записанные в SQLite, с их порядковыми номерами"""
+        first_seq = self.messages.first_seq
+        start = max(self.saved_total + 1, first_seq)
+        return [(seq, self.messages[seq - first_seq]) for seq in range(start, self.messages_total + 1)]
+    
+    def add_message(self, text: str):
+        """Добавляет сообщение в корпус чата"""
+        self.messages.append(text)
+        self.dirty = True
+    
+    def can_train(self) -> bool:
+        """Достаточно ли данных и разрешено ли обучение"""
+        return self.settings["learning_enabled"] and len(self.messages) >= config.MIN_MESSAGES_FOR_TRAINING
+    
+    def training_snapshot(self) -> Tuple[List[str], int]:
+        """Окно сообщений и значение счётчика для сборки модели с нуля"""
+        return list(self.messages), self.messages_total
+    
+    def window_size(self) -> int:
+        """Сколько последних сообщений входит в окно обучения"""
+        return len(self.messages)
+    
+    def corpus_fingerprint(self) -> int:
+        """Отпечаток окна сообщений за O(1), стабильный между перезапусками.
+        
+        Сообщения только добавляются в конец и вытесняются с начала, поэтому окно
+        однозначно задаётся монотонным счётчиком messages_total и своим размером.
+        """
+        window = self.window_size()
+        if not window:
+            return 0
+        return zlib.crc32(f"{self.messages_total}:{window}".encode("ascii"))
+    
     def update_model(self, force: bool = False) -> bool:
-        """Обновляет модель цепи Маркова"""
-        if not self.settings["learning_enabled"]:
+        """Дообучает модель цепи Маркова на новых сообщениях"""
+        if not self.can_train():
             return False
             
-        if len(self.messages) < config.MIN_MESSAGES_FOR_TRAINING:
+        model = self.model
+        if model is None:
+            # Модели нет в памяти - её загрузит или соберёт ensure_model
             return False
-            
-        messages_to_use = self.messages[-self.settings["max_messages"]:]
         
-        if messages_to_use:
-            current_hash = hash(''.join(messages_to_use)) % (10**8)
-        else:
-            current_hash = 0
-        
-        if not force and self.model and current_hash == self.model_version:
+        # Модель отстаёт, только если после её обучения пришли сообщения: отпечаток
+        # меняется с каждым сообщением, а догнать модель можно с любого места окна
+        if not force and model.trained_upto >= self.messages_total:
             return False
+        current_hash = self.corpus_fingerprint()
         
+        started = time.perf_counter()
         try:
-            text = "\n".join([msg for msg in messages_to_use])
+            # Учитываем только сообщения, добавленные после прошлого обучения
+            new_count = min(self.messages_total - model.trained_upto, self.window_size())
+            added = model.append_messages(self.messages.tail(new_count)) if new_count > 0 else 0
+            model.trained_upto = self.messages_total
+            evicted = model.trim(self.settings["max_messages"])
             
             if self.settings["revolutionary_mode"]:
                 revolutionary_texts = config.REVOLUTIONARY_TEXTS
@@ -252,24 +1606,45 @@ class ChatData:
                         random.sample(self.revolutionary_phrases_used[-50:], min(5, len(self.revolutionary_phrases_used)))
                     )
                 
-                text += "\n" + "\n".join(phrases_to_add)
-            
-            if text.strip():
-                self.model = markovify.NewlineText(text, state_size=2)
-                self.model_version = current_hash
-                logger.info(f"Модель обновлена для чата {self.chat_id}, сообщений: {len(messages_to_use)}")
-                return True
+                model.set_extra_runs(phrases_to_add)
             else:
+                model.set_extra_runs([])
+            
+            # Модель выросла - кэш должен снова уложиться в бюджет памяти
+            model_cache.resize(self.chat_id)
+            
+            if model.is_empty():
                 return False
+            
+            self.model_version = current_hash
+            metrics.observe("lssr_update_model_seconds", time.perf_counter() - started)
+            logger.info(
+                f"Модель обновлена для чата {self.chat_id}, сообщений: {model.message_count} "
+                f"(+{added}/-{evicted})"
+            )
+            return True
         except Exception as e:
             logger.error(f"Ошибка создания модели для чата {self.chat_id}: {e}")
             return False
     
     def can_generate(self) -> bool:
-        """Может ли бот генерировать сообщения"""
+        """Может ли бот генерировать сообщения (модель подгружается при необходимости)"""
         if self.off_until and time.time() < self.off_until:
             return False
-        return len(self.messages) >= config.MIN_MESSAGES_FOR_TRAINING and self.model is not None
+        return len(self.messages) >= config.MIN_MESSAGES_FOR_TRAINING
+    
+    def pool_target(self) -> int:
+        """Желаемый размер пула: растёт с количеством ответов за последний час"""
+        hour_ago = time.time() - 3600
+        recent_replies = sum(1 for t in self.reply_times if t > hour_ago)
+        return min(config.SENTENCE_POOL_MAX, config.SENTENCE_POOL_MIN + recent_replies)
+    
+    def take_pooled_sentence(self) -> Optional[str]:
+        """Достаёт готовое предложение, если пул соответствует текущей модели"""
+        if self.pool_version != self.model_version:
+            self.sentence_pool.clear()
+            return None
+        return self.sentence_pool.popleft() if self.sentence_pool else None
     
     def get_response_chance(self) -> float:
         """Возвращает текущий шанс ответа"""
@@ -282,14 +1657,610 @@ class ChatData:
         
         return base_chance * mood_multiplier
 
+# ==================== МЕТРИКИ ====================
+# Границы гистограмм задержек в секундах
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Metrics:
+    """Счётчики и гистограммы процесса в текстовом формате Prometheus"""
+    
+    def __init__(self, chat_labels: int):
+        self.chat_labels = chat_labels
+        self._kinds: Dict[str, Tuple[str, str]] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+        self._series: Dict[str, Dict[Tuple, object]] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self._chats: set = set()
+    
+    def counter(self, name: str, help_text: str):
+        self._kinds[name] = ("counter", help_text)
+        self._series[name] = {}
+    
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self._kinds[name] = ("histogram", help_text)
+        self._buckets[name] = tuple(buckets)
+        self._series[name] = {}
+    
+    def gauge(self, name: str, help_text: str, collect: Callable[[], float]):
+        """Значение снимается в момент запроса метрик"""
+        self._kinds[name] = ("gauge", help_text)
+        self._gauges[name] = collect
+    
+    def chat_label(self, chat_id: int) -> str:
+        """Метка чата: первые chat_labels чатов получают свою, остальные - общую other"""
+        if chat_id in self._chats:
+            return str(chat_id)
+        if len(self._chats) < self.chat_labels:
+            self._chats.add(chat_id)
+            return str(chat_id)
+        return "other"
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self._series[name]
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+    
+    def observe(self, name: str, value: float, **labels):
+        series = self._series[name]
+        key = tuple(sorted(labels.items()))
+        state = series.get(key)
+        if state is None:
+            # Наблюдения по корзинам (последняя - +Inf), сумма и количество
+            state = series[key] = [[0] * (len(self._buckets[name]) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self._buckets[name], value)] += 1
+        state[1] += value
+        state[2] += 1
+    
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Замеряет время блока, в том числе завершившегося исключением"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+    
+    @staticmethod
+    def _format_labels(pairs) -> str:
+        if not pairs:
+            return ""
+        escaped = (
+            (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for key, value in pairs
+        )
+        return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+    
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus 0.0.4"""
+        lines = []
+        for name, (kind, help_text) in self._kinds.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "gauge":
+                try:
+                    lines.append(f"{name} {self._gauges[name]()}")
+                except Exception as e:
+                    logger.debug(f"Не удалось снять метрику {name}: {e}")
+            elif kind == "counter":
+                for key, value in self._series[name].items():
+                    lines.append(f"{name}{self._format_labels(key)} {value}")
+            else:
+                bounds = [f"{bound:g}" for bound in self._buckets[name]] + ["+Inf"]
+                for key, (counts, total, count) in self._series[name].items():
+                    cumulative = 0
+                    for bound, bucket_count in zip(bounds, counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{self._format_labels(key + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{self._format_labels(key)} {total}")
+                    lines.append(f"{name}_count{self._format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(config.METRICS_CHAT_LABELS)
+
+metrics.histogram("lssr_handler_seconds", "Время обработчиков сообщений и кнопок")
+metrics.histogram("lssr_api_request_seconds", "Задержка вызовов Bot API")
+metrics.histogram("lssr_update_model_seconds", "Дообучение модели на новых сообщениях")
+metrics.histogram("lssr_model_build_seconds", "Полная сборка модели в пуле обучения")
+metrics.histogram("lssr_generate_seconds", "Время generate_message")
+metrics.histogram("lssr_generate_tries", "Сколько способов генерации перепробовал generate_message",
+                  buckets=(1, 2, 3, 4, 5))
+metrics.histogram("lssr_save_seconds", "Сохранение данных чата")
+metrics.histogram("lssr_load_seconds", "Загрузка чатов и моделей")
+metrics.counter("lssr_messages_total", "Обработанные сообщения по чатам")
+metrics.counter("lssr_replies_total", "Отправленные ответы по чатам")
+metrics.counter("lssr_generate_strategy_total", "Чем закончился generate_message")
+metrics.counter("lssr_saved_bytes_total", "Записано байт данных чатов")
+metrics.counter("lssr_outbound_total", "Исходящие ответы по результату")
+metrics.counter("lssr_broadcast_total", "Сообщения рассылки по результату")
+metrics.counter("lssr_model_cache_evictions_total", "Вытеснений из кэша моделей")
+metrics.histogram("lssr_send_lateness_seconds", "Насколько ответ ушёл позже запланированного")
+metrics.gauge("lssr_chats", "Чатов в памяти", lambda: len(chats_data))
+metrics.gauge("lssr_models_resident", "Моделей в памяти", lambda: len(model_cache))
+metrics.gauge("lssr_models_resident_bytes", "Оценка памяти моделей", lambda: model_cache.resident_bytes())
+metrics.gauge("lssr_training_tasks", "Сборок моделей в работе", lambda: len(training_tasks))
+metrics.gauge("lssr_queued_updates", "Обновлений в очередях чатов", lambda: dp.queued())
+metrics.gauge("lssr_outbound_queued", "Ответов в очереди отправки", lambda: send_queue.pending())
+metrics.gauge("lssr_pooled_sentences", "Готовых предложений в пулах",
+              lambda: sum(len(chat.sentence_pool) for chat in chats_data.values()))
+metrics.gauge("lssr_uptime_seconds", "Время работы", lambda: round(time.time() - bot_stats["start_time"]))
+
+metrics_runner: Optional[web.AppRunner] = None
+
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    return web.Response(
+        body=metrics.render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+async def start_metrics_server():
+    """Поднимает локальный HTTP-эндпоинт /metrics"""
+    global metrics_runner
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_endpoint)
+    metrics_runner = web.AppRunner(app, access_log=None)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, config.METRICS_HOST, config.METRICS_PORT).start()
+    logger.info(f"Метрики доступны на http://{config.METRICS_HOST}:{config.METRICS_PORT}/metrics")
+
+class InstrumentedBot(Bot):
+    """Bot, замеряющий задержку каждого вызова Bot API"""
+    
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        result = "ok"
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except BaseException as e:
+            result = type(e).__name__
+            raise
+        finally:
+            metrics.observe("lssr_api_request_seconds", time.perf_counter() - started,
+                            method=method, result=result)
+
+class SamplingProfiler:
+    """Сэмплирующий профилировщик потока с циклом событий.
+    
+    Фоновый поток снимает стек через sys._current_frames и считает одинаковые стеки;
+    результат - свёрнутые стеки (flamegraph.pl, speedscope). Сборки моделей в пуле
+    процессов сюда не попадают, только работа основного процесса.
+    """
+    
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.samples = 0
+        self._stacks: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+    
+    @staticmethod
+    def _frame_name(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        names = []
+        while frame is not None:
+            names.append(self._frame_name(frame))
+            frame = frame.f_back
+        if names:
+            stack = ";".join(reversed(names))
+            self._stacks[stack] = self._stacks.get(stack, 0) + 1
+            self.samples += 1
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="lssr-profiler", daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+    
+    def collapsed(self) -> str:
+        """Стеки в свёрнутом формате: кадры через ";" и число сэмплов"""
+        return "".join(f"{stack} {count}\n" for stack, count in
+                       sorted(self._stacks.items(), key=lambda item: item[1], reverse=True))
+
+active_profiler: Optional[SamplingProfiler] = None
+
+# ==================== ДИСПЕТЧЕР ====================
+class OrderedDispatcher(Dispatcher):
+    """Dispatcher, обрабатывающий обновления одного чата строго по очереди.
+    
+    У каждого чата своя очередь и не больше одного обновления в работе, поэтому
+    обработчики одного чата не перемежаются. Разные чаты идут параллельно, но не
+    больше concurrency одновременно; обновления без чата обрабатываются сразу.
+    """
+    
+    def __init__(self, *args, concurrency: int = 64, max_pending: int = 10000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self._running: Optional[asyncio.Semaphore] = None
+        self._pending: Optional[asyncio.Semaphore] = None
+        self._chat_queues: Dict[int, Deque[Tuple[types.Update, asyncio.Future]]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+    
+    def queued(self) -> int:
+        """Сколько обновлений ждут в очередях чатов"""
+        return sum(len(queue) for queue in self._chat_queues.values())
+    
+    async def submit(self, update: types.Update) -> asyncio.Future:
+        """Ставит обновление в очередь его чата и сразу возвращает future с результатом.
+        
+        Ждёт, только если принято max_pending необработанных обновлений.
+        """
+        if self._running is None:
+            # Семафоры создаются в работающем цикле событий
+            self._running = asyncio.Semaphore(self.concurrency)
+            self._pending = asyncio.Semaphore(self.max_pending)
+        await self._pending.acquire()
+        
+        future = asyncio.get_running_loop().create_future()
+        chat_id = update_chat_id(update)
+        if chat_id is None:
+            self._spawn(self._run_one(update, future))
+        elif chat_id in self._chat_queues:
+            self._chat_queues[chat_id].append((update, future))
+        else:
+            self._chat_queues[chat_id] = deque([(update, future)])
+            self._spawn(self._drain_chat(chat_id))
+        return future
+    
+    async def process_update(self, update: types.Update):
+        return await (await self.submit(update))
+    
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _run_one(self, update: types.Update, future: asyncio.Future):
+        try:
+            async with self._running:
+                result = await super().process_update(update)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self._pending.release()
+    
+    async def _drain_chat(self, chat_id: int):
+        # Очередь живёт, пока в ней есть обновления; новое обновление чата попадает в её конец
+        queue = self._chat_queues[chat_id]
+        try:
+            while queue:
+                update, future = queue[0]
+                await self._run_one(update, future)
+                queue.popleft()
+        finally:
+            del self._chat_queues[chat_id]
+    
+    async def drain(self):
+        """Ждёт обработки всех принятых обновлений"""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+# ==================== ИСХОДЯЩИЕ СООБЩЕНИЯ ====================
+class TokenBucket:
+    """Корзина токенов: в среднем rate событий в секунду, всплеском до burst"""
+    
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+    
+    def try_acquire(self) -> float:
+        """Берёт токен; если его нет - возвращает, сколько секунд ждать"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    async def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+    
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (RetryAfter от Telegram)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+class OutgoingMessage:
+    """Ответ, ожидающий отправки"""
+    __slots__ = ("chat_id", "text", "reply_to", "typing_at", "due", "relevant", "on_sent", "attempts")
+    
+    def __init__(self, chat_id: int, text: str, due: float, typing_at: Optional[float] = None,
+                 reply_to: Optional[int] = None, relevant: Optional[Callable[[], bool]] = None,
+                 on_sent: Optional[Callable[[], None]] = None):
+        self.chat_id = chat_id
+        self.text = text
+        self.due = due  # Время отправки по time.monotonic()
+        self.typing_at = typing_at  # Когда показать "печатает" (None - не показывать)
+        self.reply_to = reply_to
+        self.relevant = relevant  # Ложь - ответ потерял смысл и отбрасывается
+        self.on_sent = on_sent
+        self.attempts = 0
+
+# Ошибки, после которых писать в чат бессмысленно
+UNREACHABLE_ERRORS = (Unauthorized, ChatNotFound)
+
+def mark_unreachable(chat_id: int, error: Exception):
+    """Помечает чат, куда бот не может писать; пометка снимается первым сообщением из чата"""
+    chat_data = chats_data.get(chat_id)
+    if chat_data is not None and not chat_data.unreachable_since:
+        chat_data.unreachable_since = int(time.time())
+        chat_data.dirty = True
+    logger.warning(f"Чат {chat_id} недоступен: {error}")
+
+class SendQueue:
+    """Очередь исходящих ответов с учётом лимитов Telegram.
+    
+    Ответы одного чата уходят по порядку и не чаще chat_interval (group_interval для
+    групп), все вместе - не быстрее глобальной корзины токенов. "Печатает" показывается
+    один раз на несколько ответов подряд, RetryAfter откладывает чат и корзину на
+    указанное время, сетевые ошибки повторяются с растущей паузой. Ответы, опоздавшие
+    больше max_late секунд или потерявшие смысл, отбрасываются.
+    """
+    TYPING_SECONDS = 5  # Столько Telegram показывает "печатает" после send_chat_action
+    
+    def __init__(self, bot: Bot, bucket: TokenBucket, chat_interval: float, group_interval: float,
+                 max_late: float, max_attempts: int, chat_backlog: int):
+        self.bot = bot
+        self.bucket = bucket
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.max_late = max_late
+        self.max_attempts = max_attempts
+        self.chat_backlog = chat_backlog
+        self._chats: Dict[int, Deque[OutgoingMessage]] = {}
+        self._ready_at: Dict[int, float] = {}  # Раньше этого чату писать нельзя
+        self._typing_until: Dict[int, float] = {}
+        self._scheduled: Dict[int, float] = {}  # Когда чат в следующий раз смотрит на очередь
+        self._heap: List[Tuple[float, int]] = []
+        self._busy: Set[int] = set()  # Чаты, чей ответ сейчас отправляется
+        self._tasks: Set[asyncio.Task] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._runner: Optional[asyncio.Task] = None
+    
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self._chats.values())
+    
+    def schedule(self, message: OutgoingMessage):
+        """Ставит ответ в очередь и сразу возвращает управление"""
+        if self._runner is None:
+            self._wakeup = asyncio.Event()
+            self._idle = asyncio.Event()
+            self._runner = asyncio.create_task(self._run())
+        chat_id = message.chat_id
+        queue = self._chats.setdefault(chat_id, deque())
+        if len(queue) >= self.chat_backlog:
+            # Новый ответ важнее самого старого из ещё не начатых
+            queue.remove(queue[1] if chat_id in self._busy else queue[0])
+            self._count("backlog")
+        queue.append(message)
+        self._idle.clear()
+        if len(queue) == 1 and chat_id not in self._busy:
+            self._schedule_chat(chat_id)
+    
+    async def join(self, timeout: Optional[float] = None):
+        """Ждёт, пока очередь опустеет"""
+        if self._idle is None or (not self._chats and not self._busy):
+            return
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не отправлено ответов при остановке: {self.pending()}")
+    
+    def _count(self, result: str, amount: int = 1):
+        metrics.inc("lssr_outbound_total", amount, result=result)
+    
+    def _interval(self, chat_id: int) -> float:
+        return self.group_interval if chat_id < 0 else self.chat_interval
+    
+    def _schedule_chat(self, chat_id: int, when: Optional[float] = None):
+        queue = self._chats.get(chat_id)
+        if not queue:
+            self._chats.pop(chat_id, None)
+            now = time.monotonic()
+            if self._ready_at.get(chat_id, 0) <= now:
+                self._ready_at.pop(chat_id, None)
+            if self._typing_until.get(chat_id, 0) <= now:
+                self._typing_until.pop(chat_id, None)
+            if not self._chats and not self._busy:
+                self._idle.set()
+            return
+        if when is None:
+            head = queue[0]
+            when = head.typing_at if head.typing_at is not None else max(head.due, self._ready_at.get(chat_id, 0))
+        self._scheduled[chat_id] = when
+        heapq.heappush(self._heap, (when, chat_id))
+        self._wakeup.set()
+    
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                when, chat_id = heapq.heappop(self._heap)
+                if self._scheduled.get(chat_id) != when:
+                    continue  # Устаревшая запись: чат перепланирован
+                del self._scheduled[chat_id]
+                try:
+                    self._step(chat_id, now)
+                except Exception as e:
+                    # Сбойный ответ выбрасывается, чтобы не останавливать очередь остальных чатов
+                    logger.exception(f"Ошибка очереди отправки в чате {chat_id}: {e}")
+                    self._drop_head(chat_id)
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    
+    def _step(self, chat_id: int, now: float):
+        queue = self._chats.get(chat_id)
+        if not queue:
+            return
+        message = queue[0]
+        
+        if message.typing_at is not None:
+            message.typing_at = None
+            # Один "печатает" на все ответы, которые успеют уйти за время его показа
+            if self._typing_until.get(chat_id, 0) <= now:
+                self._typing_until[chat_id] = now + self.TYPING_SECONDS
+                self._spawn(self._send_typing(chat_id))
+            self._schedule_chat(chat_id)
+            return
+        
+        if now - message.due > self.max_late or (message.relevant is not None and not message.relevant()):
+            queue.popleft()
+            self._count("stale")
+            self._schedule_chat(chat_id)
+            return
+        
+        # Рассылка могла написать в чат, пока ответ ждал своей очереди
+        ready_at = self._ready_at.get(chat_id, 0)
+        if ready_at > now:
+            self._schedule_chat(chat_id, ready_at)
+            return
+        
+        wait = self.bucket.try_acquire()
+        if wait > 0:
+            self._schedule_chat(chat_id, now + wait)
+            return
+        
+        self._busy.add(chat_id)
+        self._spawn(self._send(chat_id, message))
+    
+    def _drop_head(self, chat_id: int):
+        queue = self._chats.get(chat_id)
+        if queue and chat_id not in self._busy:
+            queue.popleft()
+            self._count("failed")
+        if chat_id not in self._busy:
+            self._schedule_chat(chat_id)
+    
+    def chat_delay(self, chat_id: int) -> float:
+        """Сколько ждать, прежде чем писать в чат мимо очереди"""
+        return max(0.0, self._ready_at.get(chat_id, 0) - time.monotonic())
+    
+    def note_sent(self, chat_id: int):
+        """Учитывает сообщение, отправленное в чат мимо очереди: следующий ответ выдержит интервал"""
+        now = time.monotonic()
+        self._ready_at[chat_id] = max(self._ready_at.get(chat_id, 0), now + self._interval(chat_id))
+        if len(self._ready_at) > 2 * len(self._chats) + 10000:
+            # Рассылка проходит по всем чатам; истёкшие отметки чатов без ответов не нужны
+            self._ready_at = {key: when for key, when in self._ready_at.items()
+                              if when > now or key in self._chats or key in self._busy}
+    
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _send_typing(self, chat_id: int):
+        try:
+            await self.bot.send_chat_action(chat_id, types.ChatActions.TYPING)
+        except Exception as e:
+            logger.debug(f"Не удалось показать набор текста в чате {chat_id}: {e}")
+    
+    async def _send(self, chat_id: int, message: OutgoingMessage):
+        queue = self._chats[chat_id]
+        started = time.monotonic()
+        try:
+            await self.bot.send_message(
+                chat_id,
+                message.text,
+                reply_to_message_id=message.reply_to,
+                disable_notification=True,
+                allow_sending_without_reply=True
+            )
+        except RetryAfter as e:
+            # Ответ остаётся первым в очереди и уйдёт после паузы. 429 обычно означает общий
+            # лимит бота, поэтому ждут и остальные чаты
+            self._ready_at[chat_id] = time.monotonic() + e.timeout
+            self.bucket.pause(e.timeout)
+            message.due = time.monotonic() + e.timeout
+            self._count("retry_after")
+            logger.warning(f"Telegram просит подождать {e.timeout} с перед ответом в чат {chat_id}")
+        except UNREACHABLE_ERRORS as e:
+            self._count("unreachable", len(queue))
+            queue.clear()
+            mark_unreachable(chat_id, e)
+        except BadRequest as e:
+            queue.popleft()
+            self._count("failed")
+            logger.error(f"Telegram отклонил ответ в чат {chat_id}: {e}")
+        except Exception as e:
+            message.attempts += 1
+            if message.attempts >= self.max_attempts:
+                queue.popleft()
+                self._count("failed")
+                logger.error(f"Ошибка отправки сообщения в чат {chat_id}: {e}")
+            else:
+                backoff = 2 ** message.attempts
+                self._ready_at[chat_id] = time.monotonic() + backoff
+                message.due = time.monotonic() + backoff
+                self._count("retry")
+                logger.warning(f"Ошибка отправки в чат {chat_id}, повтор через {backoff} с: {e}")
+        else:
+            queue.popleft()
+            self._ready_at[chat_id] = time.monotonic() + self._interval(chat_id)
+            self._count("sent")
+            metrics.observe("lssr_send_lateness_seconds", started - message.due)
+            if message.on_sent is not None:
+                message.on_sent()
+        finally:
+            self._busy.discard(chat_id)
+            self._schedule_chat(chat_id)
+
 # ==================== ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ====================
-bot = Bot(os.environ["TOKEN"], parse_mode=types.ParseMode.HTML)
+bot = InstrumentedBot(
+    os.environ["TOKEN"],
+    parse_mode=types.ParseMode.HTML,
+    server=TelegramAPIServer.from_base(config.TELEGRAM_API_SERVER) if config.TELEGRAM_API_SERVER else TELEGRAM_PRODUCTION
+)
 storage = MemoryStorage()
-dp = Dispatcher(bot, storage=storage)
+dp = OrderedDispatcher(bot, storage=storage, concurrency=config.CHAT_CONCURRENCY,
+                       max_pending=config.MAX_PENDING_UPDATES)
+send_queue = SendQueue(
+    bot,
+    # Лимит Telegram общий на бота, поэтому шарды делят его поровну
+    TokenBucket(config.SEND_RATE / max(config.SHARDS, 1), config.SEND_BURST),
+    chat_interval=config.SEND_CHAT_INTERVAL,
+    group_interval=config.SEND_GROUP_INTERVAL,
+    max_late=config.REPLY_MAX_LATE,
+    max_attempts=config.SEND_MAX_ATTEMPTS,
+    chat_backlog=config.SEND_CHAT_BACKLOG
+)
 
 # Хранилище данных чатов
 chats_data: Dict[int, ChatData] = {}
 
+# Данные самого бота (get_me), обновляются в фоне
+bot_identity: Optional[types.User] = None
+
 # Статистика бота
 bot_stats = {
     "total_messages_processed": 0,
@@ -315,9 +2286,44 @@ class ChatMiddleware(BaseMiddleware):
         
         chats_data[chat_id].last_activity = int(time.time())
         chats_data[chat_id].message_count += 1
+        chats_data[chat_id].unreachable_since = 0  # Раз из чата пишут, бот снова в нём
+        chats_data[chat_id].dirty = True
         
         # Обновляем глобальную статистику
         bot_stats["total_messages_processed"] += 1
+        metrics.inc("lssr_messages_total", chat=metrics.chat_label(chat_id))
+
+class MetricsMiddleware(BaseMiddleware):
+    """Middleware для замера времени обработчиков и журнала медленных"""
+    
+    async def on_pre_process_message(self, message: Message, data: dict):
+        data["_started"] = time.perf_counter()
+    
+    async def on_process_message(self, message: Message, data: dict):
+        data["_handler"] = current_handler.get().__name__
+    
+    async def on_post_process_message(self, message: Message, results, data: dict):
+        self.observe("message", message.chat.id, data)
+    
+    async def on_pre_process_callback_query(self, callback_query: CallbackQuery, data: dict):
+        data["_started"] = time.perf_counter()
+    
+    async def on_process_callback_query(self, callback_query: CallbackQuery, data: dict):
+        data["_handler"] = current_handler.get().__name__
+    
+    async def on_post_process_callback_query(self, callback_query: CallbackQuery, results, data: dict):
+        chat_id = callback_query.message.chat.id if callback_query.message else None
+        self.observe("callback_query", chat_id, data)
+    
+    @staticmethod
+    def observe(update_type: str, chat_id: Optional[int], data: dict):
+        # Обновления, не дошедшие ни до одного обработчика, не учитываются
+        if "_handler" not in data:
+            return
+        elapsed = time.perf_counter() - data["_started"]
+        metrics.observe("lssr_handler_seconds", elapsed, handler=data["_handler"], update=update_type)
+        if elapsed * 1000 >= config.SLOW_HANDLER_MS:
+            logger.warning(f"Медленный обработчик {data['_handler']} в чате {chat_id}: {elapsed * 1000:.0f} мс")
 
 class PrivateChatMiddleware(BaseMiddleware):
     """Middleware для приватных чатов"""
@@ -328,7 +2334,7 @@ class PrivateChatMiddleware(BaseMiddleware):
             keyboard.add(
                 InlineKeyboardButton("📚 Документация", url="https://github.com/lssr-bot/docs"),
                 InlineKeyboardButton("👥 Добавить в группу", 
-                                   url=f"https://t.me/{(await bot.get_me()).username}?startgroup=true"),
+                                   url=f"https://t.me/{(await get_bot_identity()).username}?startgroup=true"),
                 InlineKeyboardButton("⚙️ Настройки", callback_data="private_settings"),
                 InlineKeyboardButton("📊 Статистика", callback_data="private_stats")
             )
@@ -347,6 +2353,34 @@ class PrivateChatMiddleware(BaseMiddleware):
             )
             raise CancelHandler()
 
+async def get_bot_identity() -> types.User:
+    """Возвращает закэшированные данные бота, запрашивая их только при первом обращении"""
+    global bot_identity
+    if bot_identity is None:
+        bot_identity = await bot.get_me()
+    return bot_identity
+
+async def identity_refresher():
+    """Фоновая задача: периодически обновляет данные бота (например, после смены username)"""
+    global bot_identity
+    while True:
+        await asyncio.sleep(config.BOT_IDENTITY_REFRESH)
+        try:
+            bot_identity = await bot.get_me()
+        except Exception as e:
+            logger.warning(f"Не удалось обновить данные бота: {e}")
+
+@functools.lru_cache(maxsize=1024)
+def compile_trigger_pattern(bot_username: str, custom_words: Tuple[str, ...]) -> re.Pattern:
+    """Собирает все триггеры чата в одно регулярное выражение"""
+    words = [f"@{bot_username}"] + config.TRIGGER_WORDS + list(custom_words)
+    return re.compile("|".join(re.escape(word) for word in words if word), re.IGNORECASE)
+
+def is_triggered(chat_data: ChatData, text: str, bot_username: str) -> bool:
+    """Упомянут ли бот или одно из слов-триггеров чата"""
+    pattern = compile_trigger_pattern(bot_username or "", tuple(chat_data.settings["trigger_words"]))
+    return pattern.search(text) is not None
+
 async def is_telegram_admin(chat_id: int, user_id: int) -> bool:
     """Проверяет, является ли пользователь администратором Telegram чата"""
     try:
@@ -402,44 +2436,68 @@ def should_respond(chat_data: ChatData, message: Message, triggered: bool = Fals
     
     return random.random() * 100 <= final_chance
 
+def generate_model_sentences(model: IncrementalText, count: int) -> List[str]:
+    """Генерирует до count предложений из модели: обычных, а недостающие - коротких"""
+    sentences = model.make_sentences(
+        count,
+        min_chars=config.MIN_SENTENCE_LENGTH,
+        max_chars=config.MAX_SENTENCE_LENGTH,
+        tries=config.MAX_TRIES_GENERATION * count
+    )
+    if len(sentences) < count:
+        missing = count - len(sentences)
+        sentences += model.make_sentences(
+            missing,
+            max_chars=config.SHORT_SENTENCE_MAX,
+            tries=config.MAX_TRIES_GENERATION * missing
+        )
+    return sentences
+
+def generate_model_sentence(model: IncrementalText) -> Optional[str]:
+    """Генерирует предложение из модели: обычное, а при неудаче короткое"""
+    sentences = generate_model_sentences(model, 1)
+    return sentences[0] if sentences else None
+
 def generate_message(chat_data: ChatData, context: str = "") -> Optional[str]:
     """Генерирует сообщение с учетом контекста"""
     if not chat_data.model:
         return None
     
+    with metrics.timer("lssr_generate_seconds"):
+        return _generate_message(chat_data, context)
+
+def _generate_message(chat_data: ChatData, context: str) -> Optional[str]:
     try:
         strategies = [
-            lambda: chat_data.model.make_sentence(
-                min_chars=config.MIN_SENTENCE_LENGTH,
-                max_chars=config.MAX_SENTENCE_LENGTH,
-                tries=config.MAX_TRIES_GENERATION
-            ),
-            lambda: chat_data.model.make_short_sentence(
-                config.SHORT_SENTENCE_MAX,
-                tries=config.MAX_TRIES_GENERATION
-            ),
-            lambda: random.choice(chat_data.custom_responses) if chat_data.custom_responses else None,
-            lambda: random.choice(chat_data.messages[-100:]) if chat_data.messages else None
+            ("pool", lambda: chat_data.take_pooled_sentence()),
+            ("model", lambda: generate_model_sentence(chat_data.model)),
+            ("custom", lambda: random.choice(chat_data.custom_responses) if chat_data.custom_responses else None),
+            ("history", lambda: random.choice(chat_data.messages.tail(100)) if chat_data.messages else None)
         ]
+        tries = 0
         
         if context and context.strip():
             try:
-                context_messages = [msg for msg in chat_data.messages[-500:] 
-                                  if any(word.lower() in msg.lower() for word in context.lower().split()[:3])]
-                
-                if context_messages:
-                    context_text = "\n".join(context_messages)
-                    if len(context_text.split()) > 10:
-                        context_model = markovify.NewlineText(context_text, state_size=2)
-                        sentence = context_model.make_sentence(tries=30)
-                        if sentence:
-                            return sentence
+                # Стартуем основную цепь из состояний, где встречаются слова контекста
+                context_tokens = [token for token in tokenize(context) if len(token) > 2][:config.CONTEXT_WORDS]
+                if context_tokens:
+                    tries += 1
+                    sentence = chat_data.model.make_sentence_with_context(
+                        context_tokens, seeds=config.CONTEXT_SEEDS, tries=3
+                    )
+                    if sentence:
+                        metrics.observe("lssr_generate_tries", tries)
+                        metrics.inc("lssr_generate_strategy_total", strategy="context")
+                        return sentence
             except Exception as e:
                 logger.debug(f"Контекстная генерация не удалась: {e}")
         
-        for strategy in strategies:
+        for name, strategy in strategies:
+            tries += 1
             result = strategy()
             if result:
+                metrics.observe("lssr_generate_tries", tries)
+                metrics.inc("lssr_generate_strategy_total", strategy=name)
                 result = re.sub(r"@(\w+)", r'<a href="https://t.me/\1">@\1</a>', result)
                 
                 if chat_data.settings["revolutionary_mode"] and random.random() < 0.4:
@@ -451,9 +2509,11 @@ def generate_message(chat_data: ChatData, context: str = "") -> Optional[str]:
                         # Запоминаем использованную фразу
                         if result not in chat_data.revolutionary_phrases_used:
                             chat_data.revolutionary_phrases_used.append(result)
+                            chat_data.dirty = True
                 
                 return result
         
+        metrics.inc("lssr_generate_strategy_total", strategy="none")
         return None
     except Exception as e:
         logger.error(f"Ошибка генерации сообщения: {e}")
@@ -476,25 +2536,458 @@ async def update_chat_mood(chat_id: int):
     
     await save_chat_data(chat_id)
 
-# ==================== СОХРАНЕНИЕ И ЗАГРУЗКА ДАННЫХ ====================
-async def save_chat_data(chat_id: int):
-    """Сохраняет данные чата"""
-    if chat_id not in chats_data:
+# ==================== ОБУЧЕНИЕ МОДЕЛЕЙ ====================
+training_pool: Optional[ProcessPoolExecutor] = None
+training_tasks: Dict[int, asyncio.Task] = {}
+
+def _on_model_evicted(chat_id: int, model: IncrementalText):
+    """Сохраняет вытесняемую из кэша модель, чтобы не собирать её заново"""
+    chat_data = chats_data.get(chat_id)
+    if not chat_data or chat_data.saved_model_version == chat_data.model_version:
         return
+    try:
+        asyncio.get_running_loop().create_task(save_chat_model(chat_id, model))
+    except RuntimeError:
+        pass
+
+model_cache = ModelCache(config.MODEL_CACHE_MB * 1024 * 1024, on_evict=_on_model_evicted)
+
+def get_training_pool() -> Optional[ProcessPoolExecutor]:
+    """Возвращает пул процессов для обучения, создавая его при первом обращении"""
+    global training_pool
+    if training_pool is None and config.TRAINING_WORKERS > 0:
+        training_pool = ProcessPoolExecutor(max_workers=config.TRAINING_WORKERS)
+    return training_pool
+
+async def _build_model_in_pool(chat_data: ChatData) -> bool:
+    """Собирает модель в пуле и атомарно подменяет ею текущую"""
+    messages, trained_upto = chat_data.training_snapshot()
+    started = time.time()
+    
+    try:
+        pool = get_training_pool()
+        if pool is not None:
+            loop = asyncio.get_running_loop()
+            model = await loop.run_in_executor(pool, build_model, messages, trained_upto)
+        else:
+            model = build_model(messages, trained_upto)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка сборки модели для чата {chat_data.chat_id}: {e}")
+        return False
+    finally:
+        if training_tasks.get(chat_data.chat_id) is asyncio.current_task():
+            del training_tasks[chat_data.chat_id]
+    
+    # Подмена одной операцией: до этого момента чат генерирует из старой модели
+    chat_data.model = model
+    metrics.observe("lssr_model_build_seconds", time.time() - started)
+    logger.info(f"Модель чата {chat_data.chat_id} собрана за {time.time() - started:.2f} с")
+    
+    # Догоняем сообщения, пришедшие во время сборки
+    chat_data.update_model(force=True)
+    await save_chat_model(chat_data.chat_id)
+    return not model.is_empty()
+
+async def train_chat_model(chat_data: ChatData, force: bool = False,
+                           rebuild: bool = False, wait: bool = True) -> bool:
+    """Обучает модель чата: дообучение на месте или полная сборка в пуле процессов.
+    
+    Без rebuild дообучается только модель, находящаяся в памяти.
+    Повторные запросы на сборку, пока она идёт, склеиваются в одну.
+    """
+    if not rebuild:
+        updated = chat_data.update_model(force=force)
+        model = model_cache.peek(chat_data.chat_id)
+        if model is not None and model.end_distances_stale() and not model.refresh_end_distances():
+            # У больших моделей расстояния до конца предложений пересчитываются полной сборкой в пуле
+            await train_chat_model(chat_data, rebuild=True, wait=False)
+        return updated
+    
+    if not chat_data.can_train():
+        return False
+    
+    task = training_tasks.get(chat_data.chat_id)
+    if task is None or task.done():
+        task = asyncio.create_task(_build_model_in_pool(chat_data))
+        training_tasks[chat_data.chat_id] = task
+    
+    if not wait:
+        return False
+    return await asyncio.shield(task)
+
+async def ensure_model(chat_data: ChatData) -> Optional[IncrementalText]:
+    """Возвращает модель чата, при необходимости загружая её с диска или запуская сборку"""
+    model = model_cache.get(chat_data.chat_id)
+    
+    if model is None and chat_data.chat_id not in training_tasks:
+        if not await load_chat_model(chat_data):
+            # Пока модель собирается, чат просто молчит
+            await train_chat_model(chat_data, rebuild=True, wait=False)
+            return None
+        chat_data.update_model()
+    
+    # Дообучение резидентной модели идёт пачками по 50 сообщений в handle_message,
+    # чтобы версия модели (и пул готовых предложений) не менялась на каждом ответе
+    return chat_data.model
+
+def cancel_training(chat_id: int):
+    """Отменяет ожидающую сборку модели, её результат будет отброшен"""
+    task = training_tasks.pop(chat_id, None)
+    if task and not task.done():
+        task.cancel()
+
+training_reports: Set[asyncio.Task] = set()
+
+async def start_training(chat_data: ChatData, status: Message, footer: str = ""):
+    """Запускает сборку модели, не занимая очередь чата; итог появится в сообщении status"""
+    await train_chat_model(chat_data, force=True, rebuild=True, wait=False)
+    task = asyncio.create_task(report_training(chat_data, training_tasks.get(chat_data.chat_id), status, footer))
+    training_reports.add(task)
+    task.add_done_callback(training_reports.discard)
+
+async def report_training(chat_data: ChatData, build: Optional[asyncio.Task], status: Message, footer: str):
+    """Дожидается сборки модели и заменяет сообщение о её начале итогом"""
+    success = False
+    if build is not None:
+        try:
+            success = await asyncio.shield(build)
+        except asyncio.CancelledError:
+            if not build.cancelled():
+                raise
+    
+    if success:
+        text = (
+            f"✅ <b>Модель успешно обучена!</b>\n\n"
+            f"• Сообщений использовано: {min(len(chat_data.messages), chat_data.settings['max_messages'])}\n"
+            f"• Версия модели: <code>{chat_data.model_version}</code>\n"
+            f"• Настроение: <code>{chat_data.mood}</code>\n"
+            f"{footer}"
+        )
+    else:
+        text = "❌ <b>Ошибка обучения модели!</b>\n\nПопробуйте позже или добавьте больше сообщений."
+    
+    try:
+        await status.edit_text(text)
+    except Exception as e:
+        logger.debug(f"Не удалось сообщить об итоге обучения в чате {chat_data.chat_id}: {e}")
+
+# ==================== СОХРАНЕНИЕ И ЗАГРУЗКА ДАННЫХ ====================
+class SQLiteStorage:
+    """Хранилище чатов в SQLite (WAL): сообщения и настройки пишутся построчно"""
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS settings (
+            chat_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (chat_id, key)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS messages (
+            chat_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            PRIMARY KEY (chat_id, seq)
+        ) WITHOUT ROWID;
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        # Все обращения к соединению идут из одного потока
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+    
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+    
+    @staticmethod
+    def split_record(data: Dict) -> Tuple[Dict, Dict, List[Tuple[int, str]]]:
+        """Разделяет словарь чата на служебные поля, настройки и сообщения"""
+        meta = {k: v for k, v in data.items() if k not in ("messages", "settings")}
+        messages = data.get("messages", [])
+        total = max(data.get("messages_total", 0), len(messages))
+        first_seq = total - len(messages) + 1
+        return meta, data.get("settings", {}), [(first_seq + i, text) for i, text in enumerate(messages)]
+    
+    def _write(self, chat_id: int, meta: Dict, settings: Dict,
+               messages: List[Tuple[int, str]], keep_from_seq: int):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO chats (chat_id, data) VALUES (?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data",
+                (chat_id, json.dumps(meta, ensure_ascii=False))
+            )
+            if settings:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO settings (chat_id, key, value) VALUES (?, ?, ?)",
+                    [(chat_id, key, json.dumps(value, ensure_ascii=False)) for key, value in settings.items()]
+                )
+            if messages:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO messages (chat_id, seq, text) VALUES (?, ?, ?)",
+                    [(chat_id, seq, text) for seq, text in messages]
+                )
+            conn.execute("DELETE FROM messages WHERE chat_id = ? AND seq < ?", (chat_id, keep_from_seq))
+    
+    def _read_all(self) -> List[Dict]:
+        conn = self._connect()
+        records: Dict[int, Dict] = {}
+        for chat_id, data in conn.execute("SELECT chat_id, data FROM chats"):
+            record = json.loads(data)
+            record.update(chat_id=chat_id, settings={}, messages=[])
+            records[chat_id] = record
+        for chat_id, key, value in conn.execute("SELECT chat_id, key, value FROM settings"):
+            if chat_id in records:
+                records[chat_id]["settings"][key] = json.loads(value)
+        for chat_id, seq, text in conn.execute("SELECT chat_id, seq, text FROM messages ORDER BY chat_id, seq"):
+            if chat_id in records:
+                records[chat_id]["messages"].append(text)
+                records[chat_id]["messages_total"] = max(records[chat_id].get("messages_total", 0), seq)
+        return list(records.values())
+    
+    async def save_chat(self, chat_data: ChatData) -> int:
+        """Пишет только изменения чата, возвращает примерный объём записанных данных"""
+        data = chat_data.to_dict()
+        meta, settings, _ = self.split_record(data)
+        changed_settings = {k: v for k, v in settings.items() if chat_data.saved_settings.get(k, object()) != v}
+        messages = chat_data.pending_messages()
+        keep_from_seq = chat_data.messages_total - len(data["messages"]) + 1
+        saved_total = chat_data.messages_total
+        
+        await self._run(self._write, chat_data.chat_id, meta, changed_settings, messages, keep_from_seq)
+        
+        chat_data.saved_total = saved_total
+        chat_data.saved_settings.update(changed_settings)
+        return (len(json.dumps(meta, ensure_ascii=False))
+                + sum(len(json.dumps(v, ensure_ascii=False)) for v in changed_settings.values())
+                + sum(len(text) for _, text in messages))
+    
+    async def import_record(self, data: Dict):
+        """Записывает чат целиком (для миграции из JSON)"""
+        meta, settings, messages = self.split_record(data)
+        keep_from_seq = messages[0][0] if messages else meta.get("messages_total", 0) + 1
+        await self._run(self._write, data["chat_id"], meta, settings, messages, keep_from_seq)
+    
+    async def load_chats(self) -> List[Dict]:
+        return await self._run(self._read_all)
+    
+    def close(self):
+        if self._conn is not None:
+            self._executor.submit(self._conn.close).result()
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+sqlite_storage: Optional[SQLiteStorage] = None
+
+def get_sqlite_storage() -> SQLiteStorage:
+    """Возвращает хранилище SQLite, открывая его при первом обращении"""
+    global sqlite_storage
+    if sqlite_storage is None:
+        sqlite_storage = SQLiteStorage(config.SQLITE_PATH)
+    return sqlite_storage
+
+async def migrate_json_to_sqlite() -> int:
+    """Переносит все чаты из JSON-файлов DB_FOLDER в базу SQLite"""
+    storage = get_sqlite_storage()
+    migrated = 0
+    
+    for filename in sorted(os.listdir(config.DB_FOLDER)) if os.path.exists(config.DB_FOLDER) else []:
+        if not filename.endswith('.json'):
+            continue
+        try:
+            async with aiofiles.open(os.path.join(config.DB_FOLDER, filename), 'r', encoding='utf-8') as f:
+                data = json.loads(await f.read())
+            await storage.import_record(ChatData.from_dict(data).to_dict())
+            migrated += 1
+        except Exception as e:
+            logger.error(f"Ошибка миграции файла {filename}: {e}")
+    
+    logger.info(f"Миграция завершена: {migrated} чатов перенесено в {config.SQLITE_PATH}")
+    return migrated
+
+async def save_chat_data(chat_id: int) -> int:
+    """Сохраняет данные чата, возвращает количество записанных байт"""
+    chat_data = chats_data.get(chat_id)
+    if chat_data is None:
+        return 0
+    
+    with metrics.timer("lssr_save_seconds", backend=config.STORAGE_BACKEND):
+        written = await _write_chat_data(chat_data)
+    metrics.inc("lssr_saved_bytes_total", written, backend=config.STORAGE_BACKEND)
+    return written
+
+async def _write_chat_data(chat_data: ChatData) -> int:
+    chat_id = chat_data.chat_id
+    
+    # Сбрасываем флаг до сериализации: изменения во время записи снова пометят чат
+    chat_data.dirty = False
+    
+    if config.STORAGE_BACKEND == "sqlite":
+        try:
+            written = await get_sqlite_storage().save_chat(chat_data)
+            logger.debug(f"Данные чата {chat_id} сохранены в SQLite")
+            return written
+        except Exception as e:
+            chat_data.dirty = True
+            logger.error(f"Ошибка сохранения чата {chat_id}: {e}")
+            return 0
     
     # Создаем все необходимые директории
     os.makedirs(config.DB_FOLDER, exist_ok=True)
     file_path = os.path.join(config.DB_FOLDER, f"{chat_id}.json")
     
     try:
-        async with aiofiles.open(file_path, 'w', encoding='utf-8') as f:
-            await f.write(json.dumps(chats_data[chat_id].to_dict(), ensure_ascii=False, indent=2))
+        payload = json.dumps(chat_data.to_dict(), ensure_ascii=False, indent=2).encode('utf-8')
+        async with aiofiles.open(file_path, 'wb') as f:
+            await f.write(payload)
         logger.debug(f"Данные чата {chat_id} сохранены")
+        return len(payload)
     except Exception as e:
+        chat_data.dirty = True
         logger.error(f"Ошибка сохранения чата {chat_id}: {e}")
-        
+        return 0
+
+async def flush_dirty_chats() -> Tuple[int, int]:
+    """Сохраняет только изменённые чаты с ограниченным параллелизмом.
+    
+    Возвращает количество сохранённых чатов и записанных байт.
+    """
+    semaphore = asyncio.Semaphore(config.SAVE_CONCURRENCY)
+    
+    async def save_one(chat_id: int) -> int:
+        async with semaphore:
+            return await save_chat_data(chat_id)
+    
+    dirty_ids = [chat_id for chat_id, chat in chats_data.items() if chat.dirty]
+    written = await asyncio.gather(*(save_one(chat_id) for chat_id in dirty_ids))
+    return len(dirty_ids), sum(written)
+
+async def flush_models():
+    """Дообучает и сохраняет изменившиеся модели, находящиеся в памяти"""
+    for chat_id in model_cache.chat_ids():
+        chat_data = chats_data.get(chat_id)
+        if chat_data:
+            chat_data.update_model()
+            await save_chat_model(chat_id)
+
+
+# Версия формата сохранённых моделей: файлы другого формата собираются заново
+MODEL_FORMAT = 5  # 4 - расстояния до конца предложений в цепи, 5 - диапазон обученных сообщений
+
+def get_model_path(chat_id: int) -> str:
+    """Путь к файлу сохранённой модели чата"""
+    return os.path.join(config.MODEL_FOLDER, f"{chat_id}.pkl")
+
+async def save_chat_model(chat_id: int, model: Optional[IncrementalText] = None):
+    """Сохраняет обученную модель чата, если она изменилась с прошлого сохранения"""
+    chat_data = chats_data.get(chat_id)
+    if not chat_data:
+        return
+    model = model or chat_data.model
+    if model is None or chat_data.saved_model_version == chat_data.model_version:
+        return
+    
+    os.makedirs(config.MODEL_FOLDER, exist_ok=True)
+    file_path = get_model_path(chat_id)
+    
+    try:
+        payload = pickle.dumps(
+            {
+                "format": MODEL_FORMAT,
+                "model_version": chat_data.model_version,
+                # Модель обучена на сообщениях trained_total - window + 1 .. trained_total
+                "trained_total": model.trained_upto,
+                "window": model.message_count,
+                "model": model
+            },
+            protocol=pickle.HIGHEST_PROTOCOL
+        )
+        async with aiofiles.open(file_path + ".tmp", 'wb') as f:
+            await f.write(payload)
+        os.replace(file_path + ".tmp", file_path)
+        chat_data.saved_model_version = chat_data.model_version
+        logger.debug(f"Модель чата {chat_id} сохранена (версия {chat_data.model_version})")
+    except Exception as e:
+        logger.error(f"Ошибка сохранения модели чата {chat_id}: {e}")
+
+async def load_chat_model(chat_data: ChatData) -> bool:
+    """Загружает сохранённую модель, если её сообщения ещё пересекаются с окном чата.
+    
+    Модель могла отстать от сообщений, пришедших после сохранения (в том числе
+    от того, что вызвало загрузку): вышедшие из окна вытесняются, новые дообучает
+    update_model.
+    """
+    file_path = get_model_path(chat_data.chat_id)
+    if not os.path.exists(file_path):
+        return False
+    
+    try:
+        with metrics.timer("lssr_load_seconds", what="model"):
+            async with aiofiles.open(file_path, 'rb') as f:
+                payload = pickle.loads(await f.read())
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать модель чата {chat_data.chat_id}: {e}")
+        return False
+    
+    if payload.get("format") != MODEL_FORMAT:
+        return False
+    trained_total = payload["trained_total"]
+    first_seq = chat_data.messages.first_seq
+    # Сообщений не может быть меньше, чем видела модель, а хотя бы последнее из них
+    # должно остаться в окне, иначе дообучение равносильно сборке с нуля
+    if trained_total > chat_data.messages_total or trained_total < first_seq or not payload["window"]:
+        return False
+    
+    version = payload["model_version"]
+    model = payload["model"]
+    model.evict_through(first_seq - 1)
+    chat_data.model = model
+    chat_data.model_version = version
+    chat_data.saved_model_version = version
+    return True
+
 async def load_all_chats():
     """Загружает все чаты из базы данных"""
+    with metrics.timer("lssr_load_seconds", what="chats", backend=config.STORAGE_BACKEND):
+        await _read_all_chats()
+    
+    # Обновляем статистику
+    bot_stats["total_chats"] = len(chats_data)
+
+async def _read_all_chats():
+    if config.STORAGE_BACKEND == "sqlite":
+        try:
+            records = await get_sqlite_storage().load_chats()
+        except Exception as e:
+            logger.error(f"Ошибка загрузки базы SQLite: {e}")
+            records = []
+        
+        for data in records:
+            if not owns_chat(data["chat_id"]):
+                continue
+            chat = ChatData.from_dict(data)
+            chat.saved_total = chat.messages_total
+            chat.saved_settings = dict(chat.settings)
+            chats_data[chat.chat_id] = chat
+            logger.info(f"Загружен чат {chat.chat_id} с {len(chat.messages)} сообщениями")
+        return
+    
     # Создаем директорию, если её нет
     os.makedirs(config.DB_FOLDER, exist_ok=True)
     
@@ -503,6 +2996,10 @@ async def load_all_chats():
     
     for filename in os.listdir(config.DB_FOLDER):
         if filename.endswith('.json'):
+            # Файлы чатов других шардов не читаем: имя файла - id чата
+            stem = filename[:-len('.json')]
+            if stem.lstrip('-').isdigit() and not owns_chat(int(stem)):
+                continue
             try:
                 file_path = os.path.join(config.DB_FOLDER, filename)
                 async with aiofiles.open(file_path, 'r', encoding='utf-8') as f:
@@ -510,14 +3007,52 @@ async def load_all_chats():
                     chat_id = data['chat_id']
                     chats_data[chat_id] = ChatData.from_dict(data)
                     
-                    chats_data[chat_id].update_model(force=True)
-                    
+                    # Модель загрузится лениво, при первой попытке генерации
                     logger.info(f"Загружен чат {chat_id} с {len(chats_data[chat_id].messages)} сообщениями")
             except Exception as e:
                 logger.error(f"Ошибка загрузки файла {filename}: {e}")
+
+async def refill_sentence_pools():
+    """Пополняет пулы готовых предложений у молчащих чатов с моделью в памяти"""
+    budget = config.POOL_REFILL_BATCH
+    now = time.time()
     
-    # Обновляем статистику
-    bot_stats["total_chats"] = len(chats_data)
+    for chat_id in model_cache.chat_ids():
+        chat_data = chats_data.get(chat_id)
+        model = model_cache.peek(chat_id)
+        if not chat_data or model is None or not chat_data.can_generate():
+            continue
+        if now - chat_data.last_activity < config.POOL_IDLE_SECONDS:
+            continue
+        
+        if chat_data.pool_version != chat_data.model_version:
+            chat_data.sentence_pool.clear()
+            chat_data.pool_version = chat_data.model_version
+        
+        needed = min(chat_data.pool_target() - len(chat_data.sentence_pool), budget)
+        while needed > 0:
+            step = min(needed, config.POOL_REFILL_STEP)
+            needed -= step
+            budget -= step
+            chat_data.sentence_pool.extend(generate_model_sentences(model, step))
+            # Отдаём управление циклу событий между шагами, чтобы большие чаты не держали очереди
+            await asyncio.sleep(0)
+            # Пока ждали, чат мог ожить или получить новую модель
+            if chat_data.pool_version != chat_data.model_version or time.time() - chat_data.last_activity < config.POOL_IDLE_SECONDS:
+                break
+        
+        if budget <= 0:
+            break
+
+async def pool_refiller():
+    """Фоновая задача пополнения пулов предложений"""
+    while True:
+        await asyncio.sleep(config.POOL_REFILL_INTERVAL)
+        
+        try:
+            await refill_sentence_pools()
+        except Exception as e:
+            logger.error(f"Ошибка пополнения пулов предложений: {e}")
 
 async def auto_saver():
     """Фоновая задача для автосохранения"""
@@ -525,12 +3060,17 @@ async def auto_saver():
         await asyncio.sleep(config.SAVE_INTERVAL)
         
         try:
-            save_count = 0
-            for chat_id in list(chats_data.keys()):
-                await save_chat_data(chat_id)
-                save_count += 1
+            started = time.time()
+            save_count, bytes_written = await flush_dirty_chats()
+            await flush_models()
             
-            logger.debug(f"Автосохранение завершено, сохранено {save_count} чатов")
+            if save_count:
+                logger.info(
+                    f"Автосохранение завершено: {save_count} из {len(chats_data)} чатов, "
+                    f"{bytes_written / 1024:.1f} КБ за {time.time() - started:.2f} с"
+                )
+            else:
+                logger.debug("Автосохранение: изменённых чатов нет")
         except Exception as e:
             logger.error(f"Ошибка автосохранения: {e}")
 
@@ -564,7 +3104,8 @@ async def cmd_start(message: Message):
         f"/import - импорт данных (админы)\n"
         f"/disable - отключить бота (админы)\n"
         f"/enable - включить бота (админы)\n"
-        f"/revolution - революционный режим\n\n"
+        f"/revolution - революционный режим\n"
+        f"/triggers - слова, на которые бот отзывается (админы)\n\n"
         f"<i>Для изменения настроек требуется быть администратором Telegram чата!</i>\n\n"
         f"<i>Да здравствует коллективное сознание пролетариата!</i>",
         reply_markup=keyboard
@@ -646,20 +3187,9 @@ async def cmd_train(message: Message):
         )
         return
     
-    await message.answer("🔄 <b>Начинаю обучение модели...</b>")
-    
-    success = chat_data.update_model(force=True)
-    
-    if success:
-        await message.answer(
-            f"✅ <b>Модель успешно обучена!</b>\n\n"
-            f"• Сообщений использовано: {min(len(chat_data.messages), chat_data.settings['max_messages'])}\n"
-            f"• Версия модели: <code>{chat_data.model_version}</code>\n"
-            f"• Настроение: <code>{chat_data.mood}</code>\n\n"
-            f"<i>Модель готова к генерации революционных текстов!</i>"
-        )
-    else:
-        await message.answer("❌ <b>Ошибка обучения модели!</b>\n\nПопробуйте позже или добавьте больше сообщений.")
+    status = await message.answer("🔄 <b>Начинаю обучение модели...</b>")
+    # Сборка идёт в пуле, а очередь чата тем временем обрабатывает следующие сообщения
+    await start_training(chat_data, status, "\n<i>Модель готова к генерации революционных текстов!</i>")
 
 @dp.message_handler(commands=['revolution', 'революция'])
 async def cmd_revolution(message: Message):
@@ -699,7 +3229,7 @@ async def cmd_revolution(message: Message):
     chat_data.settings['revolutionary_mode'] = True
     chat_data.mood = "revolutionary"
     chat_data.settings['revolutionary_intensity'] = 3
-    chat_data.update_model(force=True)
+    await train_chat_model(chat_data, force=True)
     
     await save_chat_data(chat_id)
     
@@ -849,7 +3379,7 @@ async def cmd_export(message: Message):
     export_text += f"Революционный режим: {'Да' if chat_data.settings['revolutionary_mode'] else 'Нет'}\n"
     export_text += "=" * 50 + "\n\n"
     
-    for i, msg in enumerate(chat_data.messages[-1000:], 1):
+    for i, msg in enumerate(chat_data.messages.tail(1000), 1):
         export_text += f"{i}. {msg}\n"
     
     # Сохраняем во временный файл в data директории
@@ -924,14 +3454,14 @@ async def process_import_file(message: Message, state: FSMContext):
         for line in lines_to_import:
             line = line.strip()
             if line and len(line) > 2:
-                chat_data.messages.append(line)
+                chat_data.add_message(line)
                 imported_count += 1
         
         # Удаляем временный файл
         os.remove(file_path)
         
         # Переобучаем модель
-        chat_data.update_model(force=True)
+        await train_chat_model(chat_data, force=True)
         await save_chat_data(message.chat.id)
         
         await message.answer(
@@ -947,6 +3477,51 @@ async def process_import_file(message: Message, state: FSMContext):
     
     await state.finish()
 
+@dp.message_handler(commands=['triggers', 'триггеры'])
+async def cmd_triggers(message: Message):
+    """Слова-триггеры чата - изменять могут только администраторы Telegram"""
+    chat_id = message.chat.id
+    chat_data = chats_data.get(chat_id)
+    
+    if not chat_data:
+        await message.answer("Чат не инициализирован!")
+        return
+    
+    args = message.get_args().strip()
+    
+    if not args:
+        custom = chat_data.settings['trigger_words']
+        await message.answer(
+            f"🔔 <b>Слова-триггеры</b>\n\n"
+            f"Стандартные: <code>{', '.join(config.TRIGGER_WORDS)}</code>\n"
+            f"Собственные: <code>{', '.join(custom) if custom else 'нет'}</code>\n\n"
+            f"<i>Изменить: /triggers слово1, слово2\n"
+            f"Очистить: /triggers -</i>"
+        )
+        return
+    
+    if not await is_telegram_admin(chat_id, message.from_user.id):
+        await message.answer("⚠️ Только администраторы Telegram могут изменять слова-триггеры!")
+        return
+    
+    if args == '-':
+        words = []
+    else:
+        words = []
+        for word in args.split(','):
+            word = word.strip().lower()
+            if len(word) >= 2 and word not in words:
+                words.append(word)
+        words = words[:config.MAX_CUSTOM_TRIGGERS]
+    
+    chat_data.settings['trigger_words'] = words
+    await save_chat_data(chat_id)
+    
+    await message.answer(
+        f"✅ <b>Слова-триггеры обновлены!</b>\n\n"
+        f"Собственные: <code>{', '.join(words) if words else 'нет'}</code>"
+    )
+
 @dp.message_handler(commands=['manage', 'управление'])
 async def cmd_manage(message: Message):
     """Управление ботом - только для администраторов Telegram"""
@@ -980,35 +3555,48 @@ async def cmd_statall(message: Message):
         await message.answer("⚠️ Эта команда только для администраторов бота!")
         return
     
+    # Собираем статистику по чатам со всех шардов
+    stats = merge_stats(await fan_out("stats"))
+    
     # Рассчитываем время работы
-    uptime_seconds = int(time.time() - bot_stats["start_time"])
+    uptime_seconds = int(time.time() - stats["start_time"])
     uptime_str = format_time_remaining(uptime_seconds)
     
-    # Собираем статистику по чатам
-    total_messages = sum(len(chat.messages) for chat in chats_data.values())
-    active_chats = sum(1 for chat in chats_data.values() if time.time() - chat.last_activity < 86400)
-    trained_chats = sum(1 for chat in chats_data.values() if chat.model is not None)
+    lookups = stats.get("cache_hits", 0) + stats.get("cache_misses", 0)
+    hit_rate = stats.get("cache_hits", 0) / lookups if lookups else 0.0
     
     stats_text = (
         f"👑 <b>Статистика бота {config.BOT_NAME}</b>\n\n"
         f"<b>Общая статистика:</b>\n"
         f"• Версия бота: <code>{config.BOT_VERSION}</code>\n"
         f"• Время работы: <code>{uptime_str}</code>\n"
-        f"• Всего чатов: <code>{bot_stats['total_chats']}</code>\n"
-        f"• Активных чатов (24ч): <code>{active_chats}</code>\n"
-        f"• Обученных чатов: <code>{trained_chats}</code>\n"
-        f"• Всего сообщений обработано: <code>{bot_stats['total_messages_processed']}</code>\n"
-        f"• Сообщений в базе: <code>{total_messages}</code>\n"
-        f"• Сгенерировано сообщений: <code>{bot_stats['messages_generated']}</code>\n"
-        f"• Выполнено команд: <code>{bot_stats['commands_executed']}</code>\n\n"
+        f"• Всего чатов: <code>{stats.get('total_chats', 0)}</code>\n"
+        f"• Активных чатов (24ч): <code>{stats.get('active_chats', 0)}</code>\n"
+        f"• Обученных чатов: <code>{stats.get('trained_chats', 0)}</code>\n"
+        f"• Всего сообщений обработано: <code>{stats.get('total_messages_processed', 0)}</code>\n"
+        f"• Сообщений в базе: <code>{stats.get('total_messages', 0)}</code>\n"
+        f"• Сгенерировано сообщений: <code>{stats.get('messages_generated', 0)}</code>\n"
+        f"• Выполнено команд: <code>{stats.get('commands_executed', 0)}</code>\n\n"
+        f"<b>Кэш моделей:</b>\n"
+        f"• Моделей в памяти: <code>{stats.get('models_resident', 0)}</code>\n"
+        f"• Память моделей: <code>{stats.get('models_bytes', 0) / 1024 / 1024:.1f} / "
+        f"{config.MODEL_CACHE_MB * max(stats['shards'], 1)} МБ</code>\n"
+        f"• Попадания в кэш: <code>{hit_rate * 100:.1f}%</code> "
+        f"(<code>{stats.get('cache_hits', 0)}</code> / <code>{lookups}</code>)\n"
+        f"• Вытеснено моделей: <code>{stats.get('cache_evictions', 0)}</code>\n\n"
+        f"<b>Словарь слов:</b>\n"
+        f"• Размер словаря: <code>{stats.get('vocabulary_words', 0)}</code>\n"
+        f"• Память словаря: <code>{stats.get('vocabulary_bytes', 0) / 1024 / 1024:.1f} МБ</code>\n"
+        f"• Сэкономлено памяти: <code>≈{stats.get('vocabulary_saved_bytes', 0) / 1024 / 1024:.1f} МБ</code>\n\n"
     )
     
+    if is_sharded():
+        stats_text += f"<b>Шарды:</b> <code>{stats['shards'] - stats['failed_shards']} / {stats['shards']}</code> ответили\n\n"
+    
     # Добавляем топ чатов по активности
-    if chats_data:
-        top_chats = sorted(chats_data.items(), key=lambda x: len(x[1].messages), reverse=True)[:10]
-        
+    if stats["top_chats"]:
         stats_text += f"<b>Топ-10 чатов по сообщениям:</b>\n"
-        for i, (chat_id, chat_data_item) in enumerate(top_chats, 1):
+        for i, (chat_id, message_count) in enumerate(stats["top_chats"], 1):
             chat_info = ""
             try:
                 chat = await bot.get_chat(chat_id)
@@ -1016,7 +3604,7 @@ async def cmd_statall(message: Message):
             except:
                 chat_info = f"Чат {chat_id}"
             
-            stats_text += f"{i}. {chat_info}: {len(chat_data_item.messages)} сообщений\n"
+            stats_text += f"{i}. {chat_info}: {message_count} сообщений\n"
     
     await message.answer(stats_text)
 
@@ -1032,26 +3620,40 @@ async def cmd_broadcast(message: Message):
         await message.answer("⚠️ Укажите сообщение для рассылки!")
         return
     
-    await message.answer(f"🔄 <b>Начинаю рассылку сообщения...</b>\n\nСообщение: {args[:100]}...")
+    # Каждый шард рассылает своим чатам; новая рассылка не начинается, пока идёт прежняя
+    if merge_progress(await fan_out("broadcast_status"))["running"]:
+        await message.answer("⚠️ Рассылка уже идёт!\n\nХод рассылки: /broadcast_status\nОстановить: /broadcast_stop")
+        return
     
-    sent_count = 0
-    failed_count = 0
+    progress_message = await message.answer(f"🔄 <b>Начинаю рассылку сообщения...</b>\n\nСообщение: {args[:100]}...")
+    notify = [progress_message.chat.id, progress_message.message_id]
+    await fan_out("broadcast", {"id": secrets.token_hex(4), "text": args, "notify": notify})
+    spawn_broadcast_watcher(*notify)
+
+@dp.message_handler(commands=['broadcast_status', 'рассылка_статус'])
+async def cmd_broadcast_status(message: Message):
+    """Ход последней рассылки - только для администраторов бота"""
+    if not await is_bot_admin(message.from_user.id):
+        await message.answer("⚠️ Эта команда только для администраторов бота!")
+        return
     
-    for chat_id in chats_data.keys():
-        try:
-            await bot.send_message(chat_id, f"📢 <b>Объявление от администрации:</b>\n\n{args}")
-            sent_count += 1
-            await asyncio.sleep(0.1)  # Задержка чтобы не превысить лимиты
-        except Exception as e:
-            logger.error(f"Ошибка рассылки в чат {chat_id}: {e}")
-            failed_count += 1
+    progress = merge_progress(await fan_out("broadcast_status"))
+    if not progress["total"] and not progress["failed_shards"]:
+        await message.answer("📢 Рассылок ещё не было.")
+        return
+    await message.answer(format_broadcast_progress(progress))
+
+@dp.message_handler(commands=['broadcast_stop', 'рассылка_стоп'])
+async def cmd_broadcast_stop(message: Message):
+    """Остановка рассылки - только для главного администратора"""
+    if message.from_user.id != config.MAIN_ADMIN_ID:
+        await message.answer("⚠️ Эта команда только для главного администратора!")
+        return
     
-    await message.answer(
-        f"✅ <b>Рассылка завершена!</b>\n\n"
-        f"• Отправлено: <code>{sent_count}</code>\n"
-        f"• Не отправлено: <code>{failed_count}</code>\n"
-        f"• Всего чатов: <code>{len(chats_data)}</code>"
-    )
+    if not merge_progress(await fan_out("broadcast_status"))["running"]:
+        await message.answer("⚠️ Сейчас нет рассылки!")
+        return
+    await message.answer(format_broadcast_progress(merge_progress(await fan_out("broadcast_stop"))))
 
 @dp.message_handler(commands=['getchat', 'чат'])
 async def cmd_getchat(message: Message):
@@ -1067,7 +3669,9 @@ async def cmd_getchat(message: Message):
     
     try:
         chat_id = int(args)
-        chat_data_item = chats_data.get(chat_id)
+        # Чат лежит на одном из шардов
+        found = [result["chat"] for result in await fan_out("getchat", {"chat_id": chat_id}) if result.get("chat")]
+        chat_data_item = found[0] if found else None
         
         if not chat_data_item:
             await message.answer(f"❌ Чат <code>{chat_id}</code> не найден в базе!")
@@ -1085,18 +3689,18 @@ async def cmd_getchat(message: Message):
             f"📊 <b>Информация о чате:</b>\n\n"
             f"ID: <code>{chat_id}</code>\n"
             f"{chat_info}\n"
-            f"Сообщений в базе: <code>{len(chat_data_item.messages)}</code>\n"
-            f"Всего обработано: <code>{chat_data_item.message_count}</code>\n"
-            f"Настроение: <code>{chat_data_item.mood}</code>\n"
-            f"Революционный режим: {'✅' if chat_data_item.settings['revolutionary_mode'] else '❌'}\n"
-            f"Обучение: {'✅' if chat_data_item.settings['learning_enabled'] else '❌'}\n"
-            f"Шанс ответа: <code>{chat_data_item.get_response_chance():.1f}%</code>\n"
-            f"Последняя активность: <code>{datetime.fromtimestamp(chat_data_item.last_activity).strftime('%d.%m.%Y %H:%M')}</code>\n"
+            f"Сообщений в базе: <code>{chat_data_item['messages']}</code>\n"
+            f"Всего обработано: <code>{chat_data_item['message_count']}</code>\n"
+            f"Настроение: <code>{chat_data_item['mood']}</code>\n"
+            f"Революционный режим: {'✅' if chat_data_item['revolutionary_mode'] else '❌'}\n"
+            f"Обучение: {'✅' if chat_data_item['learning_enabled'] else '❌'}\n"
+            f"Шанс ответа: <code>{chat_data_item['response_chance']:.1f}%</code>\n"
+            f"Последняя активность: <code>{datetime.fromtimestamp(chat_data_item['last_activity']).strftime('%d.%m.%Y %H:%M')}</code>\n"
         )
         
-        if chat_data_item.off_until > time.time():
-            remaining = chat_data_item.off_until - time.time()
-            stats_text += f"Отключен до: <code>{datetime.fromtimestamp(chat_data_item.off_until).strftime('%d.%m.%Y %H:%M')}</code>\n"
+        if chat_data_item['off_until'] > time.time():
+            remaining = chat_data_item['off_until'] - time.time()
+            stats_text += f"Отключен до: <code>{datetime.fromtimestamp(chat_data_item['off_until']).strftime('%d.%m.%Y %H:%M')}</code>\n"
             stats_text += f"Осталось: <code>{format_time_remaining(int(remaining))}</code>\n"
         
         await message.answer(stats_text)
@@ -1104,6 +3708,62 @@ async def cmd_getchat(message: Message):
     except ValueError:
         await message.answer("⚠️ Неверный ID чата! Укажите числовой ID.")
 
+@dp.message_handler(commands=['profile', 'профиль'])
+async def cmd_profile(message: Message):
+    """Сэмплирующий профилировщик на N секунд - только для администраторов бота"""
+    global active_profiler
+    if not await is_bot_admin(message.from_user.id):
+        await message.answer("⚠️ Эта команда только для администраторов бота!")
+        return
+    
+    args = message.get_args()
+    try:
+        seconds = int(args) if args else 30
+    except ValueError:
+        await message.answer("⚠️ Укажите длительность в секундах: <code>/profile 30</code>")
+        return
+    seconds = max(1, min(seconds, config.PROFILE_MAX_SECONDS))
+    
+    # Проверка и захват без await между ними: команды из разных чатов идут параллельно
+    if active_profiler is not None:
+        await message.answer("⏳ Профилировщик уже запущен, дождитесь результата.")
+        return
+    profiler = SamplingProfiler(config.PROFILE_INTERVAL)
+    active_profiler = profiler
+    
+    try:
+        await message.answer(f"🔬 Профилирую {seconds} с, результат пришлю файлом.")
+    except Exception:
+        active_profiler = None
+        raise
+    # Обработчик не ждёт окончания замера, чтобы не попасть в него самому
+    asyncio.create_task(run_profiler(profiler, message.chat.id, seconds))
+
+async def run_profiler(profiler: SamplingProfiler, chat_id: int, seconds: int):
+    """Снимает профиль основного процесса и отправляет свёрнутые стеки документом"""
+    global active_profiler
+    try:
+        profiler.start()
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+        active_profiler = None
+    
+    if not profiler.samples:
+        await bot.send_message(chat_id, "❌ Профилировщик не собрал ни одного сэмпла.")
+        return
+    
+    filename = f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded"
+    await bot.send_document(
+        chat_id,
+        types.InputFile(io.BytesIO(profiler.collapsed().encode("utf-8")), filename=filename),
+        caption=(
+            f"🔬 <b>Профиль за {seconds} с</b>\n\n"
+            f"Сэмплов: {profiler.samples}, шаг {config.PROFILE_INTERVAL * 1000:.0f} мс\n"
+            f"<i>Свёрнутые стеки: flamegraph.pl или speedscope.app</i>"
+        )
+    )
+
 # ==================== CALLBACK ОБРАБОТЧИКИ ====================
 @dp.callback_query_handler(lambda c: c.data == 'stats')
 async def callback_stats(callback_query: CallbackQuery):
@@ -1324,7 +3984,7 @@ async def process_revolution(callback_query: CallbackQuery):
         chat_data.settings['revolutionary_mode'] = True
         chat_data.mood = "revolutionary"
         chat_data.settings['revolutionary_intensity'] = 3
-        chat_data.update_model(force=True)
+        await train_chat_model(chat_data, force=True)
         
         await save_chat_data(chat_id)
         await callback_query.answer(f"⚡ {random.choice(config.REVOLUTIONARY_GREETINGS)}")
@@ -1342,7 +4002,7 @@ async def process_revolution(callback_query: CallbackQuery):
     elif action == 'intensity_up':
         if chat_data.settings['revolutionary_intensity'] < 5:
             chat_data.settings['revolutionary_intensity'] += 1
-            chat_data.update_model(force=True)
+            await train_chat_model(chat_data, force=True)
             await save_chat_data(chat_id)
             await callback_query.answer(f"🔥 Интенсивность увеличена до {chat_data.settings['revolutionary_intensity']}/5")
             await revolution_menu_callback(callback_query)
@@ -1352,7 +4012,7 @@ async def process_revolution(callback_query: CallbackQuery):
     elif action == 'intensity_down':
         if chat_data.settings['revolutionary_intensity'] > 1:
             chat_data.settings['revolutionary_intensity'] -= 1
-            chat_data.update_model(force=True)
+            await train_chat_model(chat_data, force=True)
             await save_chat_data(chat_id)
             await callback_query.answer(f"💧 Интенсивность уменьшена до {chat_data.settings['revolutionary_intensity']}/5")
             await revolution_menu_callback(callback_query)
@@ -1399,27 +4059,23 @@ async def bot_stats_detailed_callback(callback_query: CallbackQuery):
         await callback_query.answer("⚠️ Эта информация только для администраторов бота!")
         return
     
-    uptime_seconds = int(time.time() - bot_stats["start_time"])
+    stats = merge_stats(await fan_out("stats"))
+    uptime_seconds = int(time.time() - stats["start_time"])
     uptime_str = format_time_remaining(uptime_seconds)
     
-    total_messages = sum(len(chat.messages) for chat in chats_data.values())
-    active_chats = sum(1 for chat in chats_data.values() if time.time() - chat.last_activity < 86400)
-    trained_chats = sum(1 for chat in chats_data.values() if chat.model is not None)
-    revolutionary_chats = sum(1 for chat in chats_data.values() if chat.settings['revolutionary_mode'])
-    
     text = (
         f"📈 <b>Подробная статистика бота</b>\n\n"
         f"<b>Общие показатели:</b>\n"
         f"• Время работы: {uptime_str}\n"
-        f"• Всего чатов: {len(chats_data)}\n"
-        f"• Активных чатов (24ч): {active_chats}\n"
-        f"• Обученных чатов: {trained_chats}\n"
-        f"• Чатов в революц. режиме: {revolutionary_chats}\n\n"
+        f"• Всего чатов: {stats.get('total_chats', 0)}\n"
+        f"• Активных чатов (24ч): {stats.get('active_chats', 0)}\n"
+        f"• Обученных чатов: {stats.get('trained_chats', 0)}\n"
+        f"• Чатов в революц. режиме: {stats.get('revolutionary_chats', 0)}\n\n"
         f"<b>Сообщения:</b>\n"
-        f"• Всего обработано: {bot_stats['total_messages_processed']}\n"
-        f"• Сообщений в базе: {total_messages}\n"
-        f"• Сгенерировано: {bot_stats['messages_generated']}\n"
-        f"• Выполнено команд: {bot_stats['commands_executed']}\n\n"
+        f"• Всего обработано: {stats.get('total_messages_processed', 0)}\n"
+        f"• Сообщений в базе: {stats.get('total_messages', 0)}\n"
+        f"• Сгенерировано: {stats.get('messages_generated', 0)}\n"
+        f"• Выполнено команд: {stats.get('commands_executed', 0)}\n\n"
         f"<b>Система:</b>\n"
         f"• Версия Python: 3.8+\n"
         f"• Библиотека aiogram: {aiogram.__version__}\n"
@@ -1451,18 +4107,8 @@ async def callback_retrain(callback_query: CallbackQuery):
         return
     
     await callback_query.answer("🔄 Начинаю обучение модели...")
-    
-    success = chat_data.update_model(force=True)
-    
-    if success:
-        await callback_query.message.answer(
-            f"✅ <b>Модель успешно обучена!</b>\n\n"
-            f"• Сообщений использовано: {min(len(chat_data.messages), chat_data.settings['max_messages'])}\n"
-            f"• Версия модели: <code>{chat_data.model_version}</code>\n"
-            f"• Настроение: <code>{chat_data.mood}</code>\n"
-        )
-    else:
-        await callback_query.message.answer("❌ <b>Ошибка обучения модели!</b>")
+    status = await callback_query.message.answer("🔄 <b>Начинаю обучение модели...</b>")
+    await start_training(chat_data, status)
 
 @dp.callback_query_handler(lambda c: c.data == 'manage')
 async def callback_manage(callback_query: CallbackQuery):
@@ -1587,7 +4233,8 @@ async def callback_clear_history(callback_query: CallbackQuery):
     
     if chat_data:
         message_count = len(chat_data.messages)
-        chat_data.messages = []
+        cancel_training(chat_id)
+        chat_data.messages.clear()
         chat_data.revolutionary_phrases_used = []
         chat_data.model = None
         chat_data.model_version = 0
@@ -1609,17 +4256,21 @@ async def bot_chats_list_callback(callback_query: CallbackQuery):
         await callback_query.answer("⚠️ Эта информация только для администраторов бота!")
         return
     
-    if not chats_data:
+    # Каждый шард отдаёт свои чаты
+    all_chats = [chat for result in await fan_out("list_chats") for chat in result.get("chats", [])]
+    
+    if not all_chats:
         await callback_query.message.edit_text("📭 <b>Список чатов пуст</b>\n\nБот ещё не добавлен ни в один чат.")
         return
     
-    text = f"👥 <b>Список чатов ({len(chats_data)}):</b>\n\n"
+    text = f"👥 <b>Список чатов ({len(all_chats)}):</b>\n\n"
     
     # Группируем чаты по типу
     groups = []
     privates = []
     
-    for chat_id, chat_data_item in chats_data.items():
+    for chat_data_item in all_chats:
+        chat_id = chat_data_item['chat_id']
         try:
             chat = await bot.get_chat(chat_id)
             chat_name = chat.title if hasattr(chat, 'title') else chat.first_name
@@ -1636,16 +4287,16 @@ async def bot_chats_list_callback(callback_query: CallbackQuery):
         text += "<b>Группы и каналы:</b>\n"
         for i, (chat_id, chat_name, chat_type, chat_data_item) in enumerate(groups[:20], 1):
             text += f"{i}. {chat_name} (ID: {chat_id})\n"
-            text += f"   📝 Сообщений: {len(chat_data_item.messages)}\n"
-            text += f"   🔧 Революция: {'✅' if chat_data_item.settings['revolutionary_mode'] else '❌'}\n"
-            text += f"   🕒 Активность: {datetime.fromtimestamp(chat_data_item.last_activity).strftime('%d.%m %H:%M')}\n\n"
+            text += f"   📝 Сообщений: {chat_data_item['messages']}\n"
+            text += f"   🔧 Революция: {'✅' if chat_data_item['revolutionary_mode'] else '❌'}\n"
+            text += f"   🕒 Активность: {datetime.fromtimestamp(chat_data_item['last_activity']).strftime('%d.%m %H:%M')}\n\n"
     
     if privates:
         text += "\n<b>Личные сообщения:</b>\n"
         for i, (chat_id, chat_name, chat_type, chat_data_item) in enumerate(privates[:10], 1):
             text += f"{i}. {chat_name} (ID: {chat_id})\n"
-            text += f"   📝 Сообщений: {len(chat_data_item.messages)}\n"
-            text += f"   🕒 Последнее: {datetime.fromtimestamp(chat_data_item.last_activity).strftime('%d.%m %H:%M')}\n\n"
+            text += f"   📝 Сообщений: {chat_data_item['messages']}\n"
+            text += f"   🕒 Последнее: {datetime.fromtimestamp(chat_data_item['last_activity']).strftime('%d.%m %H:%M')}\n\n"
     
     keyboard = InlineKeyboardMarkup()
     keyboard.add(InlineKeyboardButton("🔙 Назад в админку", callback_data="admin_panel"))
@@ -1673,15 +4324,13 @@ async def bot_reload_db_callback(callback_query: CallbackQuery):
         await callback_query.answer("⚠️ Эта функция только для администраторов бота!")
         return
     
-    old_count = len(chats_data)
-    chats_data.clear()
-    await load_all_chats()
+    results = [result for result in await fan_out("reload") if "error" not in result]
     
     await callback_query.message.edit_text(
         f"🔄 <b>База данных перезагружена!</b>\n\n"
-        f"Было чатов: <code>{old_count}</code>\n"
-        f"Стало чатов: <code>{len(chats_data)}</code>\n"
-        f"Загружено сообщений: <code>{sum(len(chat.messages) for chat in chats_data.values())}</code>"
+        f"Было чатов: <code>{sum(result['old_chats'] for result in results)}</code>\n"
+        f"Стало чатов: <code>{sum(result['chats'] for result in results)}</code>\n"
+        f"Загружено сообщений: <code>{sum(result['messages'] for result in results)}</code>"
     )
     await callback_query.answer()
 
@@ -1696,6 +4345,8 @@ async def bot_broadcast_callback(callback_query: CallbackQuery):
         "📢 <b>Рассылка сообщения</b>\n\n"
         "Для рассылки используйте команду:\n"
         "<code>/broadcast Ваше сообщение</code>\n\n"
+        "Ход рассылки: /broadcast_status\n"
+        "Остановить: /broadcast_stop\n\n"
         "<i>Эта функция доступна только главному администратору.</i>"
     )
     await callback_query.answer()
@@ -1768,63 +4419,62 @@ async def handle_message(message: Message):
     cleaned_text = text.strip()
     
     if chat_data.settings['learning_enabled']:
-        chat_data.messages.append(cleaned_text)
+        chat_data.add_message(cleaned_text)
         
-        if len(chat_data.messages) % 50 == 0:
-            chat_data.update_model(force=False)
-        
-        if len(chat_data.messages) > chat_data.settings['max_messages'] * 2:
-            chat_data.messages = chat_data.messages[-chat_data.settings['max_messages']:]
+        if chat_data.messages_total % 50 == 0:
+            await train_chat_model(chat_data, wait=False)
     
-    bot_username = (await bot.get_me()).username
-    triggered = any([
-        f"@{bot_username}".lower() in cleaned_text.lower(),
-        'председатель' in cleaned_text.lower(),
-        'лсср' in cleaned_text.lower(),
-        message.reply_to_message and message.reply_to_message.from_user.id == bot.id
-    ])
+    bot_username = (await get_bot_identity()).username
+    triggered = bool(
+        is_triggered(chat_data, cleaned_text, bot_username)
+        or (message.reply_to_message and message.reply_to_message.from_user.id == bot.id)
+    )
     
     if not should_respond(chat_data, message, triggered):
         return
     
-    chat_data.update_model()
+    if await ensure_model(chat_data) is None:
+        return
     
     generated = generate_message(chat_data, context=cleaned_text[:50])
     
     if not generated:
         return
     
+    schedule_reply(message, chat_data, generated)
+
+def schedule_reply(message: Message, chat_data: ChatData, generated: str):
+    """Ставит ответ в очередь отправки с задержкой настроения и имитацией набора текста"""
+    chat_id = message.chat.id
     mood_settings = config.MOODS.get(chat_data.mood, config.MOODS['neutral'])
-    min_delay, max_delay = mood_settings['response_time']
-    
-    await asyncio.sleep(random.uniform(min_delay, max_delay))
+    typing_at = time.monotonic() + random.uniform(*mood_settings['response_time'])
+    messages_seen = chat_data.messages_total
     
-    await bot.send_chat_action(chat_id, 'typing')
-    await asyncio.sleep(random.uniform(0.5, 1.5))
+    def relevant() -> bool:
+        # Бота выключили или разговор ушёл далеко вперёд - ответ уже ни к чему
+        return (chats_data.get(chat_id) is chat_data and chat_data.can_generate()
+                and chat_data.messages_total - messages_seen < config.REPLY_STALE_MESSAGES)
     
-    try:
-        if chat_data.settings['allow_replies'] and random.random() < 0.5:
-            await message.reply(
-                generated,
-                disable_notification=True,
-                allow_sending_without_reply=True
-            )
-        else:
-            await message.answer(
-                generated,
-                disable_notification=True
-            )
-        
+    def on_sent():
         bot_stats["messages_generated"] += 1
-        
-    except Exception as e:
-        logger.error(f"Ошибка отправки сообщения: {e}")
+        metrics.inc("lssr_replies_total", chat=metrics.chat_label(chat_id))
+        chat_data.reply_times.append(time.time())
+    
+    send_queue.schedule(OutgoingMessage(
+        chat_id,
+        generated,
+        due=typing_at + random.uniform(*config.TYPING_DELAY),
+        typing_at=typing_at,
+        reply_to=message.message_id if chat_data.settings['allow_replies'] and random.random() < 0.5 else None,
+        relevant=relevant,
+        on_sent=on_sent
+    ))
 
 # ==================== ОБРАБОТЧИКИ ДОБАВЛЕНИЯ В ЧАТ ====================
 @dp.message_handler(content_types=['new_chat_members'])
 async def on_new_members(message: Message):
     """Обработчик добавления новых участников"""
-    bot_id = (await bot.get_me()).id
+    bot_id = (await get_bot_identity()).id
     
     if any(member.id == bot_id for member in message.new_chat_members):
         welcome_text = (
@@ -1846,18 +4496,781 @@ async def on_new_members(message: Message):
         
         await message.answer(welcome_text)
 
+# ==================== ВЕБХУК ====================
+class WebhookServer:
+    """Приём обновлений по вебхуку: Telegram получает ответ сразу, обработку ведут воркеры"""
+    
+    SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+    
+    def __init__(self, dispatcher: Dispatcher, path: str, secret: str, workers: int, queue_size: int):
+        if not secret:
+            raise ValueError("Вебхук без секрета принимал бы поддельные обновления")
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret = secret
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.received = 0
+        self.rejected = 0
+        self._runner: Optional[web.AppRunner] = None
+        self._tasks: List[asyncio.Task] = []
+    
+    async def handle(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(self.SECRET_HEADER, ""), self.secret):
+            self.rejected += 1
+            return web.Response(status=403)
+        try:
+            update = types.Update.to_object(await request.json())
+        except (ValueError, TypeError):
+            self.rejected += 1
+            return web.Response(status=400)
+        
+        # Ждём места в очереди: ответ задерживается, и Telegram сам придержит следующие обновления
+        await self.queue.put(update)
+        self.received += 1
+        return web.Response()
+    
+    async def worker(self):
+        """Берёт обновления из очереди и прогоняет их через диспетчер"""
+        Bot.set_current(bot)
+        Dispatcher.set_current(self.dispatcher)
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.process(update)
+            except Exception as e:
+                logger.exception(f"Ошибка обработки обновления {update.update_id}: {e}")
+            finally:
+                self.queue.task_done()
+    
+    async def process(self, update: types.Update):
+        # Воркер только раскладывает обновления по очередям чатов и не ждёт обработки,
+        # иначе один шумный чат занял бы всех воркеров
+        future = await self.dispatcher.submit(update)
+        future.add_done_callback(functools.partial(self._log_failure, update.update_id))
+    
+    @staticmethod
+    def _log_failure(update_id: int, future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.opt(exception=future.exception()).error(f"Ошибка обработки обновления {update_id}")
+    
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+    
+    async def start(self, host: str, port: int):
+        self._tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Вебхук слушает {host}:{port}{self.path}, воркеров: {self.workers}")
+    
+    async def stop(self, timeout: float = 30):
+        """Перестаёт принимать обновления и даёт воркерам доделать очередь"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+            await asyncio.wait_for(self.dispatcher.drain(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Вебхук остановлен с {self.queue.qsize() + self.dispatcher.queued()} необработанными обновлениями"
+            )
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+async def register_webhook():
+    """Регистрирует вебхук в Telegram, не сбрасывая накопившиеся обновления"""
+    # set_webhook в aiogram 2.20 не знает secret_token, поэтому запрос собирается вручную
+    payload = {
+        "url": config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH,
+        "max_connections": config.WEBHOOK_WORKERS,
+        "secret_token": config.WEBHOOK_SECRET
+    }
+    await bot.request("setWebhook", payload)
+    logger.info(f"Вебхук зарегистрирован: {payload['url']}")
+
+def ensure_webhook_secret() -> bool:
+    """Проверяет секрет вебхука: без него любой, кто достучится до порта, подделает обновления"""
+    if config.WEBHOOK_SECRET:
+        return True
+    if not config.WEBHOOK_URL:
+        logger.error("WEBHOOK_SECRET не задан: укажите его и передайте тот же secret_token в setWebhook")
+        return False
+    # Вебхук регистрирует сам бот, поэтому секрет можно придумать на этот запуск
+    config.WEBHOOK_SECRET = secrets.token_urlsafe(32)
+    logger.info("WEBHOOK_SECRET не задан, для вебхука сгенерирован случайный секрет")
+    return True
+
+def stop_event() -> asyncio.Event:
+    """Событие, которое выставляют SIGINT и SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+async def serve_updates(server: WebhookServer, host: str, port: int, register: bool):
+    """Работа бота с приёмом обновлений через server до SIGINT/SIGTERM"""
+    stop = stop_event()
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    await on_startup(dp)
+    try:
+        await server.start(host, port)
+        if register:
+            await register_webhook()
+        await stop.wait()
+    finally:
+        await server.stop()
+        await on_shutdown(dp)
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        await (await bot.get_session()).close()
+
+async def run_webhook():
+    """Работа в режиме вебхука"""
+    if not config.WEBHOOK_URL:
+        logger.warning("WEBHOOK_URL не задан: вебхук в Telegram не регистрируется")
+    server = WebhookServer(dp, config.WEBHOOK_PATH, config.WEBHOOK_SECRET,
+                           config.WEBHOOK_WORKERS, config.WEBHOOK_QUEUE)
+    await serve_updates(server, config.WEBHOOK_HOST, config.WEBHOOK_PORT, bool(config.WEBHOOK_URL))
+
+# ==================== РАССЫЛКА ====================
+class BroadcastJob:
+    """Рассылка по чатам этого процесса с сохранением прогресса.
+    
+    Сообщения уходят параллельно, но не быстрее общей корзины токенов очереди
+    отправки и не раньше интервала чата после его последнего ответа; RetryAfter
+    останавливает корзину на указанное время. Прогресс
+    периодически пишется в файл, и после перезапуска рассылка продолжается с
+    необработанных чатов (повторно могут уйти только сообщения, бывшие в полёте).
+    Чаты, где бота заблокировали или которых больше нет, помечаются и пропускаются.
+    """
+    
+    def __init__(self, job_id: str, text: str, chat_ids: List[int], notify: Optional[List[int]] = None):
+        self.id = job_id
+        self.text = text
+        self.chat_ids = chat_ids
+        self.notify = notify  # [chat_id, message_id] сообщения с прогрессом
+        self.status = "running"  # running / done / cancelled
+        self.position = 0  # Все чаты до этого индекса обработаны
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self._done_ahead: Set[int] = set()  # Обработанные индексы после position
+        self._run_started = time.monotonic()
+        self._run_done = 0  # Сколько было обработано к началу этого запуска
+        self._saved_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+    
+    @property
+    def done(self) -> int:
+        return self.position + len(self._done_ahead)
+    
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "text": self.text,
+            "chat_ids": self.chat_ids,
+            "notify": self.notify,
+            "status": self.status,
+            "position": self.position,
+            "done_ahead": sorted(self._done_ahead),
+            "sent": self.sent,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "started": self.started,
+            "finished": self.finished
+        }
+    
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'BroadcastJob':
+        job = cls(data["id"], data["text"], data["chat_ids"], data.get("notify"))
+        job.status = data.get("status", "running")
+        job.position = data.get("position", 0)
+        job._done_ahead = set(data.get("done_ahead", []))
+        job.sent = data.get("sent", 0)
+        job.failed = data.get("failed", 0)
+        job.skipped = data.get("skipped", 0)
+        job.started = data.get("started", job.started)
+        job.finished = data.get("finished")
+        return job
+    
+    def progress(self) -> Dict:
+        """Состояние рассылки для /broadcast_status и шардов"""
+        elapsed = time.monotonic() - self._run_started
+        return {
+            "id": self.id,
+            "running": int(self.status == "running"),
+            "cancelled": int(self.status == "cancelled"),
+            "total": len(self.chat_ids),
+            "done": self.done,
+            "sent": self.sent,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "rate": (self.done - self._run_done) / elapsed if self.status == "running" and elapsed > 0 else 0,
+            "started": self.started
+        }
+    
+    def start(self):
+        self._run_started = time.monotonic()
+        self._run_done = self.done
+        self._task = asyncio.create_task(self.run())
+    
+    async def run(self):
+        pending = (index for index in range(self.position, len(self.chat_ids)) if index not in self._done_ahead)
+        try:
+            await asyncio.gather(*(self._worker(pending) for _ in range(config.BROADCAST_CONCURRENCY)))
+        except asyncio.CancelledError:
+            await self.save()
+            raise
+        if self.status == "running":
+            self.status = "done"
+        self.finished = time.time()
+        await self.save()
+        logger.info(f"Рассылка {self.id} завершена: отправлено {self.sent}, "
+                    f"не отправлено {self.failed}, пропущено {self.skipped}")
+    
+    async def _worker(self, pending: Iterable[int]):
+        # Воркеры берут индексы из общего генератора, поэтому каждый чат обрабатывается один раз
+        for index in pending:
+            if self.status != "running":
+                return
+            result = await self._deliver(self.chat_ids[index])
+            setattr(self, result, getattr(self, result) + 1)
+            metrics.inc("lssr_broadcast_total", result=result)
+            
+            self._done_ahead.add(index)
+            while self.position in self._done_ahead:
+                self._done_ahead.remove(self.position)
+                self.position += 1
+            
+            if time.monotonic() - self._saved_at >= config.BROADCAST_SAVE_INTERVAL:
+                await self.save()
+    
+    async def _deliver(self, chat_id: int) -> str:
+        """Отправляет объявление в чат; возвращает sent, failed или skipped"""
+        chat_data = chats_data.get(chat_id)
+        if chat_data is not None and chat_data.unreachable_since:
+            return "skipped"
+        
+        attempts = 0
+        while True:
+            delay = send_queue.chat_delay(chat_id)
+            if delay:
+                await asyncio.sleep(delay)
+            await send_queue.bucket.acquire()
+            try:
+                await bot.send_message(chat_id, f"📢 <b>Объявление от администрации:</b>\n\n{self.text}")
+                send_queue.note_sent(chat_id)
+                return "sent"
+            except RetryAfter as e:
+                # Рассылка упирается в общий лимит бота - ждут все отправки
+                send_queue.bucket.pause(e.timeout)
+                logger.warning(f"Рассылка: Telegram просит подождать {e.timeout} с")
+            except UNREACHABLE_ERRORS as e:
+                mark_unreachable(chat_id, e)
+                return "skipped"
+            except BadRequest as e:
+                logger.error(f"Ошибка рассылки в чат {chat_id}: {e}")
+                return "failed"
+            except Exception as e:
+                attempts += 1
+                if attempts >= config.SEND_MAX_ATTEMPTS:
+                    logger.error(f"Ошибка рассылки в чат {chat_id}: {e}")
+                    return "failed"
+                await asyncio.sleep(2 ** attempts)
+    
+    def cancel(self):
+        self.status = "cancelled"
+    
+    async def stop(self):
+        """Останавливает рассылку при выключении; прогресс сохраняется для продолжения"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+    
+    async def save(self):
+        self._saved_at = time.monotonic()
+        path = broadcast_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            async with aiofiles.open(path + ".tmp", 'w', encoding='utf-8') as f:
+                await f.write(json.dumps(self.to_dict(), ensure_ascii=False))
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить прогресс рассылки: {e}")
+
+# Последняя рассылка этого процесса
+broadcast_job: Optional[BroadcastJob] = None
+
+def broadcast_path() -> str:
+    """Файл прогресса рассылки; у каждого шарда свой"""
+    if config.SHARD_INDEX < 0:
+        return config.BROADCAST_PATH
+    root, ext = os.path.splitext(config.BROADCAST_PATH)
+    return f"{root}-{config.SHARD_INDEX}{ext}"
+
+async def resume_broadcast():
+    """Продолжает рассылку, прерванную выключением"""
+    global broadcast_job
+    path = broadcast_path()
+    if not os.path.exists(path):
+        return
+    try:
+        async with aiofiles.open(path, 'r', encoding='utf-8') as f:
+            broadcast_job = BroadcastJob.from_dict(json.loads(await f.read()))
+    except Exception as e:
+        logger.error(f"Не удалось прочитать прогресс рассылки: {e}")
+        return
+    if broadcast_job.status != "running":
+        return
+    
+    logger.info(f"Продолжаю рассылку {broadcast_job.id}: {broadcast_job.done}/{len(broadcast_job.chat_ids)}")
+    broadcast_job.start()
+    if broadcast_job.notify and config.SHARD_INDEX <= 0:
+        spawn_broadcast_watcher(*broadcast_job.notify)
+
+async def local_broadcast(payload: dict) -> dict:
+    """Запускает рассылку по чатам этого процесса и сразу возвращает её состояние"""
+    global broadcast_job
+    if broadcast_job is not None and broadcast_job.status == "running":
+        return {**broadcast_job.progress(), "accepted": 0}
+    
+    broadcast_job = BroadcastJob(payload["id"], payload["text"], list(chats_data.keys()), payload.get("notify"))
+    await broadcast_job.save()
+    broadcast_job.start()
+    return {**broadcast_job.progress(), "accepted": 1}
+
+async def local_broadcast_status(payload: dict) -> dict:
+    return broadcast_job.progress() if broadcast_job is not None else {}
+
+async def local_broadcast_stop(payload: dict) -> dict:
+    if broadcast_job is not None and broadcast_job.status == "running":
+        broadcast_job.cancel()
+    return await local_broadcast_status(payload)
+
+def merge_progress(results: List[dict]) -> dict:
+    """Сводит состояние рассылки шардов"""
+    merged = {"running": 0, "cancelled": 0, "total": 0, "done": 0, "sent": 0, "failed": 0,
+              "skipped": 0, "rate": 0, "failed_shards": 0}
+    for result in results:
+        if "error" in result:
+            merged["failed_shards"] += 1
+            continue
+        for key in ("running", "cancelled", "total", "done", "sent", "failed", "skipped", "rate"):
+            merged[key] += result.get(key, 0)
+    return merged
+
+def format_broadcast_progress(progress: dict) -> str:
+    """Текст сообщения о ходе рассылки"""
+    if progress["running"]:
+        title = "📢 <b>Идёт рассылка...</b>"
+    elif progress["cancelled"]:
+        title = "⏹️ <b>Рассылка остановлена</b>"
+    else:
+        title = "✅ <b>Рассылка завершена!</b>"
+    
+    total = progress["total"]
+    text = (
+        f"{title}\n\n"
+        f"• Обработано: <code>{progress['done']}/{total}</code> "
+        f"({progress['done'] * 100 // total if total else 100}%)\n"
+        f"• Отправлено: <code>{progress['sent']}</code>\n"
+        f"• Не отправлено: <code>{progress['failed']}</code>\n"
+        f"• Пропущено (бот удалён или заблокирован): <code>{progress['skipped']}</code>\n"
+    )
+    if progress["running"] and progress["rate"] > 0:
+        remaining = int((total - progress["done"]) / progress["rate"])
+        text += (f"• Скорость: <code>{progress['rate']:.1f}</code> сообщений/с\n"
+                 f"• Осталось: ~{format_time_remaining(remaining)}\n")
+    if progress["failed_shards"]:
+        text += f"• Шардов без ответа: <code>{progress['failed_shards']}</code>\n"
+    return text
+
+# Задачи, обновляющие сообщения с прогрессом; ссылки держатся, чтобы задачи не собрал GC
+broadcast_watchers: Set[asyncio.Task] = set()
+
+def spawn_broadcast_watcher(chat_id: int, message_id: int):
+    task = asyncio.create_task(watch_broadcast(chat_id, message_id))
+    broadcast_watchers.add(task)
+    task.add_done_callback(broadcast_watchers.discard)
+
+async def watch_broadcast(chat_id: int, message_id: int):
+    """Обновляет сообщение с прогрессом, пока рассылка идёт"""
+    last_text = ""
+    silent = 0  # Сколько проверок подряд какой-то шард не отвечает
+    while True:
+        await asyncio.sleep(config.BROADCAST_PROGRESS_INTERVAL)
+        progress = merge_progress(await fan_out("broadcast_status"))
+        text = format_broadcast_progress(progress)
+        if text != last_text:
+            try:
+                await bot.edit_message_text(text, chat_id, message_id)
+                last_text = text
+            except Exception as e:
+                logger.debug(f"Не удалось обновить прогресс рассылки: {e}")
+        # Шард без ответа мог перезапускаться - какое-то время ждём, пока он снова ответит
+        silent = silent + 1 if progress["failed_shards"] else 0
+        if not progress["running"] and (not silent or silent >= config.BROADCAST_WATCH_RETRIES):
+            return
+
+# ==================== ШАРДЫ ====================
+def shard_of(chat_id: int, shards: int) -> int:
+    """Шард чата; crc32 не зависит от PYTHONHASHSEED и одинаков во всех процессах"""
+    return zlib.crc32(str(chat_id).encode()) % shards
+
+def is_sharded() -> bool:
+    return config.SHARDS > 1
+
+def owns_chat(chat_id: int) -> bool:
+    """Принадлежит ли чат этому процессу (без шардов - всегда)"""
+    return not is_sharded() or config.SHARD_INDEX < 0 or shard_of(chat_id, config.SHARDS) == config.SHARD_INDEX
+
+def update_chat_id(update: types.Update) -> Optional[int]:
+    """Чат, к которому относится обновление; для обновлений без чата - пользователь"""
+    for item in (update.message, update.edited_message, update.channel_post, update.edited_channel_post,
+                 update.my_chat_member, update.chat_member, update.chat_join_request):
+        if item is not None:
+            return item.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    for item in (update.inline_query, update.chosen_inline_result, update.shipping_query,
+                 update.pre_checkout_query, update.poll_answer):
+        if item is not None:
+            return item.from_user.id if hasattr(item, "from_user") else item.user.id
+    return None
+
+def shard_url(index: int, path: str) -> str:
+    return f"http://127.0.0.1:{config.SHARD_BASE_PORT + index}{path}"
+
+def local_stats() -> dict:
+    """Статистика чатов этого процесса для /statall"""
+    now = time.time()
+    top = sorted(chats_data.items(), key=lambda item: len(item[1].messages), reverse=True)[:10]
+    return {
+        "start_time": bot_stats["start_time"],
+        "total_chats": len(chats_data),
+        "active_chats": sum(1 for chat in chats_data.values() if now - chat.last_activity < 86400),
+        "trained_chats": sum(1 for chat in chats_data.values() if chat.model_version),
+        "revolutionary_chats": sum(1 for chat in chats_data.values() if chat.settings['revolutionary_mode']),
+        "total_messages": sum(len(chat.messages) for chat in chats_data.values()),
+        "total_messages_processed": bot_stats["total_messages_processed"],
+        "messages_generated": bot_stats["messages_generated"],
+        "commands_executed": bot_stats["commands_executed"],
+        "models_resident": len(model_cache),
+        "models_bytes": model_cache.resident_bytes(),
+        "cache_hits": model_cache.hits,
+        "cache_misses": model_cache.misses,
+        "cache_evictions": model_cache.evictions,
+        "vocabulary_words": len(vocabulary),
+        "vocabulary_bytes": vocabulary.string_bytes,
+        "vocabulary_saved_bytes": vocabulary.saved_bytes(model_cache.word_count()),
+        "top_chats": [[chat_id, len(chat.messages)] for chat_id, chat in top],
+    }
+
+def chat_summary(chat_data: ChatData) -> dict:
+    """Сведения о чате для /getchat и списка чатов"""
+    return {
+        "chat_id": chat_data.chat_id,
+        "messages": len(chat_data.messages),
+        "message_count": chat_data.message_count,
+        "mood": chat_data.mood,
+        "revolutionary_mode": chat_data.settings['revolutionary_mode'],
+        "learning_enabled": chat_data.settings['learning_enabled'],
+        "response_chance": chat_data.get_response_chance(),
+        "last_activity": chat_data.last_activity,
+        "off_until": chat_data.off_until,
+    }
+
+def merge_stats(results: List[dict]) -> dict:
+    """Сводит статистику шардов: числа складываются, топ чатов объединяется"""
+    merged = {"shards": len(results), "failed_shards": 0, "top_chats": []}
+    for result in results:
+        if "error" in result:
+            merged["failed_shards"] += 1
+            continue
+        for key, value in result.items():
+            if key == "top_chats":
+                merged["top_chats"].extend(value)
+            elif key == "start_time":
+                merged[key] = min(merged.get(key, value), value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+    merged["top_chats"] = sorted(merged["top_chats"], key=lambda item: item[1], reverse=True)[:10]
+    merged.setdefault("start_time", bot_stats["start_time"])
+    return merged
+
+async def local_reload(payload: dict) -> dict:
+    """Перечитывает чаты этого процесса из хранилища"""
+    old_count = len(chats_data)
+    chats_data.clear()
+    model_cache.clear()
+    await load_all_chats()
+    return {
+        "old_chats": old_count,
+        "chats": len(chats_data),
+        "messages": sum(len(chat.messages) for chat in chats_data.values()),
+    }
+
+async def _local_stats(payload: dict) -> dict:
+    return local_stats()
+
+async def _local_getchat(payload: dict) -> dict:
+    chat_data = chats_data.get(payload["chat_id"])
+    return {"chat": chat_summary(chat_data) if chat_data else None}
+
+async def _local_list_chats(payload: dict) -> dict:
+    return {"chats": [chat_summary(chat_data) for chat_data in chats_data.values()]}
+
+# Действия, которые админские команды выполняют на каждом шарде
+SHARD_ACTIONS: Dict[str, Callable[[dict], "asyncio.Future"]] = {
+    "stats": _local_stats,
+    "broadcast": local_broadcast,
+    "broadcast_status": local_broadcast_status,
+    "broadcast_stop": local_broadcast_stop,
+    "reload": local_reload,
+    "getchat": _local_getchat,
+    "list_chats": _local_list_chats,
+}
+
+async def fan_out(action: str, payload: Optional[dict] = None) -> List[dict]:
+    """Выполняет действие на всех шардах и возвращает их ответы (без шардов - локально)"""
+    payload = payload or {}
+    if not is_sharded():
+        return [await SHARD_ACTIONS[action](payload)]
+    
+    headers = {WebhookServer.SECRET_HEADER: config.SHARD_SECRET}
+    # Рассылка идёт долго, поэтому общего таймаута нет
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as session:
+        async def call(index: int) -> dict:
+            try:
+                async with session.post(shard_url(index, f"/shard/{action}"), json=payload, headers=headers) as response:
+                    response.raise_for_status()
+                    return await response.json()
+            except Exception as e:
+                logger.error(f"Шард {index} не выполнил {action}: {e}")
+                return {"shard": index, "error": str(e)}
+        
+        return list(await asyncio.gather(*(call(index) for index in range(config.SHARDS))))
+
+class ShardServer(WebhookServer):
+    """Шард: принимает обновления своих чатов от фронта и выполняет разосланные действия"""
+    
+    async def handle_action(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(self.SECRET_HEADER, ""), self.secret):
+            return web.Response(status=403)
+        action = SHARD_ACTIONS.get(request.match_info["action"])
+        if action is None:
+            return web.Response(status=404)
+        return web.json_response(await action(await request.json()))
+    
+    async def ping(self, request: web.Request) -> web.Response:
+        return web.json_response({"shard": config.SHARD_INDEX, "chats": len(chats_data)})
+    
+    def app(self) -> web.Application:
+        app = super().app()
+        app.router.add_post("/shard/{action}", self.handle_action)
+        app.router.add_get("/shard/ping", self.ping)
+        return app
+
+class ShardFrontServer(WebhookServer):
+    """Вебхук фронта: обновления не обрабатываются, а уходят шардам"""
+    
+    def __init__(self, router: "ShardRouter", *args):
+        super().__init__(dp, *args)
+        self.router = router
+    
+    async def process(self, update: types.Update):
+        await self.router.route(update)
+
+class ShardRouter:
+    """Фронт шардов: запускает процессы-шарды и раскладывает им обновления по chat_id"""
+    
+    def __init__(self, shards: int):
+        self.shards = shards
+        self.secret = secrets.token_urlsafe(24)
+        self.routed = [0] * shards
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._stopping = False
+        self._processes: List[Optional[asyncio.subprocess.Process]] = [None] * shards
+        self._supervisors: List[asyncio.Task] = []
+    
+    async def _spawn(self, index: int) -> asyncio.subprocess.Process:
+        env = dict(os.environ, SHARDS=str(self.shards), SHARD_INDEX=str(index), SHARD_SECRET=self.secret)
+        process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), "--shard-worker", env=env)
+        self._processes[index] = process
+        logger.info(f"Шард {index} запущен, pid {process.pid}")
+        return process
+    
+    async def _supervise(self, index: int):
+        """Перезапускает упавший шард"""
+        while True:
+            code = await self._processes[index].wait()
+            if self._stopping:
+                return
+            logger.error(f"Шард {index} завершился с кодом {code}, перезапуск")
+            await asyncio.sleep(1)
+            await self._spawn(index)
+    
+    async def _wait_ready(self, index: int):
+        deadline = time.time() + config.SHARD_START_TIMEOUT
+        while True:
+            try:
+                async with self.session.get(shard_url(index, "/shard/ping")) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.time() > deadline:
+                raise RuntimeError(f"Шард {index} не ответил за {config.SHARD_START_TIMEOUT} с")
+            await asyncio.sleep(0.5)
+    
+    async def start(self):
+        self.session = aiohttp.ClientSession()
+        for index in range(self.shards):
+            await self._spawn(index)
+        self._supervisors = [asyncio.create_task(self._supervise(index)) for index in range(self.shards)]
+        await asyncio.gather(*(self._wait_ready(index) for index in range(self.shards)))
+        logger.info(f"Все {self.shards} шардов готовы")
+    
+    async def route(self, update: types.Update):
+        """Отдаёт обновление шарду его чата; пока шард перезапускается, повторяет с паузой"""
+        chat_id = update_chat_id(update)
+        index = shard_of(chat_id or 0, self.shards)
+        deadline = time.monotonic() + config.SHARD_START_TIMEOUT
+        delay = 0.5
+        while True:
+            try:
+                async with self.session.post(shard_url(index, config.WEBHOOK_PATH), json=update.to_python(),
+                                             headers={WebhookServer.SECRET_HEADER: self.secret}) as response:
+                    if response.status < 500:
+                        response.raise_for_status()
+                        self.routed[index] += 1
+                        return
+                    error = f"HTTP {response.status}"
+            except aiohttp.ClientResponseError as e:
+                # Шард отверг обновление - повтор не поможет
+                logger.error(f"Шард {index} отклонил обновление {update.update_id}: {e}")
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = str(e) or type(e).__name__
+            except Exception as e:
+                logger.exception(f"Обновление {update.update_id} не доставлено шарду {index}: {e}")
+                return
+            
+            if self._stopping or time.monotonic() > deadline:
+                logger.error(f"Обновление {update.update_id} не доставлено шарду {index}: {error}")
+                return
+            logger.warning(f"Шард {index} недоступен ({error}), повтор через {delay:g} с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10)
+    
+    async def stop(self):
+        """Останавливает шарды: каждый доделывает очередь и сохраняет свои чаты"""
+        self._stopping = True
+        for process in self._processes:
+            if process is not None and process.returncode is None:
+                process.terminate()
+        await asyncio.gather(*(process.wait() for process in self._processes if process is not None))
+        for task in self._supervisors:
+            task.cancel()
+        if self.session is not None:
+            await self.session.close()
+
+async def poll_updates(process: Callable[[types.Update], "asyncio.Future"], stop: asyncio.Event):
+    """Long polling фронта: обновления по порядку передаются в process"""
+    await dp.skip_updates()
+    offset = None
+    while not stop.is_set():
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=20)
+        except Exception as e:
+            logger.error(f"Ошибка получения обновлений: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            try:
+                await process(update)
+            except Exception as e:
+                logger.exception(f"Ошибка передачи обновления {update.update_id}: {e}")
+            offset = update.update_id + 1
+
+async def run_shard_front(use_webhook: bool):
+    """Фронт: принимает обновления (polling или вебхук) и раздаёт их шардам"""
+    stop = stop_event()
+    router = ShardRouter(config.SHARDS)
+    Bot.set_current(bot)
+    try:
+        await router.start()
+        if use_webhook:
+            server = ShardFrontServer(router, config.WEBHOOK_PATH, config.WEBHOOK_SECRET,
+                                      config.WEBHOOK_WORKERS, config.WEBHOOK_QUEUE)
+            await server.start(config.WEBHOOK_HOST, config.WEBHOOK_PORT)
+            if config.WEBHOOK_URL:
+                await register_webhook()
+            await stop.wait()
+            await server.stop()
+        else:
+            polling = asyncio.create_task(poll_updates(router.route, stop))
+            await stop.wait()
+            polling.cancel()
+    finally:
+        await router.stop()
+        logger.info(f"Фронт остановлен, обновлений по шардам: {router.routed}")
+        await (await bot.get_session()).close()
+
+async def run_shard_worker():
+    """Процесс-шард: обычный бот, получающий обновления своих чатов от фронта"""
+    server = ShardServer(dp, config.WEBHOOK_PATH, config.SHARD_SECRET,
+                         config.WEBHOOK_WORKERS, config.WEBHOOK_QUEUE)
+    await serve_updates(server, "127.0.0.1", config.SHARD_BASE_PORT + config.SHARD_INDEX, False)
+
 # ==================== ЗАПУСК БОТА ====================
+def setup_middlewares():
+    """Подключает мидлвары к диспетчеру"""
+    dp.middleware.setup(MetricsMiddleware())
+    dp.middleware.setup(PrivateChatMiddleware())
+    dp.middleware.setup(ChatMiddleware())
+
 async def on_startup(dp):
     """Действия при запуске бота"""
     logger.info(f"{config.BOT_NAME} v{config.BOT_VERSION} запускается...")
     
     await load_all_chats()
+    await resume_broadcast()
+    
+    try:
+        await get_bot_identity()
+    except Exception as e:
+        logger.error(f"Не удалось получить данные бота: {e}")
     
     asyncio.create_task(auto_saver())
+    asyncio.create_task(identity_refresher())
+    asyncio.create_task(pool_refiller())
+    
+    if config.METRICS_PORT:
+        # У каждого шарда свой порт метрик: METRICS_PORT + номер шарда
+        config.METRICS_PORT += max(config.SHARD_INDEX, 0)
+        try:
+            await start_metrics_server()
+        except OSError as e:
+            logger.error(f"Не удалось запустить сервер метрик: {e}")
     
     logger.info(f"Бот запущен! Загружено {len(chats_data)} чатов.")
     logger.info(f"Главный администратор: {config.MAIN_ADMIN_ID}")
     
+    # Из шардов о запуске сообщает только первый
+    if config.SHARD_INDEX > 0:
+        return
+    
     # Уведомляем главного администратора о запуске
     try:
         await bot.send_message(
@@ -1875,10 +5288,29 @@ async def on_shutdown(dp):
     """Действия при выключении бота"""
     logger.info("Бот выключается...")
     
-    for chat_id in list(chats_data.keys()):
-        await save_chat_data(chat_id)
+    await send_queue.join(timeout=10)
+    for task in list(broadcast_watchers) + list(training_reports):
+        task.cancel()
+    if broadcast_job is not None:
+        await broadcast_job.stop()
     
-    logger.info("Все данные сохранены.")
+    save_count, bytes_written = await flush_dirty_chats()
+    await flush_models()
+    
+    logger.info(f"Все данные сохранены: {save_count} чатов, {bytes_written / 1024:.1f} КБ.")
+    
+    if training_pool is not None:
+        # Отмена задач отменяет и ещё не начатые сборки в пуле (cancel_futures есть только с 3.9)
+        for task in list(training_tasks.values()):
+            task.cancel()
+        training_pool.shutdown(wait=False)
+    if sqlite_storage is not None:
+        sqlite_storage.close()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    
+    if config.SHARD_INDEX > 0:
+        return
     
     # Уведомляем главного администратора о выключении
     try:
@@ -1894,13 +5326,44 @@ async def on_shutdown(dp):
         logger.error(f"Не удалось уведомить главного администратора: {e}")
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=config.BOT_DESCRIPTION)
+    parser.add_argument("--migrate-json", action="store_true",
+                        help="перенести чаты из JSON-файлов в SQLite и выйти")
+    parser.add_argument("--webhook", action="store_true",
+                        help="принимать обновления по вебхуку (WEBHOOK_*) вместо long polling")
+    parser.add_argument("--shards", type=int, default=config.SHARDS,
+                        help="раздавать чаты N процессам-шардам по chat_id")
+    parser.add_argument("--shard-worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    config.SHARDS = args.shards
+    chain_engine(config.CHAIN_ENGINE)  # Опечатка в CHAIN_ENGINE останавливает запуск, а не каждую сборку
+    
     # Создаем все необходимые директории
     os.makedirs(config.DB_FOLDER, exist_ok=True)
     os.makedirs(config.MODEL_FOLDER, exist_ok=True)
     os.makedirs(os.path.join(BASE_DIR, "data", "temp"), exist_ok=True)
     
-    dp.middleware.setup(PrivateChatMiddleware())
-    dp.middleware.setup(ChatMiddleware())
+    if args.migrate_json:
+        asyncio.run(migrate_json_to_sqlite())
+        get_sqlite_storage().close()
+        sys.exit(0)
+    
+    setup_middlewares()
+    
+    if args.webhook and not args.shard_worker and not ensure_webhook_secret():
+        sys.exit(1)
+    
+    if args.shard_worker:
+        asyncio.run(run_shard_worker())
+        sys.exit(0)
+    
+    if is_sharded():
+        asyncio.run(run_shard_front(args.webhook))
+        sys.exit(0)
+    
+    if args.webhook:
+        asyncio.run(run_webhook())
+        sys.exit(0)
     
     from aiogram.utils import executor
     
@@ -0,0 +1,387 @@
+# coding: utf-8
+# Нагрузочный прогон бота: настоящий dp, поток обновлений и локальная заглушка Bot API
+#
+# Синтетика: python replay.py --chats 50 --rate 20 --duration 60 --output replay.json
+# Запись: --updates updates.jsonl (по объекту Update в строке, как отдаёт getUpdates)
+# Режим вебхука: --webhook - обновления уходят POST-запросами на WebhookServer бота
+# В Telegram ничего не уходит: бот ходит в заглушку на 127.0.0.1
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# Адрес Bot API и токен читаются при импорте lssr, поэтому задаются до него
+BOT_ID = 123456789
+FAKE_API_PORT = free_port()
+WEBHOOK_SECRET = "replay-secret"
+os.environ["TOKEN"] = f"{BOT_ID}:OFFLINE-REPLAY-TOKEN"
+os.environ["TELEGRAM_API_SERVER"] = f"http://127.0.0.1:{FAKE_API_PORT}"
+
+import aiohttp
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+from loguru import logger
+
+import lssr
+from bench import git_revision, load_corpus, peak_rss_mb, percentiles, synthetic_corpus
+
+BOT_USERNAME = "lssr_replay_bot"
+COMMANDS = ["/stats", "/mood", "/help", "/settings", "/triggers"]
+UPDATE_KINDS = ("message", "command", "reply", "mention")
+
+# ==================== ЗАГЛУШКА BOT API ====================
+class FakeBotAPI:
+    """Локальный Bot API: отвечает правдоподобными объектами и считает вызовы"""
+
+    def __init__(self, admin_share: float):
+        self.admin_share = admin_share
+        self.calls = Counter()
+        self.chats = Counter()
+        self.message_id = 1000000
+        self.runner: Optional[web.AppRunner] = None
+
+    def bot_user(self) -> Dict:
+        return {"id": BOT_ID, "is_bot": True, "first_name": "ЛССР", "username": BOT_USERNAME}
+
+    def chat(self, chat_id) -> Dict:
+        chat_id = int(chat_id)
+        if chat_id > 0:
+            return {"id": chat_id, "type": "private", "first_name": f"user{chat_id}"}
+        return {"id": chat_id, "type": "supergroup", "title": f"Чат {chat_id}"}
+
+    def member(self, user_id) -> Dict:
+        user_id = int(user_id)
+        # Админом считается фиксированная доля пользователей, чтобы прогоны повторялись
+        admin = (user_id % 1000) < self.admin_share * 1000
+        return {
+            "user": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "status": "administrator" if admin else "member",
+            "can_be_edited": False,
+        }
+
+    def message(self, params: Dict) -> Dict:
+        self.message_id += 1
+        return {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": self.chat(params.get("chat_id", 0)),
+            "from": self.bot_user(),
+            "text": params.get("text") or params.get("caption") or "",
+        }
+
+    def result(self, method: str, params: Dict):
+        if method == "getme":
+            return self.bot_user()
+        if method in ("sendmessage", "senddocument", "sendphoto", "sendsticker", "editmessagetext"):
+            self.chats[params.get("chat_id")] += 1
+            return self.message(params)
+        if method == "getchatmember":
+            return self.member(params.get("user_id", 0))
+        if method == "getchatadministrators":
+            return [{"user": self.bot_user(), "status": "administrator"}]
+        if method == "getchat":
+            return self.chat(params.get("chat_id", 0))
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        params = dict(request.query)
+        if request.body_exists:
+            params.update({key: value for key, value in (await request.post()).items()
+                           if isinstance(value, str)})
+        self.calls[method] += 1
+        return web.json_response({"ok": True, "result": self.result(method, params)})
+
+    async def start(self, port: int):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+# ==================== ПОТОК ОБНОВЛЕНИЙ ====================
+def update_kind(data: Dict) -> str:
+    """Тип обновления для отчёта: команда, ответ боту, упоминание или обычное сообщение"""
+    message = data.get("message") or {}
+    text = message.get("text") or message.get("caption") or ""
+    if text.startswith("/"):
+        return "command"
+    if (message.get("reply_to_message") or {}).get("from", {}).get("id") == BOT_ID:
+        return "reply"
+    lowered = text.lower()
+    if f"@{BOT_USERNAME}" in lowered or any(word in lowered for word in lssr.config.TRIGGER_WORDS):
+        return "mention"
+    return "message"
+
+def synthetic_updates(args, corpus: List[str]) -> Iterator[Tuple[str, Dict]]:
+    """Сообщения в N групп вперемешку: обычные, команды, ответы боту и упоминания"""
+    rng = random.Random(args.seed)
+    chat_ids = [-1001000000000 - index for index in range(args.chats)]
+    kinds = ["command", "reply", "mention", "message"]
+    weights = [args.commands, args.replies, args.mentions]
+    weights.append(max(0.0, 1 - sum(weights)))
+
+    for update_id in range(1, int(args.rate * args.duration) + 1):
+        chat_id = rng.choice(chat_ids)
+        user_id = rng.randint(1, args.users)
+        kind = rng.choices(kinds, weights)[0]
+        text = rng.choice(corpus)
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Чат {chat_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        }
+        if kind == "command":
+            message["text"] = rng.choice(COMMANDS)
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(message["text"])}]
+        elif kind == "reply":
+            message["reply_to_message"] = {
+                "message_id": update_id - 1,
+                "date": int(time.time()),
+                "chat": message["chat"],
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "ЛССР", "username": BOT_USERNAME},
+                "text": rng.choice(corpus),
+            }
+        elif kind == "mention":
+            mention = rng.choice([f"@{BOT_USERNAME}"] + lssr.config.TRIGGER_WORDS)
+            message["text"] = f"{mention}, {text}"
+        yield kind, {"update_id": update_id, "message": message}
+
+def recorded_updates(path: str) -> Iterator[Tuple[str, Dict]]:
+    """Записанный поток: JSONL или JSON-список объектов Update"""
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".json"):
+            data = json.load(f)
+            items = data.get("result", []) if isinstance(data, dict) else data
+        else:
+            items = (json.loads(line) for line in f if line.strip())
+        for item in items:
+            yield update_kind(item), item
+
+# ==================== ПРОГОН ====================
+async def monitor_loop_lag(samples: List[float], interval: float):
+    """Насколько позже запланированного просыпается цикл событий"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - started - interval)
+
+async def process(update: types.Update, kind: str, due: float, latency: Dict[str, List[float]], errors: Counter):
+    # Задержка считается от момента, когда обновление должно было прийти
+    try:
+        await lssr.dp.process_update(update)
+    except Exception as e:
+        errors[type(e).__name__] += 1
+    latency[kind].append(asyncio.get_running_loop().time() - due)
+
+async def post(session: aiohttp.ClientSession, url: str, data: Dict, kind: str, due: float,
+               latency: Dict[str, List[float]], errors: Counter):
+    # В режиме вебхука меряется время до ответа сервера, обработка идёт после него
+    try:
+        async with session.post(url, json=data, headers={lssr.WebhookServer.SECRET_HEADER: WEBHOOK_SECRET}) as response:
+            if response.status != 200:
+                errors[f"HTTP {response.status}"] += 1
+    except aiohttp.ClientError as e:
+        errors[type(e).__name__] += 1
+    latency[kind].append(asyncio.get_running_loop().time() - due)
+
+async def preload_history(args, corpus: List[str], chat_ids: List[int]):
+    """История чатов до прогона, чтобы бот сразу мог отвечать"""
+    rng = random.Random(args.seed + 1)
+    for chat_id in chat_ids:
+        chat_data = lssr.ChatData(chat_id)
+        for message in rng.sample(corpus, min(args.history, len(corpus))):
+            chat_data.add_message(message)
+        lssr.chats_data[chat_id] = chat_data
+
+async def replay(args, updates: List[Tuple[str, Dict]],
+                 webhook: Optional[Tuple[lssr.WebhookServer, str]] = None) -> Dict:
+    loop = asyncio.get_running_loop()
+    latency: Dict[str, List[float]] = defaultdict(list)
+    errors = Counter()
+    lag: List[float] = []
+    tasks = []
+
+    session = aiohttp.ClientSession() if webhook else None
+    lag_monitor = asyncio.create_task(monitor_loop_lag(lag, args.lag_interval))
+    interval = 1 / args.rate
+    started = loop.time()
+    for index, (kind, data) in enumerate(updates):
+        due = started + index * interval
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if webhook:
+            delivery = post(session, webhook[1], data, kind, due, latency, errors)
+        else:
+            delivery = process(types.Update.to_object(data), kind, due, latency, errors)
+        tasks.append(asyncio.create_task(delivery))
+    fed = loop.time() - started
+
+    await asyncio.gather(*tasks)
+    if webhook:
+        await session.close()
+        await webhook[0].queue.join()
+        await lssr.dp.drain()
+    # Ответы бота уходят из очереди отправки после задержки набора текста
+    await lssr.send_queue.join()
+    finished = loop.time() - started
+    lag_monitor.cancel()
+
+    all_latency = [sample for samples in latency.values() for sample in samples]
+    return {
+        "updates": len(updates),
+        "feed_seconds": round(fed, 3),
+        "total_seconds": round(finished, 3),
+        "achieved_rate": round(len(updates) / fed, 2) if fed else None,
+        "webhook_ack_latency" if webhook else "handler_latency": {
+            "all": percentiles(all_latency),
+            **{kind: percentiles(latency[kind]) for kind in UPDATE_KINDS if latency[kind]},
+        },
+        "loop_lag": percentiles(lag),
+        "errors": dict(errors),
+    }
+
+async def run(args) -> Dict:
+    workdir = tempfile.mkdtemp(prefix="lssr-replay-")
+    lssr.config.DB_FOLDER = os.path.join(workdir, "lsrr_db")
+    lssr.config.MODEL_FOLDER = os.path.join(workdir, "models")
+    lssr.config.SQLITE_PATH = os.path.join(workdir, "lssr.sqlite3")
+    os.makedirs(lssr.config.DB_FOLDER, exist_ok=True)
+    os.makedirs(lssr.config.MODEL_FOLDER, exist_ok=True)
+    if args.save_interval:
+        lssr.config.SAVE_INTERVAL = args.save_interval
+    if args.no_delays:
+        lssr.config.TYPING_DELAY = (0, 0)
+        for mood in lssr.config.MOODS.values():
+            mood["response_time"] = (0, 0)
+
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus(10000, args.seed)
+    if args.updates:
+        updates = list(recorded_updates(args.updates))
+    else:
+        updates = list(synthetic_updates(args, corpus))
+
+    fake_api = FakeBotAPI(args.admin_share)
+    await fake_api.start(FAKE_API_PORT)
+    Bot.set_current(lssr.bot)
+    Dispatcher.set_current(lssr.dp)
+    lssr.setup_middlewares()
+    try:
+        await lssr.on_startup(lssr.dp)
+        if args.history:
+            chat_ids = sorted({data["message"]["chat"]["id"] for _, data in updates if data.get("message")})
+            await preload_history(args, corpus, chat_ids)
+        startup_calls = Counter(fake_api.calls)
+
+        webhook = None
+        if args.webhook:
+            port = free_port()
+            server = lssr.WebhookServer(lssr.dp, lssr.config.WEBHOOK_PATH, WEBHOOK_SECRET,
+                                        args.webhook_workers, lssr.config.WEBHOOK_QUEUE)
+            await server.start("127.0.0.1", port)
+            webhook = (server, f"http://127.0.0.1:{port}{lssr.config.WEBHOOK_PATH}")
+
+        print(f"Прогон: {len(updates)} обновлений, {args.rate} в секунду", file=sys.stderr)
+        result = await replay(args, updates, webhook)
+        replay_calls = fake_api.calls - startup_calls
+        if webhook:
+            await webhook[0].stop()
+            result["webhook"] = {"received": webhook[0].received, "rejected": webhook[0].rejected}
+
+        await lssr.on_shutdown(lssr.dp)
+    finally:
+        await fake_api.stop()
+        await (await lssr.bot.get_session()).close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    calls = sum(replay_calls.values())
+    result["api_calls"] = {
+        "total": calls,
+        "per_update": round(calls / len(updates), 3) if updates else None,
+        "by_method": dict(replay_calls),
+        "chats_replied": len(fake_api.chats) - (str(lssr.config.MAIN_ADMIN_ID) in fake_api.chats),
+    }
+    result["replies_generated"] = lssr.bot_stats["messages_generated"]
+    result["peak_rss_mb"] = peak_rss_mb()
+    return {
+        "meta": {
+            "bot_version": lssr.config.BOT_VERSION,
+            "revision": git_revision(),
+            "source": args.updates or "synthetic",
+            "chats": args.chats,
+            "rate": args.rate,
+            "duration": args.duration,
+            "history": args.history,
+            "no_delays": args.no_delays,
+            "webhook_workers": args.webhook_workers if args.webhook else None,
+            "chain_engine": lssr.config.CHAIN_ENGINE,
+            "seed": args.seed,
+            "started_at": int(time.time()),
+        },
+        "result": result,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота ЛССР через заглушку Bot API")
+    parser.add_argument("--updates", help="Записанный поток обновлений (JSONL или JSON)")
+    parser.add_argument("--corpus", help="Корпус текстов для синтетики и истории чатов")
+    parser.add_argument("--chats", type=int, default=20, help="Число групп в синтетике")
+    parser.add_argument("--users", type=int, default=200, help="Число пользователей в синтетике")
+    parser.add_argument("--rate", type=float, default=10, help="Обновлений в секунду на все чаты")
+    parser.add_argument("--duration", type=float, default=30, help="Длительность синтетики в секундах")
+    parser.add_argument("--commands", type=float, default=0.03, help="Доля команд")
+    parser.add_argument("--replies", type=float, default=0.05, help="Доля ответов на сообщения бота")
+    parser.add_argument("--mentions", type=float, default=0.05, help="Доля упоминаний бота")
+    parser.add_argument("--admin-share", type=float, default=0.1,
+                        help="Доля пользователей, которых заглушка считает админами")
+    parser.add_argument("--history", type=int, default=300,
+                        help="Сообщений истории в каждом чате до прогона")
+    parser.add_argument("--no-delays", action="store_true",
+                        help="Без имитации набора текста (задержки настроений и TYPING_DELAY)")
+    parser.add_argument("--webhook", action="store_true",
+                        help="Доставлять обновления POST-запросами на вебхук бота")
+    parser.add_argument("--webhook-workers", type=int, default=lssr.config.WEBHOOK_WORKERS,
+                        help="Воркеров вебхука")
+    parser.add_argument("--save-interval", type=int, help="Период автосохранения в секундах")
+    parser.add_argument("--lag-interval", type=float, default=0.01,
+                        help="Шаг замера задержки цикла событий в секундах")
+    parser.add_argument("--seed", type=int, default=1917)
+    parser.add_argument("--output", help="Файл отчёта JSON (по умолчанию - stdout)")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()